@@ -3,6 +3,7 @@ from discord import app_commands
 from discord.ext import commands
 from typing import Literal
 from config import Config
+from models.fair_queue import guild_usage
 import json
 import os
 import shutil
@@ -134,42 +135,14 @@ class AdminCog(commands.Cog):
     async def _show_stats(self, interaction: discord.Interaction):
         """使用統計の表示"""
         try:
-            # 統計データの収集
-            stats = {
-                "total_users": 0,
-                "total_conversations": 0,
-                "total_messages": 0
-            }
-            
-            # 会話データの統計
-            conversations_dir = "data/conversations/memories"
-            if os.path.exists(conversations_dir):
-                for file in os.listdir(conversations_dir):
-                    if file.endswith('.json'):
-                        stats["total_users"] += 1
-                        try:
-                            with open(os.path.join(conversations_dir, file), 'r', encoding='utf-8') as f:
-                                data = json.load(f)
-                                conversations = data.get('conversations', [])
-                                stats["total_conversations"] += len(conversations)
-                                stats["total_messages"] += len(conversations) * 2  # ユーザー + AI
-                        except:
-                            continue
-            
-            # 学習データの統計
-            training_data_path = "data/conversations/training_data.json"
-            training_data_count = 0
-            if os.path.exists(training_data_path):
-                try:
-                    with open(training_data_path, 'r', encoding='utf-8') as f:
-                        training_data = json.load(f)
-                        training_data_count = len(training_data)
-                except:
-                    pass
+            # 統計データ（書き込み時に更新されるカウンター）
+            from models.engine_registry import engine_registry
+            stats = engine_registry.get_memory().get_data_stats()
+            training_data_count = stats['training_rows']
             
             embed = discord.Embed(
                 title="📊 使用統計",
-                description="ボットの使用統計です",
+                description="ボットの使用統計です" + ("" if stats['ready'] else "（データ統計を集計中）"),
                 color=discord.Color.blue(),
                 timestamp=datetime.now()
             )
@@ -177,9 +150,9 @@ class AdminCog(commands.Cog):
             embed.add_field(
                 name="👥 ユーザー統計",
                 value=(
-                    f"**総ユーザー数**: {stats['total_users']}\n"
-                    f"**総会話数**: {stats['total_conversations']}\n"
-                    f"**総メッセージ数**: {stats['total_messages']}"
+                    f"**総ユーザー数**: {stats['users']}\n"
+                    f"**総会話数**: {stats['conversations']}\n"
+                    f"**総メッセージ数**: {stats['messages']}"
                 ),
                 inline=True
             )
@@ -196,7 +169,13 @@ class AdminCog(commands.Cog):
             
             embed.add_field(
                 name="💾 データサイズ",
-                value=self._get_data_size(),
+                value=self._format_data_size(stats),
+                inline=False
+            )
+            
+            embed.add_field(
+                name="🏷️ サーバー別使用量",
+                value=self._format_guild_usage(),
                 inline=False
             )
             
@@ -210,21 +189,33 @@ class AdminCog(commands.Cog):
             )
             await interaction.response.send_message(embed=embed, ephemeral=True)
     
-    def _get_data_size(self) -> str:
-        """データディレクトリのサイズを取得"""
-        try:
-            total_size = 0
-            for dirpath, dirnames, filenames in os.walk("data"):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    if os.path.exists(filepath):
-                        total_size += os.path.getsize(filepath)
-            
-            # バイトをMBに変換
-            size_mb = total_size / (1024 * 1024)
-            return f"{size_mb:.2f} MB"
-        except:
-            return "不明"
+    def _format_guild_usage(self, limit: int = 5) -> str:
+        """生成トークン数の多いサーバーの使用量を整形"""
+        usage = guild_usage.get_stats()
+        if not usage:
+            return "まだ生成がありません"
+        
+        lines = []
+        top = sorted(usage.items(), key=lambda item: item[1]['tokens'], reverse=True)[:limit]
+        for guild_id, stats in top:
+            guild = self.bot.get_guild(int(guild_id)) if guild_id.isdigit() else None
+            name = guild.name if guild else guild_id
+            quota = f"/{stats['quota']}" if stats['quota'] else ""
+            lines.append(
+                f"**{name}**: {stats['requests']}件, {stats['tokens']}トークン "
+                f"(直近1分 {stats['tokens_last_minute']}{quota})"
+            )
+        return "\n".join(lines)
+    
+    def _format_data_size(self, stats: dict) -> str:
+        """会話履歴と学習データのサイズを整形"""
+        # バイトをMBに変換
+        history_mb = stats['bytes'] / (1024 * 1024)
+        training_mb = stats['training_bytes'] / (1024 * 1024)
+        return (
+            f"{history_mb + training_mb:.2f} MB "
+            f"(会話履歴 {history_mb:.2f} MB / 学習データ {training_mb:.2f} MB)"
+        )
 
 async def setup(bot):
     await bot.add_cog(AdminCog(bot))
\ No newline at end of file
@@ -1,35 +1,68 @@
 import discord
 from discord import app_commands
 from discord.ext import commands
-from models.local_ai import LocalAI
-from models.memory_manager import MemoryManager
+from config import Config
+from models.cancellation import CancellationToken, GenerationCancelled
+from models.engine_registry import engine_registry, STATE_WARMING
+from utils.streaming_reply import StreamingReply
 import asyncio
 
+# インタラクションのトークンの有効期間（秒、これを過ぎるとfollowupを送れない）
+INTERACTION_TOKEN_LIFETIME = 15 * 60
+
 class AIChatCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.ai = LocalAI()
-        self.memory = MemoryManager()
+        self.memory = engine_registry.get_memory()
         
     @app_commands.command(name="chat", description="AIと対話します")
     @app_commands.describe(message="AIに送るメッセージ")
     async def chat(self, interaction: discord.Interaction, message: str):
+        # モデルの準備中は待たせずにその旨を返す
+        ai = engine_registry.get_ready_ai()
+        if ai is None:
+            await interaction.response.send_message(embed=self._build_warming_embed(), ephemeral=True)
+            return
+        
         await interaction.response.defer(thinking=True)
         
         try:
             # ユーザーの会話履歴を取得（サーバー別）
             user_id = str(interaction.user.id)
             guild_id = str(interaction.guild.id) if interaction.guild else None
-            context = self.memory.get_context(user_id, guild_id)
+            context = await self.memory.get_prompt_context_async(user_id, guild_id)
             
-            # AI応答生成（時間測定）
+            # 生成途中の応答を段階的に表示（ストリーミング）
+            stream = None
+            if Config.AI_STREAMING and ai.use_real_model:
+                stream = StreamingReply(
+                    send=lambda embed: interaction.followup.send(embed=embed, wait=True),
+                    build_embed=self._build_partial_embed
+                )
+            
+            # インタラクションの期限が切れたら生成を途中で止める（もう応答を送れないため）
             import time
+            elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+            cancel_token = CancellationToken(expires_at=time.monotonic() + INTERACTION_TOKEN_LIFETIME - elapsed)
+            
+            # AI応答生成（時間測定）
             start_time = time.time()
-            response = await self.ai.generate_response(message, context)
+            try:
+                response = await ai.generate_response(
+                    message, context,
+                    on_partial=stream.update if stream else None,
+                    guild_id=guild_id,
+                    cancel_token=cancel_token,
+                    user_id=user_id
+                )
+            except GenerationCancelled:
+                if stream:
+                    await stream.discard()
+                return
             generation_time = time.time() - start_time
             
             # 会話履歴を更新（サーバー別、コマンドとして）
-            self.memory.add_conversation(
+            await self.memory.add_conversation_async(
                 user_id=user_id,
                 user_message=message,
                 ai_response=response,
@@ -50,16 +83,19 @@ class AIChatCog(commands.Cog):
             )
             
             # 応答時間とモデル情報を追加
-            model_info = "rinna/japanese-gpt2-medium" if self.ai.use_real_model else "ダミーモード"
+            model_info = "rinna/japanese-gpt2-medium" if ai.use_real_model else "ダミーモード"
             embed.set_footer(
                 text=f"応答時間: {generation_time:.2f}秒 | モデル: {model_info} | {interaction.user.display_name}",
                 icon_url=interaction.user.display_avatar.url
             )
             
-            await interaction.followup.send(embed=embed)
+            if stream:
+                await stream.finish(embed, response)
+            else:
+                await interaction.followup.send(embed=embed)
             
             # 非同期で学習データを更新
-            asyncio.create_task(self.ai.update_learning_data(user_id, message, response))
+            asyncio.create_task(ai.update_learning_data(user_id, message, response))
             
         except Exception as e:
             print(f"Chat command error: {e}")
@@ -69,6 +105,25 @@ class AIChatCog(commands.Cog):
                 color=discord.Color.red()
             )
             await interaction.followup.send(embed=error_embed, ephemeral=True)
+    
+    def _build_warming_embed(self) -> discord.Embed:
+        """モデル準備中の案内Embed"""
+        state_text = "モデルを読み込み中" if engine_registry.state != STATE_WARMING else "ウォームアップ中"
+        return discord.Embed(
+            title="⏳ AI 準備中",
+            description=f"AIモデルは現在{state_text}です。準備ができるまで少しお待ちください。",
+            color=discord.Color.orange()
+        )
+    
+    def _build_partial_embed(self, text: str) -> discord.Embed:
+        """生成途中の応答用Embed"""
+        embed = discord.Embed(
+            title="🤖 AI アシスタント",
+            description=text,
+            color=discord.Color.from_rgb(100, 149, 237)  # コーンフラワーブルー
+        )
+        embed.set_footer(text="✍️ 生成中...")
+        return embed
 
 async def setup(bot):
     await bot.add_cog(AIChatCog(bot))
\ No newline at end of file
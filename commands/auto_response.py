@@ -59,7 +59,7 @@ class AutoResponseCog(commands.Cog):
 
     async def _enable_auto_response(self, interaction: discord.Interaction, channel: discord.TextChannel):
         """自動応答を有効化"""
-        success = auto_response_manager.add_channel(channel.id)
+        success = await auto_response_manager.add_channel_async(channel.id)
         
         if success:
             embed = discord.Embed(
@@ -79,7 +79,7 @@ class AutoResponseCog(commands.Cog):
 
     async def _disable_auto_response(self, interaction: discord.Interaction, channel: discord.TextChannel):
         """自動応答を無効化"""
-        success = auto_response_manager.remove_channel(channel.id)
+        success = await auto_response_manager.remove_channel_async(channel.id)
         
         if success:
             embed = discord.Embed(
@@ -54,6 +54,17 @@ class HelpCog(commands.Cog):
             inline=False
         )
         
+        # 禁止パターンコマンド
+        embed.add_field(
+            name="🚫 禁止パターン",
+            value=(
+                "`/filter list` - このサーバーの禁止パターン一覧\n"
+                "`/filter add` - 禁止パターンを追加\n"
+                "`/filter remove` - 禁止パターンを解除"
+            ),
+            inline=False
+        )
+        
         # 管理者コマンド
         embed.add_field(
             name="⚙️ 管理者コマンド",
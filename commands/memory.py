@@ -1,13 +1,13 @@
 import discord
 from discord import app_commands
 from discord.ext import commands
-from models.memory_manager import MemoryManager
+from models.engine_registry import engine_registry
 from typing import Literal
 
 class MemoryCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.memory = MemoryManager()
+        self.memory = engine_registry.get_memory()
         
     @app_commands.command(name="memory", description="記憶管理を行います")
     @app_commands.describe(action="実行するアクション")
@@ -24,7 +24,7 @@ class MemoryCog(commands.Cog):
     async def _show_memory(self, interaction: discord.Interaction, user_id: str):
         """会話履歴を表示（サーバー別）"""
         guild_id = str(interaction.guild.id) if interaction.guild else None
-        conversations = self.memory.get_context(user_id, guild_id)
+        conversations = await self.memory.get_context_async(user_id, guild_id)
         
         if not conversations:
             embed = discord.Embed(
@@ -66,7 +66,7 @@ class MemoryCog(commands.Cog):
     async def _clear_memory(self, interaction: discord.Interaction, user_id: str):
         """会話履歴をクリア（サーバー別）"""
         guild_id = str(interaction.guild.id) if interaction.guild else None
-        conversations = self.memory.get_context(user_id, guild_id)
+        conversations = await self.memory.get_context_async(user_id, guild_id)
         
         if not conversations:
             embed = discord.Embed(
@@ -95,7 +95,7 @@ class MemoryCog(commands.Cog):
                 
             @discord.ui.button(label="はい", style=discord.ButtonStyle.danger)
             async def confirm(self, interaction: discord.Interaction, button: discord.ui.Button):
-                self.memory_manager.clear_memory(self.user_id, self.guild_id)
+                await self.memory_manager.clear_memory_async(self.user_id, self.guild_id)
                 
                 embed = discord.Embed(
                     title="🧠 記憶クリア完了",
@@ -119,7 +119,7 @@ class MemoryCog(commands.Cog):
     async def _export_memory(self, interaction: discord.Interaction, user_id: str):
         """会話履歴をエクスポート（サーバー別）"""
         guild_id = str(interaction.guild.id) if interaction.guild else None
-        export_text = self.memory.export_memory(user_id, guild_id)
+        export_text = await self.memory.export_memory_async(user_id, guild_id)
         
         if export_text == "会話履歴がありません。":
             embed = discord.Embed(
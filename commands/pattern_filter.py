@@ -0,0 +1,144 @@
+"""
+禁止パターンコマンド - サーバーごとの禁止パターン設定
+
+AIの応答に含めない文字列（URL・宣伝など）をサーバーごとに追加・無効化するコマンド
+"""
+
+import discord
+from discord import app_commands
+from discord.ext import commands
+from typing import Literal
+
+from models.engine_registry import engine_registry
+from models.pattern_filter import BLOCKED_PATTERNS, blocked_pattern_settings
+from config import Config
+
+
+class PatternFilterCog(commands.Cog):
+    """禁止パターン管理コマンド"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def _is_admin(self, user_id: int) -> bool:
+        """管理者権限チェック"""
+        return str(user_id) in Config.ADMIN_IDS
+
+    @app_commands.command(name="filter", description="AI応答の禁止パターンを設定します")
+    @app_commands.describe(
+        action="実行するアクション",
+        pattern="対象のパターン（add / remove の場合）"
+    )
+    async def pattern_filter(
+        self,
+        interaction: discord.Interaction,
+        action: Literal["list", "add", "remove"],
+        pattern: str = None
+    ):
+        """禁止パターン設定コマンド"""
+        # 管理者権限チェック
+        if not self._is_admin(interaction.user.id):
+            embed = discord.Embed(
+                title="❌ 権限エラー",
+                description="このコマンドは管理者のみ使用できます。",
+                color=discord.Color.red()
+            )
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+
+        if interaction.guild is None:
+            embed = discord.Embed(
+                title="❌ サーバー外",
+                description="このコマンドはサーバー内でのみ使用できます。",
+                color=discord.Color.red()
+            )
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+
+        guild_id = str(interaction.guild.id)
+        if action == "list":
+            await self._show_list(interaction, guild_id)
+        elif not pattern or not pattern.strip():
+            embed = discord.Embed(
+                title="❌ パターン未指定",
+                description="`pattern` に対象の文字列を指定してください。",
+                color=discord.Color.red()
+            )
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+        elif action == "add":
+            await self._add_pattern(interaction, guild_id, pattern.strip())
+        elif action == "remove":
+            await self._remove_pattern(interaction, guild_id, pattern.strip())
+
+    async def _add_pattern(self, interaction: discord.Interaction, guild_id: str, pattern: str):
+        """禁止パターンを有効化"""
+        if blocked_pattern_settings.add_pattern(guild_id, pattern):
+            embed = discord.Embed(
+                title="✅ 禁止パターンを追加",
+                description=f"`{pattern}` を含む応答を生成しないようにしました。",
+                color=discord.Color.green()
+            )
+        else:
+            embed = discord.Embed(
+                title="ℹ️ 既に有効",
+                description=f"`{pattern}` は既に禁止パターンです。",
+                color=discord.Color.blue()
+            )
+
+        await interaction.response.send_message(embed=embed)
+
+        # 生成中に語彙全体を走査しないよう、ここで索引を作っておく
+        # （準備中の場合はウォームアップで設定済みのパターンをまとめて作る）
+        ai = engine_registry.get_ready_ai()
+        prepare_patterns = getattr(ai, 'prepare_patterns', None)
+        if prepare_patterns is not None:
+            await prepare_patterns([pattern.lower()])
+
+    async def _remove_pattern(self, interaction: discord.Interaction, guild_id: str, pattern: str):
+        """禁止パターンを無効化"""
+        if blocked_pattern_settings.remove_pattern(guild_id, pattern):
+            embed = discord.Embed(
+                title="🔓 禁止パターンを解除",
+                description=f"このサーバーでは `{pattern}` を禁止しません。",
+                color=discord.Color.orange()
+            )
+        else:
+            embed = discord.Embed(
+                title="ℹ️ 禁止されていません",
+                description=f"`{pattern}` はこのサーバーの禁止パターンではありません。",
+                color=discord.Color.blue()
+            )
+
+        await interaction.response.send_message(embed=embed)
+
+    async def _show_list(self, interaction: discord.Interaction, guild_id: str):
+        """このサーバーで有効な禁止パターン一覧"""
+        patterns = blocked_pattern_settings.get_patterns(guild_id)
+
+        embed = discord.Embed(
+            title="📋 禁止パターン一覧",
+            color=discord.Color.blue()
+        )
+
+        if not patterns:
+            embed.description = "このサーバーでは禁止パターンが設定されていません。"
+        else:
+            embed.description = "\n".join(
+                f"• `{pattern}`" + ("" if pattern in BLOCKED_PATTERNS else "（追加）")
+                for pattern in patterns
+            )
+
+        disabled = [pattern for pattern in BLOCKED_PATTERNS if pattern not in patterns]
+        if disabled:
+            embed.add_field(
+                name="無効にした既定パターン",
+                value=", ".join(f"`{pattern}`" for pattern in disabled),
+                inline=False
+            )
+
+        embed.set_footer(text="管理者のみがこの設定を変更できます")
+        await interaction.response.send_message(embed=embed)
+
+
+async def setup(bot):
+    await bot.add_cog(PatternFilterCog(bot))
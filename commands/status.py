@@ -2,7 +2,6 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 import psutil
-import os
 from datetime import datetime
 
 # PyTorchのインポートを安全に行う
@@ -40,21 +39,11 @@ class StatusCog(commands.Cog):
                 gpu_name = "PyTorch未インストール" if not TORCH_AVAILABLE else "なし"
                 gpu_memory = 0
 
-            # 会話データの統計（サーバー別に対応）
-            conversations_dir = "data/conversations/memories"
-            total_conversations = 0
-            total_servers = 0
-            
-            if os.path.exists(conversations_dir):
-                for item in os.listdir(conversations_dir):
-                    item_path = os.path.join(conversations_dir, item)
-                    if os.path.isdir(item_path) and item.startswith("guild_"):
-                        total_servers += 1
-                        for file in os.listdir(item_path):
-                            if file.endswith('.json'):
-                                total_conversations += 1
-                    elif item.endswith('.json'):
-                        total_conversations += 1
+            # 会話データの統計（書き込み時に更新されるカウンター）
+            from models.engine_registry import engine_registry
+            data_stats = engine_registry.get_memory().get_data_stats()
+            total_conversations = data_stats['users']
+            total_servers = data_stats['servers']
 
             embed = discord.Embed(
                 title="🔍 ボット状態",
@@ -77,6 +66,11 @@ class StatusCog(commands.Cog):
 
             # AI情報
             from config import Config
+            from models.cancellation import (
+                REASON_DELETED, REASON_DISCONNECTED, REASON_EXPIRED, REASON_SUPERSEDED
+            )
+            from models.fair_queue import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+            engine_stats = engine_registry.get_stats()
             embed.add_field(
                 name="🧠 AI情報",
                 value=(
@@ -88,14 +82,170 @@ class StatusCog(commands.Cog):
                 ),
                 inline=True
             )
+
+            # エンジン情報（プロセス共有モデルのロード状況）
+            embed.add_field(
+                name="🔧 エンジン情報",
+                value=(
+                    f"**状態**: {self._format_engine_state(engine_stats['state'])}\n"
+                    f"**ロード回数**: {engine_stats['load_count']}\n"
+                    f"**ロード時間**: {engine_stats['load_time']:.2f}秒\n"
+                    f"**モデル分メモリ**: {engine_stats['model_rss_mb']:.1f}MB\n"
+                    f"**プロセスRSS**: {engine_stats['rss_mb']:.1f}MB"
+                ),
+                inline=True
+            )
+
+            # バッチ生成情報
+            generation_stats = engine_stats['generation']
+            if generation_stats and 'remote' in generation_stats:
+                # 推論サーバー使用時はサーバーごとの状況
+                embed.add_field(
+                    name="🌐 推論サーバー",
+                    value="\n".join(
+                        f"{'🟢' if server['healthy'] else '🔴'} `{server['url']}` "
+                        f"処理中 {server['in_flight']} / 計 {server['requests']}件 / "
+                        f"エラー {server['errors']} / 平均 {server['avg_latency_ms']:.0f}ms"
+                        for server in generation_stats['remote']
+                    ) + f"\n**ダミー応答へのフォールバック**: {generation_stats['fallback_count']}件",
+                    inline=False
+                )
+            elif generation_stats:
+                batching = generation_stats['batching']
+                embed.add_field(
+                    name="⚡ バッチ生成",
+                    value=(
+                        f"**推論精度**: {generation_stats['precision']}{self._format_precision_size(generation_stats['precision_report'])}\n"
+                        f"**生成速度**: {generation_stats['tokens_per_second']:.1f} tokens/秒\n"
+                        f"**文末打ち切りで節約**: {generation_stats['tokens_saved']} tokens\n"
+                        f"**応答候補**: {generation_stats['candidates']['num_candidates']}件/回 "
+                        f"(採用率 {generation_stats['candidates']['acceptance_rate'] * 100:.0f}%, "
+                        f"救済 {generation_stats['candidates']['rescued']}件, "
+                        f"追加コスト {generation_stats['candidates']['extra_token_ratio'] * 100:.0f}%)\n"
+                        f"**プロンプト**: 履歴 平均{generation_stats['prompt']['avg_turns']:.1f}ターン "
+                        f"({generation_stats['prompt']['avg_context_tokens']:.0f}/{generation_stats['prompt']['context_tokens']} tokens, "
+                        f"質問の切り詰め {generation_stats['prompt']['questions_truncated']}件)\n"
+                        f"**禁止パターン**: 生成中に回避 {generation_stats['pattern_filter']['interventions']}回 / "
+                        f"生成後に破棄 {generation_stats['pattern_filter']['pattern_rejections']}件 "
+                        f"({generation_stats['pattern_filter']['pattern_rejection_rate'] * 100:.1f}%)\n"
+                        f"**平均バッチサイズ**: {batching['avg_batch_size']:.2f} (最大 {batching['max_observed_batch']}/{batching['max_batch_size']})\n"
+                        f"**平均待機時間**: {batching['avg_wait_ms']:.1f}ms (窓 {batching['window_ms']:.0f}ms)\n"
+                        f"**キュー待ち**: {batching['queue_depth']}件 "
+                        f"(対話 {batching['queue_by_priority'].get(PRIORITY_INTERACTIVE, 0)} / "
+                        f"自動応答 {batching['queue_by_priority'].get(PRIORITY_BACKGROUND, 0)})\n"
+                        f"**推論ワーカー**: {batching['executor']['workers']} × {batching['executor']['threads_per_worker']}スレッド "
+                        f"(待ち {batching['executor']['queue_depth']}件, 稼働率 "
+                        f"{' / '.join(f'{rate * 100:.0f}%' for rate in batching['executor']['utilization'])})"
+                    ),
+                    inline=True
+                )
+
+                # 投機的デコーディング
+                speculative = generation_stats['speculative']
+                if speculative:
+                    embed.add_field(
+                        name="🏎️ 投機的デコーディング",
+                        value=(
+                            f"**状態**: {'🟢 有効' if speculative['enabled'] else '🔴 無効（' + speculative['disabled_reason'] + '）'}\n"
+                            f"**採用率**: {speculative['acceptance_rate'] * 100:.0f}% "
+                            f"({speculative['tokens_per_target_call']:.2f} tokens/検証)\n"
+                            f"**速度向上**: {speculative['speedup']:.2f}倍 "
+                            f"(先読み {speculative['speculative_runs']}回 / 比較用 {speculative['baseline_runs']}回)"
+                        ),
+                        inline=True
+                    )
+                
+                # 応答キャッシュ情報
+                cache = generation_stats['cache']
+                embed.add_field(
+                    name="🗃️ 応答キャッシュ",
+                    value=(
+                        f"**ヒット率**: {cache['hit_ratio'] * 100:.1f}% ({cache['hits']}件)\n"
+                        f"**ミス率**: {cache['miss_ratio'] * 100:.1f}% ({cache['misses']}件)\n"
+                        f"**バイパス**: {cache['bypassed']}件\n"
+                        f"**エントリ数**: {cache['entries']}/{cache['max_entries']}\n"
+                        f"**同時の同一リクエスト相乗り**: {generation_stats['single_flight']['merged']}件 "
+                        f"(別途生成 {generation_stats['single_flight']['resampled']}件)"
+                    ),
+                    inline=True
+                )
+                
+                # 会話プレフィックスのKVキャッシュ
+                prefix_cache = generation_stats['prefix_cache']
+                embed.add_field(
+                    name="🧩 プレフィックスKVキャッシュ",
+                    value=(
+                        f"**状態**: {'🟢 有効' if prefix_cache['enabled'] else '🔴 無効' + ('（' + prefix_cache['disabled_reason'] + '）' if prefix_cache['disabled_reason'] else '')}\n"
+                        f"**ヒット率**: {prefix_cache['hit_rate'] * 100:.1f}% ({prefix_cache['hits']}件, 不一致 {prefix_cache['stale']}件)\n"
+                        f"**節約**: {prefix_cache['saved_ms_per_request']:.1f}ms/件 "
+                        f"(計 {prefix_cache['time_saved']:.2f}秒, {prefix_cache['tokens_saved']} tokens)\n"
+                        f"**会話数**: {prefix_cache['entries']}件 ({prefix_cache['size_mb']:.1f}MB, 削除 {prefix_cache['evictions']}件)"
+                    ),
+                    inline=True
+                )
+                
+                # 取り消した生成
+                cancellation = generation_stats['cancellation']
+                embed.add_field(
+                    name="🛑 生成の取り消し",
+                    value=(
+                        f"**開始前に取り消し**: {cancellation['cancelled_queued']}件\n"
+                        f"**生成途中で停止**: {cancellation['cancelled_running']}件 "
+                        f"(節約 {cancellation['tokens_saved']} tokens)\n"
+                        f"**理由**: 削除 {cancellation['by_reason'].get(REASON_DELETED, 0)} / "
+                        f"期限切れ {cancellation['by_reason'].get(REASON_EXPIRED, 0)} / "
+                        f"置き換え {cancellation['by_reason'].get(REASON_SUPERSEDED, 0)} / "
+                        f"切断 {cancellation['by_reason'].get(REASON_DISCONNECTED, 0)}"
+                    ),
+                    inline=True
+                )
             
+            # 会話の要約
+            if Config.AI_SUMMARY_ENABLED:
+                from models.conversation_summarizer import conversation_summarizer
+                summarizer = conversation_summarizer.get_stats()
+                embed.add_field(
+                    name="📝 会話の要約",
+                    value=(
+                        f"**状態**: {'🟢 実行中' if summarizer['running'] else '⏸️ 停止中'}\n"
+                        f"**要約**: {summarizer['summaries']}件 ({summarizer['turns_summarized']}ターン, "
+                        f"簡易要約 {summarizer['fallbacks']}件)\n"
+                        f"**待ち**: {summarizer['pending']}件 (混雑で延期 {summarizer['skipped_busy']}回)"
+                    ),
+                    inline=True
+                )
+            
+            # 自動応答の負荷制御
+            from utils.admission_control import admission_controller
+            from utils.message_coalescer import message_coalescer
+            admission = admission_controller.get_stats()
+            coalescing = message_coalescer.get_stats()
+            embed.add_field(
+                name="🚦 自動応答の負荷制御",
+                value=(
+                    f"**処理待ち**: {admission['pending']}/{admission['max_pending']}\n"
+                    f"**破棄（混雑）**: {admission['shed']}件\n"
+                    f"**破棄（期限切れ）**: {admission['expired']}件\n"
+                    f"**短縮生成**: {admission['degraded_short']}件 / **テンプレート**: {admission['degraded_template']}件\n"
+                    f"**連投まとめ**: {coalescing['received']}件 → {coalescing['dispatched']}回生成 "
+                    f"(省略 {coalescing['generations_saved']}回, 重複破棄 {coalescing['duplicates']}件, 取り消し {coalescing['superseded']}件)"
+                ),
+                inline=True
+            )
+
             # サーバー統計
+            memory_cache = engine_registry.get_memory().get_cache_stats()
             embed.add_field(
                 name="🌐 サーバー統計",
                 value=(
                     f"**サーバー数**: {total_servers}\n"
-                    f"**会話履歴あり**: {total_conversations}ユーザー\n"
+                    f"**会話履歴あり**: {total_conversations}ユーザー{'' if data_stats['ready'] else '（集計中）'}\n"
                     f"**データ管理**: サーバー別分離"
+                    + (
+                        f"\n**会話キャッシュ**: ヒット率 {memory_cache['hit_rate'] * 100:.1f}% "
+                        f"({memory_cache['entries']}/{memory_cache['max_entries']}件, 未書き込み {memory_cache['dirty']}件)"
+                        if memory_cache else ""
+                    )
                 ),
                 inline=True
             )
@@ -140,6 +290,22 @@ class StatusCog(commands.Cog):
             )
             await interaction.followup.send(embed=error_embed)
 
+    def _format_engine_state(self, state):
+        """エンジンの準備状態の表示"""
+        return {
+            "idle": "⚪ 未ロード",
+            "loading": "🟡 ロード中",
+            "warming": "🟠 ウォームアップ中",
+            "ready": "🟢 準備完了",
+            "degraded": "🔴 ダミーモード"
+        }.get(state, state)
+
+    def _format_precision_size(self, report):
+        """精度モード適用時の重みサイズ表示"""
+        if not report or not report.get('size_mb'):
+            return ""
+        return f" (重み {report['fp32_size_mb']:.0f}MB → {report['size_mb']:.0f}MB)"
+
     def _get_uptime(self):
         """ボットの稼働時間を取得"""
         uptime = datetime.now() - self.start_time
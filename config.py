@@ -15,9 +15,84 @@ class Config:
     AI_MAX_TOKENS = int(os.getenv('AI_MAX_TOKENS', '50'))  # Apple Silicon最適化のため少し短めに
     AI_TEMPERATURE = float(os.getenv('AI_TEMPERATURE', '0.7'))  # 少し控えめに
     AI_USE_MPS = os.getenv('AI_USE_MPS', 'true').lower() == 'true'  # Apple Silicon MPS使用
+    AI_PRECISION = os.getenv('AI_PRECISION', 'fp32').lower()  # CPU推論精度: fp32 / bf16 / int8（動的量子化）
+    AI_PRECISION_MAX_LOSS_INCREASE = float(os.getenv('AI_PRECISION_MAX_LOSS_INCREASE', '0.15'))  # 許容する品質低下（fp32比）
+    AI_STOP_AT_SENTENCE = os.getenv('AI_STOP_AT_SENTENCE', 'true').lower() == 'true'  # 最初の文末（。！？）で生成を打ち切る
+    AI_MAX_RESPONSE_CHARS = int(os.getenv('AI_MAX_RESPONSE_CHARS', '100'))  # 応答の最大文字数（超えた時点で生成終了）
+    AI_PROMPT_MAX_TOKENS = int(os.getenv('AI_PROMPT_MAX_TOKENS', '400'))  # プロンプト全体のトークン数上限（質問と「回答:」は必ず残す）
+    AI_PROMPT_CONTEXT_TOKENS = int(os.getenv('AI_PROMPT_CONTEXT_TOKENS', '160'))  # 会話履歴に使うトークン数上限（新しいやり取りから入るだけ入れる）
+    AI_NUM_CANDIDATES = int(os.getenv('AI_NUM_CANDIDATES', '1'))  # 1回の生成で作る応答候補数（クリーニング後に最良のものを採用、途中表示は最初の候補のみ）
+    AI_DECODE_PATTERN_FILTER = os.getenv('AI_DECODE_PATTERN_FILTER', 'true').lower() == 'true'  # 禁止パターン（http, blog など）を生成中に出させない
+    
+    # 投機的デコーディング設定（同じトークナイザーの小さなモデルで先読み）
+    AI_DRAFT_MODEL_NAME = os.getenv('AI_DRAFT_MODEL_NAME', '')  # ドラフトモデル（例: rinna/japanese-gpt2-small、空の場合は無効）
+    AI_SPECULATIVE_MIN_ACCEPTANCE = float(os.getenv('AI_SPECULATIVE_MIN_ACCEPTANCE', '0.3'))  # これを下回る採用率なら通常のデコードに戻す
+    AI_SPECULATIVE_BASELINE_RATE = float(os.getenv('AI_SPECULATIVE_BASELINE_RATE', '0.1'))  # 速度比較のため通常のデコードで生成する割合
+    
+    # 会話要約設定（古いターンをバックグラウンドで要約し、プロンプトでは要約を使う）
+    AI_SUMMARY_ENABLED = os.getenv('AI_SUMMARY_ENABLED', 'false').lower() == 'true'
+    AI_SUMMARY_INTERVAL = float(os.getenv('AI_SUMMARY_INTERVAL', '60'))  # 要約を実行する間隔（秒）
+    AI_SUMMARY_KEEP_TURNS = int(os.getenv('AI_SUMMARY_KEEP_TURNS', '4'))  # 要約せずにそのまま使う最新のターン数
+    AI_SUMMARY_MIN_TURNS = int(os.getenv('AI_SUMMARY_MIN_TURNS', '6'))  # 要約されていない古いターンがこの件数溜まったら要約
+    AI_SUMMARY_MAX_CHARS = int(os.getenv('AI_SUMMARY_MAX_CHARS', '200'))  # 要約の最大文字数
+    AI_SUMMARY_MAX_TOKENS = int(os.getenv('AI_SUMMARY_MAX_TOKENS', '60'))  # 要約の生成トークン上限
+    
+    # バッチ生成設定
+    AI_BATCH_MAX_SIZE = int(os.getenv('AI_BATCH_MAX_SIZE', '4'))  # 1回のgenerateでまとめる最大プロンプト数
+    AI_BATCH_WINDOW_MS = float(os.getenv('AI_BATCH_WINDOW_MS', '30'))  # 後続リクエストを待つ時間（ミリ秒）
+    
+    # 推論エグゼキューター設定
+    AI_INFERENCE_WORKERS = int(os.getenv('AI_INFERENCE_WORKERS', '1'))  # 同時にgenerateを実行するワーカー数
+    AI_THREADS_PER_WORKER = int(os.getenv('AI_THREADS_PER_WORKER', '0'))  # ワーカーごとのtorch演算スレッド数（0でCPU数を等分）
+    AI_PIN_CPUS = os.getenv('AI_PIN_CPUS', 'false').lower() == 'true'  # ワーカーをCPUコアに固定（Linuxのみ）
+    
+    # サーバー別の公平スケジューリング設定
+    AI_GUILD_TOKENS_PER_MINUTE = int(os.getenv('AI_GUILD_TOKENS_PER_MINUTE', '0'))  # サーバーごとの1分あたり生成トークン上限（0で無制限）
+    AI_GUILD_WEIGHTS = os.getenv('AI_GUILD_WEIGHTS', '')  # サーバーごとの重み（例: 123456789:2,987654321:0.5）
+    
+    # 応答キャッシュ設定
+    AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', 'true').lower() == 'true'
+    AI_CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', '512'))  # 保持する最大件数（LRUで削除）
+    AI_CACHE_TTL = float(os.getenv('AI_CACHE_TTL', '600'))  # エントリの有効期間（秒）
+    AI_CACHE_PER_GUILD = os.getenv('AI_CACHE_PER_GUILD', 'true').lower() == 'true'  # サーバーごとにキャッシュを分ける
+    AI_CACHE_BYPASS_RATE = float(os.getenv('AI_CACHE_BYPASS_RATE', '0.1'))  # キャッシュを使わず生成し直す確率
+    AI_SINGLE_FLIGHT_RESAMPLE_RATE = float(os.getenv('AI_SINGLE_FLIGHT_RESAMPLE_RATE', '0'))  # 同時に届いた同一プロンプトで相乗りせず別途生成する確率
+    
+    # プレフィックスKVキャッシュ設定（会話の「前回: …」部分のエンコード結果を次のターンで再利用）
+    AI_PREFIX_CACHE_ENABLED = os.getenv('AI_PREFIX_CACHE_ENABLED', 'true').lower() == 'true'
+    AI_PREFIX_CACHE_MAX_ENTRIES = int(os.getenv('AI_PREFIX_CACHE_MAX_ENTRIES', '64'))  # 保持する最大会話数（LRUで削除）
+    AI_PREFIX_CACHE_MAX_MB = float(os.getenv('AI_PREFIX_CACHE_MAX_MB', '256'))  # 保持するpast_key_valuesの合計サイズ上限（MB）
+    
+    # ストリーミング応答設定
+    AI_STREAMING = os.getenv('AI_STREAMING', 'true').lower() == 'true'  # 生成途中でメッセージを表示・編集
+    AI_STREAM_CHUNK_CHARS = int(os.getenv('AI_STREAM_CHUNK_CHARS', '12'))  # 文の区切りがなくても途中表示する文字数
+    STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.2'))  # メッセージ編集の最小間隔（秒、Discordのレート制限対策）
+    
+    # 自動応答の負荷制御設定
+    AUTO_RESPONSE_MAX_PENDING = int(os.getenv('AUTO_RESPONSE_MAX_PENDING', '16'))  # 処理待ちの上限（超えたら破棄）
+    AUTO_RESPONSE_DEADLINE = float(os.getenv('AUTO_RESPONSE_DEADLINE', '30'))  # 生成開始までの期限（秒）
+    AUTO_RESPONSE_SHORT_THRESHOLD = int(os.getenv('AUTO_RESPONSE_SHORT_THRESHOLD', '6'))  # 生成を短縮する処理待ち件数
+    AUTO_RESPONSE_TEMPLATE_THRESHOLD = int(os.getenv('AUTO_RESPONSE_TEMPLATE_THRESHOLD', '12'))  # テンプレート応答にする処理待ち件数
+    AUTO_RESPONSE_SHORT_MAX_TOKENS = int(os.getenv('AUTO_RESPONSE_SHORT_MAX_TOKENS', '20'))  # 短縮時の生成トークン上限
+    
+    # 自動応答の連投まとめ設定
+    AUTO_RESPONSE_DEBOUNCE = float(os.getenv('AUTO_RESPONSE_DEBOUNCE', '1.5'))  # 最後のメッセージから応答を始めるまでの待機時間（秒、0でまとめない）
+    AUTO_RESPONSE_MAX_BURST = int(os.getenv('AUTO_RESPONSE_MAX_BURST', '5'))  # 1回の応答にまとめる最大メッセージ数
+    AUTO_RESPONSE_DUPLICATE_WINDOW = float(os.getenv('AUTO_RESPONSE_DUPLICATE_WINDOW', '60'))  # 同じ内容の連投を破棄する時間（秒）
+    
+    # 推論サーバー設定（カンマ区切り、例: http://127.0.0.1:8765,unix:/tmp/discord_bot_ai.sock）
+    INFERENCE_SERVER_URLS = os.getenv('INFERENCE_SERVER_URLS', '')  # 空の場合はボットのプロセス内でモデルを実行
+    INFERENCE_SERVER_TOKEN = os.getenv('INFERENCE_SERVER_TOKEN', '')  # サーバーとボットで共有する認証トークン
+    INFERENCE_TIMEOUT = float(os.getenv('INFERENCE_TIMEOUT', '120'))  # 1リクエストのタイムアウト（秒）
     
     # データベース設定
     DATABASE_PATH = os.getenv('DATABASE_PATH', 'data/bot.db')
+    MEMORY_BACKEND = os.getenv('MEMORY_BACKEND', 'json').lower()  # 会話履歴の保存先: json（ファイル）/ sqlite（DATABASE_PATH）/ segment（追記専用セグメント）
+    MEMORY_RETENTION_TURNS = int(os.getenv('MEMORY_RETENTION_TURNS', '2000'))  # segment使用時に1会話あたりに保持するターン数
+    MEMORY_COMPACT_INTERVAL = float(os.getenv('MEMORY_COMPACT_INTERVAL', '300'))  # segment使用時にセグメントをまとめ直す間隔（秒）
+    MEMORY_CACHE_MAX_ENTRIES = int(os.getenv('MEMORY_CACHE_MAX_ENTRIES', '1024'))  # メモリ上に保持する会話数（0でキャッシュ無効）
+    MEMORY_FLUSH_INTERVAL = float(os.getenv('MEMORY_FLUSH_INTERVAL', '5.0'))  # 会話履歴の変更をまとめて書き込む間隔（秒）
+    MEMORY_IO_WORKERS = int(os.getenv('MEMORY_IO_WORKERS', '4'))  # 会話履歴のファイル入出力を行うスレッド数
     
     # ログ設定
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
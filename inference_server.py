@@ -0,0 +1,169 @@
+"""
+推論サーバー - LocalAIを別プロセスで動かすスタンドアロンワーカー
+
+Discordボットのプロセスから生成処理を切り離し、GILやCPUをゲートウェイと奪い合わないようにする。
+複数起動してボット側の INFERENCE_SERVER_URLS に列挙すると、リクエストが振り分けられる
+
+使い方:
+    python inference_server.py --host 127.0.0.1 --port 8765
+    python inference_server.py --unix /tmp/discord_bot_ai.sock
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from aiohttp import web
+
+from config import Config
+from models.batch_scheduler import DeadlineExceeded
+from models.cancellation import REASON_DISCONNECTED, CancellationToken, GenerationCancelled
+from models.engine_registry import engine_registry
+from models.fair_queue import PRIORITY_INTERACTIVE
+
+
+def check_auth(request: web.Request) -> bool:
+    """共有トークンの確認（未設定の場合は認証なし）"""
+    if not Config.INFERENCE_SERVER_TOKEN:
+        return True
+    return request.headers.get("Authorization") == f"Bearer {Config.INFERENCE_SERVER_TOKEN}"
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    """状態確認"""
+    ai = engine_registry.get_ready_ai()
+    return web.json_response({
+        "state": engine_registry.state,
+        "use_real_model": ai.use_real_model if ai else False,
+        "stats": ai.get_generation_stats() if ai else None
+    })
+
+
+async def handle_generate(request: web.Request) -> web.StreamResponse:
+    """応答生成（stream指定時はNDJSONで途中経過を返す）"""
+    if not check_auth(request):
+        return web.json_response({"error": "unauthorized"}, status=401)
+
+    # 準備中はクライアントに別サーバーを使わせる
+    ai = engine_registry.get_ready_ai()
+    if ai is None:
+        return web.json_response({"error": engine_registry.state}, status=503)
+
+    data = await request.json()
+    message = data.get("message", "")
+    context = data.get("context") or []
+    guild_id = data.get("guild_id")
+    # クライアントが切断したら「切断」として取り消す（置き換えと区別して集計するため）
+    cancel_token = CancellationToken()
+    options = {
+        "cancel_token": cancel_token,
+        "guild_id": guild_id,
+        "max_new_tokens": data.get("max_new_tokens"),
+        "priority": data.get("priority", PRIORITY_INTERACTIVE),
+        "deadline": time.monotonic() + data["deadline_in"] if data.get("deadline_in") is not None else None
+    }
+
+    if not data.get("stream"):
+        task = asyncio.create_task(ai.generate_response(message, context, **options))
+        try:
+            # 切断時のキャンセルが先に生成へ届かないよう、理由を付けてから止める
+            response = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            _cancel_disconnected(task, cancel_token)
+            raise
+        except Exception as e:
+            error, status = _error_body(e)
+            return web.json_response(error, status=status)
+        return web.json_response({"response": response})
+
+    stream = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await stream.prepare(request)
+
+    partials: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(
+        ai.generate_response(message, context, on_partial=partials.put_nowait, **options)
+    )
+
+    # 生成完了まで途中経過を転送（クライアントが切断したら生成を取り消す）
+    try:
+        while True:
+            getter = asyncio.ensure_future(partials.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                break
+            await _write_line(stream, {"partial": getter.result()})
+    except (asyncio.CancelledError, ConnectionResetError):
+        _cancel_disconnected(task, cancel_token)
+        raise
+
+    # 生成の失敗も最終行で返す（途中で切るとクライアントが正常なサーバーを除外して生成をやり直す）
+    if task.exception() is not None:
+        error, _ = _error_body(task.exception())
+        await _write_line(stream, error)
+    else:
+        await _write_line(stream, {"response": task.result()})
+    await stream.write_eof()
+    return stream
+
+
+def _error_body(error: Exception) -> tuple:
+    """生成の失敗をクライアントに返す (内容, ステータス)"""
+    if isinstance(error, DeadlineExceeded):
+        return {"error": "deadline exceeded"}, 504
+    if isinstance(error, GenerationCancelled):
+        return {"error": "cancelled", "reason": error.args[0] if error.args else None}, 409
+    print(f"生成エラー: {error}")
+    return {"error": "generation failed", "detail": str(error)}, 500
+
+
+def _cancel_disconnected(task: asyncio.Task, cancel_token: CancellationToken):
+    """クライアントの切断による生成の取り消し"""
+    cancel_token.cancel(REASON_DISCONNECTED)
+    task.cancel()
+
+
+async def _write_line(stream: web.StreamResponse, data: dict):
+    """NDJSONの1行を書き込む"""
+    await stream.write((json.dumps(data, ensure_ascii=False) + "\n").encode('utf-8'))
+
+
+async def on_startup(app: web.Application):
+    """起動時にモデルのロードとウォームアップを開始"""
+    engine_registry.start_background_load()
+
+
+def create_app() -> web.Application:
+    """アプリケーションの作成"""
+    app = web.Application()
+    app.router.add_get("/health", handle_health)
+    app.router.add_post("/generate", handle_generate)
+    app.on_startup.append(on_startup)
+    return app
+
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description="AI Discord Bot 推論サーバー")
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けホスト")
+    parser.add_argument("--port", type=int, default=8765, help="待ち受けポート")
+    parser.add_argument("--unix", help="Unixソケットのパス（指定時はTCPの代わりに使用）")
+    args = parser.parse_args()
+
+    # OpenMP競合回避の環境変数設定
+    os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+
+    # サーバー自身は必ずローカルでモデルを動かす
+    engine_registry.remote_urls = []
+
+    print("🚀 推論サーバーを起動中...")
+    if args.unix:
+        web.run_app(create_app(), path=args.unix)
+    else:
+        web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,10 @@ import discord
 from discord.ext import commands
 
 from config import Config
+from models.cancellation import CancellationToken, GenerationCancelled, cancellation_registry
+from utils.admission_control import admission_controller, MODE_TEMPLATE
+from utils.message_coalescer import MessageBurst, message_coalescer
+from utils.streaming_reply import StreamingReply
 
 
 class DiscordBot(commands.Bot):
@@ -23,6 +27,9 @@ class DiscordBot(commands.Bot):
         intents = discord.Intents.default()
         intents.message_content = True
         super().__init__(command_prefix='/', intents=intents)
+        
+        # モデル準備中に案内を送ったチャンネル（準備中の連投を防ぐ）
+        self._warming_notified_channels = set()
 
     async def setup_hook(self):
         """ボット起動時のセットアップ処理"""
@@ -30,7 +37,7 @@ class DiscordBot(commands.Bot):
             print("コマンドを登録中...")
             
             # 各Cogを個別にインポートして登録
-            from commands import ai_chat, help, status, memory, admin, auto_response
+            from commands import ai_chat, help, status, memory, admin, auto_response, pattern_filter
 
             cogs = [
                 (ai_chat.AIChatCog, "AI chat"),
@@ -38,7 +45,8 @@ class DiscordBot(commands.Bot):
                 (status.StatusCog, "Status"),
                 (memory.MemoryCog, "Memory"),
                 (admin.AdminCog, "Admin"),
-                (auto_response.AutoResponseCog, "Auto Response")
+                (auto_response.AutoResponseCog, "Auto Response"),
+                (pattern_filter.PatternFilterCog, "Pattern Filter")
             ]
             
             for cog_class, name in cogs:
@@ -98,8 +106,24 @@ class DiscordBot(commands.Bot):
                 print(f"  - {guild.name} (ID: {guild.id})")
 
         await self.change_presence(activity=discord.Game(name="/help でヘルプ"))
+        
+        # 接続後にバックグラウンドでAIモデルをロード・ウォームアップ
+        from models.engine_registry import engine_registry
+        engine_registry.start_background_load()
+        
+        # 長くなった会話履歴をバックグラウンドで要約
+        if Config.AI_SUMMARY_ENABLED:
+            from models.conversation_summarizer import conversation_summarizer
+            conversation_summarizer.start(engine_registry.get_memory(), engine_registry.get_ready_ai)
+        
         await self._display_available_commands()
 
+    async def close(self):
+        """終了処理（未書き込みの会話履歴を書き込んでから切断）"""
+        from models.engine_registry import engine_registry
+        await engine_registry.get_memory().flush_async()
+        await super().close()
+
     async def on_message(self, message):
         """メッセージイベントハンドラー（自動応答用）"""
         # ボット自身のメッセージは無視
@@ -123,42 +147,126 @@ class DiscordBot(commands.Bot):
         if len(message.content) > 500:
             return
         
+        # 連投は待機時間内にまとめて1回だけ応答（同じ内容の連投は破棄）
+        message_coalescer.submit(message, self._process_auto_response)
+
+    async def on_message_delete(self, message):
+        """メッセージ削除時に、そのメッセージへの自動応答を取り消す"""
+        if message.author.bot:
+            return
+        message_coalescer.discard_message(message)
+        cancellation_registry.cancel_message(message.id)
+
+    async def _process_auto_response(self, burst: MessageBurst):
+        """自動応答の処理（まとめたメッセージ群に1回応答）"""
         try:
-            # AIによる自動応答
-            await self._process_auto_response(message)
+            await self._respond_to_burst(burst)
         except Exception as e:
             print(f"自動応答エラー: {e}")
 
-    async def _process_auto_response(self, message):
-        """自動応答の処理"""
+    async def _respond_to_burst(self, burst: MessageBurst):
+        """受付制御を通して自動応答を生成"""
+        from models.engine_registry import engine_registry
+        
+        message = burst.last_message
+        
+        # 共有のAIとメモリマネージャーを取得（モデルはプロセスで1回だけロード）
+        ai = engine_registry.get_ready_ai()
+        if ai is None:
+            await self._notify_warming_up(message)
+            return
+        self._warming_notified_channels.clear()
+        
+        # 処理待ちが上限を超えていれば破棄（混雑度に応じて生成を短縮）
+        ticket = admission_controller.admit()
+        if ticket is None:
+            return
+        
+        # 元のメッセージが削除されたら生成を途中で止める
+        cancel_token = CancellationToken()
+        for burst_message in burst.messages:
+            cancellation_registry.register(burst_message.id, cancel_token)
+        try:
+            await self._generate_auto_response(burst, ai, ticket, cancel_token)
+        finally:
+            admission_controller.release(ticket)
+            for burst_message in burst.messages:
+                cancellation_registry.unregister(burst_message.id, cancel_token)
+
+    async def _generate_auto_response(self, burst: MessageBurst, ai, ticket, cancel_token: CancellationToken):
+        """受付済みの自動応答の生成と送信"""
+        from models.batch_scheduler import DeadlineExceeded
+        from models.engine_registry import engine_registry
+        from models.fair_queue import PRIORITY_BACKGROUND
         from models.local_ai import LocalAI
-        from models.memory_manager import MemoryManager
         import time
         
-        # AIとメモリマネージャーの初期化
-        ai = LocalAI()
-        memory = MemoryManager()
+        memory = engine_registry.get_memory()
+        message = burst.last_message
+        content = burst.content
         
         # 会話履歴を取得（サーバー別）
         user_id = str(message.author.id)
         guild_id = str(message.guild.id) if message.guild else None
-        context = memory.get_context(user_id, guild_id)
+        context = await memory.get_prompt_context_async(user_id, guild_id)
+        
+        # 生成途中の応答を返信として先に投稿し、段階的に編集（ストリーミング）
+        stream = None
+        if Config.AI_STREAMING and ai.use_real_model and ticket.mode != MODE_TEMPLATE:
+            stream = StreamingReply(
+                send=lambda embed: message.reply(embed=embed, mention_author=False),
+                build_embed=self._build_partial_embed
+            )
         
         # typing表示
         async with message.channel.typing():
-            # AI応答生成
+            # AI応答生成（混雑時はテンプレート応答）
             start_time = time.time()
-            response = await ai.generate_response(message.content, context)
+            if ticket.mode == MODE_TEMPLATE:
+                response = LocalAI.generate_template_response(content, context)
+            else:
+                try:
+                    response = await ai.generate_response(
+                        content, context,
+                        on_partial=stream.update if stream else None,
+                        guild_id=guild_id,
+                        max_new_tokens=ticket.max_new_tokens,
+                        deadline=ticket.deadline,
+                        priority=PRIORITY_BACKGROUND,
+                        cancel_token=cancel_token,
+                        user_id=user_id
+                    )
+                except DeadlineExceeded:
+                    # 期限までに生成が始まらなかった応答は手遅れなので送らない
+                    admission_controller.record_expired()
+                    if stream:
+                        await stream.discard()
+                    return
+                except GenerationCancelled:
+                    # 元のメッセージが削除された応答は送らない
+                    if stream:
+                        await stream.discard()
+                    return
+                except asyncio.CancelledError:
+                    # 続きのメッセージが届いた場合は途中表示を消してまとめ直す
+                    if stream:
+                        await stream.discard()
+                    raise
             generation_time = time.time() - start_time
         
         # 応答が有効かチェック
         if not response or len(response.strip()) < 3:
+            if stream:
+                await stream.discard()
             return  # 無効な応答の場合は送信しない
         
+        # ここから先は新しいメッセージが届いても取り消さない
+        burst.committed = True
+        
         # 会話履歴を保存（サーバー別、自動応答として）
-        memory.add_conversation(
+        await memory.add_conversation_async(
             user_id=user_id,
-            user_message=message.content,
+            user_message=content,
             ai_response=response,
             guild_id=guild_id,
             channel_id=str(message.channel.id),
@@ -166,7 +274,7 @@ class DiscordBot(commands.Bot):
         )
         
         # 学習データの更新
-        await ai.update_learning_data(user_id, message.content, response)
+        await ai.update_learning_data(user_id, content, response)
         
         # 応答を送信
         embed = discord.Embed(
@@ -178,8 +286,32 @@ class DiscordBot(commands.Bot):
             icon_url=message.author.display_avatar.url
         )
         
+        if stream:
+            await stream.finish(embed, response)
+        else:
+            await message.reply(embed=embed, mention_author=False)
+
+    async def _notify_warming_up(self, message):
+        """モデル準備中であることをチャンネルごとに1回だけ案内"""
+        if message.channel.id in self._warming_notified_channels:
+            return
+        self._warming_notified_channels.add(message.channel.id)
+        
+        embed = discord.Embed(
+            description="⏳ AIモデルを準備中です。準備ができ次第、自動応答を再開します。",
+            color=discord.Color.orange()
+        )
         await message.reply(embed=embed, mention_author=False)
 
+    def _build_partial_embed(self, text):
+        """生成途中の自動応答用Embed"""
+        embed = discord.Embed(
+            description=text,
+            color=discord.Color.from_rgb(135, 206, 235)  # スカイブルー
+        )
+        embed.set_footer(text="✍️ 生成中... | 自動応答")
+        return embed
+
     async def _display_available_commands(self):
         """利用可能なコマンドの表示"""
         print("\n📝 利用可能なコマンドを確認中...")
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+会話履歴の移行スクリプト
+JSONファイル（data/conversations/memories/）の会話履歴をSQLite（DATABASE_PATH）または
+追記専用セグメント（data/conversations/segments/）に取り込みます。
+取り込み済みの会話は飛ばすため、繰り返し実行しても重複しません。
+"""
+
+import argparse
+import os
+import time
+
+from config import Config
+from models.data_stats import stats_path
+from models.memory_storage import (
+    BACKEND_SEGMENT, BACKEND_SQLITE, JsonMemoryStorage, SegmentMemoryStorage, SQLiteMemoryStorage
+)
+
+
+def migrate_memories(memory_path: str, backend: str, db_path: str, segment_path: str, batch_size: int):
+    """JSONの会話履歴をSQLiteまたはセグメントに取り込む"""
+    print("🗄️ 会話履歴の移行ツール")
+    print("=" * 50)
+    print(f"移行元: {memory_path}")
+    print(f"移行先: {db_path if backend == BACKEND_SQLITE else segment_path}")
+
+    start_time = time.time()
+    source = JsonMemoryStorage(memory_path)
+    if backend == BACKEND_SQLITE:
+        target = SQLiteMemoryStorage(db_path)
+    else:
+        target = SegmentMemoryStorage(segment_path, retention=Config.MEMORY_RETENTION_TURNS)
+    try:
+        if backend == BACKEND_SQLITE:
+            imported, turns, skipped = target.import_records(source.iter_records(), batch_size=batch_size)
+        else:
+            imported, turns, skipped = target.import_records(source.iter_records())
+    finally:
+        target.close()
+
+    # 移行先のカウンターは次回の起動時に数え直す
+    if imported and os.path.exists(stats_path(backend)):
+        os.remove(stats_path(backend))
+
+    print(f"\n✅ {imported}件の会話（{turns}ターン）を取り込みました（{time.time() - start_time:.2f}秒）")
+    if skipped:
+        print(f"ℹ️ 取り込み済みの{skipped}件は飛ばしました")
+    print(f"\n💡 .envに MEMORY_BACKEND={backend} を設定すると移行した会話履歴を使用します")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="会話履歴をJSONファイルからSQLiteまたはセグメントに移行")
+    parser.add_argument("--source", default="data/conversations/memories/", help="移行元のディレクトリ")
+    parser.add_argument("--backend", choices=[BACKEND_SQLITE, BACKEND_SEGMENT], default=BACKEND_SQLITE, help="移行先の形式")
+    parser.add_argument("--database", default=Config.DATABASE_PATH, help="移行先のデータベース（sqlite）")
+    parser.add_argument("--segments", default="data/conversations/segments/", help="移行先のディレクトリ（segment）")
+    parser.add_argument("--batch-size", type=int, default=500, help="1回の挿入にまとめるターン数")
+    args = parser.parse_args()
+
+    try:
+        migrate_memories(args.source, args.backend, args.database, args.segments, args.batch_size)
+    except KeyboardInterrupt:
+        print("\n\n👋 中断されました。")
+    except Exception as e:
+        print(f"\n❌ エラー: {e}")
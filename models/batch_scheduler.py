@@ -0,0 +1,181 @@
+"""
+バッチスケジューラー - 生成リクエストの動的マイクロバッチ化
+
+短い待機ウィンドウ内に届いたリクエストをまとめ、1回のバッチ生成で処理する。
+待機中のリクエストは優先度クラスとサーバー別の公平キューで順番を決める
+"""
+
+import asyncio
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from models.cancellation import GenerationCancelled, cancellation_registry
+from models.fair_queue import FairQueue, GuildUsage, PRIORITY_INTERACTIVE
+from models.inference_executor import InferenceExecutor
+
+
+class DeadlineExceeded(Exception):
+    """生成開始前にリクエストの期限が切れた"""
+
+
+class BatchScheduler:
+    """動的マイクロバッチスケジューラー"""
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 4,
+        window_ms: float = 30.0,
+        executor: Optional[InferenceExecutor] = None,
+        usage: Optional[GuildUsage] = None,
+        guild_weights: Optional[Dict[str, float]] = None
+    ):
+        """
+        初期化
+
+        run_batch: リクエストのリストを受け取り、同じ順序で結果のリストを返す同期関数
+        max_batch_size: 1バッチの最大リクエスト数
+        window_ms: 最初のリクエストから追加リクエストを待つ時間（ミリ秒）
+        executor: バッチを実行する推論エグゼキューター（ワーカー数まで同時にバッチを実行）
+        usage: サーバー別の使用量（1分あたりの上限判定に使用）
+        guild_weights: サーバーごとの公平キューの重み
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.window_ms = max(0.0, window_ms)
+        self.executor = executor or InferenceExecutor()
+        self.usage = usage
+        self.guild_weights = guild_weights or {}
+
+        # 空いているワーカー数（ワーカーが埋まっている間はキューにためて次のバッチを大きくする）
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._running_tasks = set()
+
+        self._queue: Optional[FairQueue] = None
+        self._worker_task: Optional[asyncio.Task] = None
+
+        # メトリクス
+        self.total_batches = 0
+        self.total_requests = 0
+        self.max_observed_batch = 0
+        self.total_wait_time = 0.0
+        self.total_batch_time = 0.0
+        self.expired_requests = 0
+
+    async def submit(self, request: Any) -> Any:
+        """リクエストを投入し、バッチ処理の結果を待つ"""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(
+            (request, future, time.monotonic()),
+            priority=getattr(request, 'priority', PRIORITY_INTERACTIVE),
+            guild_id=getattr(request, 'guild_id', None),
+            cost=getattr(request, 'estimated_tokens', 1.0)
+        )
+        return await future
+
+    def _ensure_worker(self):
+        """ワーカータスクを起動（未起動または停止済みの場合）"""
+        if self._queue is None:
+            self._queue = FairQueue(self.usage, self.guild_weights)
+            self._slots = asyncio.Semaphore(self.executor.workers)
+        if self._worker_task is None or self._worker_task.done():
+            self._worker_task = asyncio.create_task(self._worker())
+
+    async def _worker(self):
+        """キューからバッチを組み立てて実行するループ"""
+        while True:
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.window_ms / 1000
+
+            # ウィンドウ内に届いたリクエストを最大サイズまで集める
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # 待機中にキャンセル・期限切れ・取り消しになったリクエストは除外
+            batch = [
+                entry for entry in batch
+                if not self._cancel_if_moot(entry) and not entry[1].done() and not self._expire_if_late(entry)
+            ]
+            if not batch:
+                self._slots.release()
+                continue
+
+            task = asyncio.create_task(self._run(batch))
+            self._running_tasks.add(task)
+            task.add_done_callback(self._on_batch_done)
+
+    def _expire_if_late(self, entry: Tuple[Any, asyncio.Future, float]) -> bool:
+        """期限切れのリクエストに例外を設定（期限切れならTrue）"""
+        request, future, _ = entry
+        deadline = getattr(request, 'deadline', None)
+        if deadline is None or time.monotonic() < deadline:
+            return False
+        self.expired_requests += 1
+        future.set_exception(DeadlineExceeded())
+        return True
+
+    def _cancel_if_moot(self, entry: Tuple[Any, asyncio.Future, float]) -> bool:
+        """取り消し済みのリクエストに例外を設定（取り消し済みならTrue）"""
+        request, future, _ = entry
+        token = getattr(request, 'cancel_token', None)
+        if token is None or not token.cancelled:
+            return False
+        cancellation_registry.record_queued(token)
+        if not future.done():
+            future.set_exception(GenerationCancelled(token.reason))
+        return True
+
+    def _on_batch_done(self, task: asyncio.Task):
+        """バッチ完了時にワーカーの枠を返す"""
+        self._running_tasks.discard(task)
+        self._slots.release()
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future, float]]):
+        """バッチを実行して各呼び出し元に結果を返す"""
+        start_time = time.monotonic()
+        self.total_batches += 1
+        self.total_requests += len(batch)
+        self.max_observed_batch = max(self.max_observed_batch, len(batch))
+        self.total_wait_time += sum(start_time - queued_at for _, _, queued_at in batch)
+
+        try:
+            results = await self.executor.run(self.run_batch, [request for request, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.total_batch_time += time.monotonic() - start_time
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def get_stats(self) -> Dict:
+        """スケジューラーのメトリクスを取得"""
+        batches = max(1, self.total_batches)
+        requests = max(1, self.total_requests)
+        return {
+            "max_batch_size": self.max_batch_size,
+            "window_ms": self.window_ms,
+            "total_batches": self.total_batches,
+            "total_requests": self.total_requests,
+            "avg_batch_size": self.total_requests / batches,
+            "max_observed_batch": self.max_observed_batch,
+            "avg_wait_ms": self.total_wait_time / requests * 1000,
+            "avg_batch_time_ms": self.total_batch_time / batches * 1000,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "queue_by_priority": self._queue.qsize_by_priority() if self._queue else {},
+            "running_batches": len(self._running_tasks),
+            "expired_requests": self.expired_requests,
+            "executor": self.executor.get_stats()
+        }
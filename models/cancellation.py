@@ -0,0 +1,155 @@
+"""
+生成の取り消し - 不要になった生成を途中で止めるためのトークン
+
+元のメッセージが削除された・インタラクションの期限が切れた・新しいメッセージで
+置き換えられた場合に取り消しを通知し、生成ループが1ステップごとに確認する
+"""
+
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+# 取り消し理由
+REASON_DELETED = "deleted"          # 元のメッセージが削除された
+REASON_EXPIRED = "expired"          # インタラクションの応答期限が切れた
+REASON_SUPERSEDED = "superseded"    # 新しいメッセージで置き換えられた
+REASON_DISCONNECTED = "disconnected"  # 推論サーバーへのクライアントの接続が切れた
+
+
+class GenerationCancelled(Exception):
+    """生成が取り消された"""
+
+
+class CancellationToken:
+    """スレッドをまたいで共有する取り消しフラグ"""
+
+    def __init__(self, expires_at: Optional[float] = None):
+        """
+        初期化
+
+        expires_at: この時刻（time.monotonic）を過ぎたら自動的に取り消し扱い
+        """
+        self.expires_at = expires_at
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        """取り消されているかチェック（期限切れを含む）"""
+        if not self._event.is_set() and self.expires_at is not None and time.monotonic() >= self.expires_at:
+            self.cancel(REASON_EXPIRED)
+        return self._event.is_set()
+
+    def cancel(self, reason: str):
+        """取り消しを通知（2回目以降は無視）"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        """取り消し時に呼ぶ関数を登録（取り消し済みなら即座に呼ぶ）"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+class CancellationGroup:
+    """複数の呼び出し元で共有する生成の取り消しフラグ（全員が取り消したときだけ取り消し扱い）"""
+
+    def __init__(self):
+        self._members: List[CancellationToken] = []
+        self._lock = threading.Lock()
+
+    def add(self, token: CancellationToken):
+        """共有する呼び出し元のトークンを追加"""
+        with self._lock:
+            self._members.append(token)
+
+    @property
+    def cancelled(self) -> bool:
+        """全員が取り消しているかチェック"""
+        with self._lock:
+            members = list(self._members)
+        return bool(members) and all(token.cancelled for token in members)
+
+    @property
+    def reason(self) -> Optional[str]:
+        """最後のメンバーの取り消し理由"""
+        with self._lock:
+            return self._members[-1].reason if self._members else None
+
+
+class CancellationRegistry:
+    """DiscordのメッセージIDと取り消しトークンの対応、および取り消しの統計"""
+
+    def __init__(self):
+        self._tokens: Dict[int, List[CancellationToken]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+        # 統計
+        self.cancelled_by_reason: Dict[str, int] = defaultdict(int)
+        self.cancelled_queued = 0
+        self.cancelled_running = 0
+        self.tokens_saved = 0
+
+    def register(self, message_id: int, token: CancellationToken):
+        """メッセージに取り消しトークンを関連付ける"""
+        with self._lock:
+            self._tokens[message_id].append(token)
+
+    def unregister(self, message_id: int, token: CancellationToken):
+        """関連付けを解除（応答完了時に呼ぶ）"""
+        with self._lock:
+            tokens = self._tokens.get(message_id)
+            if not tokens:
+                return
+            if token in tokens:
+                tokens.remove(token)
+            if not tokens:
+                del self._tokens[message_id]
+
+    def cancel_message(self, message_id: int, reason: str = REASON_DELETED) -> int:
+        """メッセージに関連する生成をすべて取り消す（取り消した件数を返す）"""
+        with self._lock:
+            tokens = self._tokens.pop(message_id, [])
+        for token in tokens:
+            token.cancel(reason)
+        return len(tokens)
+
+    def record_queued(self, token: CancellationToken):
+        """生成開始前に取り消したリクエストを記録"""
+        with self._lock:
+            self.cancelled_queued += 1
+            self.cancelled_by_reason[token.reason or REASON_SUPERSEDED] += 1
+
+    def record_running(self, token: CancellationToken, tokens_saved: int):
+        """生成途中で止めたリクエストを記録（tokens_savedは生成せずに済んだトークン数）"""
+        with self._lock:
+            self.cancelled_running += 1
+            self.tokens_saved += tokens_saved
+            self.cancelled_by_reason[token.reason or REASON_SUPERSEDED] += 1
+
+    def get_stats(self) -> Dict:
+        """取り消しの統計を取得"""
+        with self._lock:
+            return {
+                "cancelled_queued": self.cancelled_queued,
+                "cancelled_running": self.cancelled_running,
+                "tokens_saved": self.tokens_saved,
+                "by_reason": dict(self.cancelled_by_reason),
+                "watched_messages": len(self._tokens)
+            }
+
+
+# グローバルインスタンス
+cancellation_registry = CancellationRegistry()
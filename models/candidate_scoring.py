@@ -0,0 +1,75 @@
+"""
+候補の採点 - 1回の生成で得た複数の応答候補から最良のものを選ぶ
+
+_clean_responseで破棄されなかった候補を、文として完結しているか・長さ・
+日本語の割合・同じ文字の繰り返し・質問のオウム返しで軽く採点する
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+# 日本語の文字（ひらがな・カタカナ・漢字・全角記号）
+JAPANESE_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\u3000-\u303f\uff01-\uff60]')
+
+# 応答として自然な長さ（文字数）
+PREFERRED_MIN_CHARS = 8
+PREFERRED_MAX_CHARS = 60
+
+
+def score_candidate(raw_text: str, cleaned: str, message: str) -> float:
+    """
+    クリーニング済みの候補を採点（高いほど良い）
+
+    raw_text: クリーニング前の生成テキスト
+    cleaned: _clean_response後のテキスト（空でないこと）
+    message: ユーザーのメッセージ
+    """
+    score = 0.0
+
+    # 生成が途中で切れずに文末記号で終わっている
+    if re.search(r'[。！？]', raw_text):
+        score += 1.0
+
+    # 短すぎず長すぎない
+    length = len(cleaned)
+    if PREFERRED_MIN_CHARS <= length <= PREFERRED_MAX_CHARS:
+        score += 1.0
+    elif length < PREFERRED_MIN_CHARS:
+        score -= 0.5
+
+    # 日本語の割合
+    score += len(JAPANESE_PATTERN.findall(cleaned)) / length
+
+    # 同じ文字ばかりの応答（「ははははは」など）
+    if len(set(cleaned)) / length < 0.4:
+        score -= 1.0
+
+    # 質問をそのまま繰り返しているだけの応答
+    question = message.strip()
+    if question and (
+        cleaned.rstrip('。！？') == question.rstrip('。！？!?')
+        or (len(question) >= PREFERRED_MIN_CHARS and question in cleaned)
+    ):
+        score -= 1.0
+
+    return score
+
+
+def select_candidate(candidates: List[Tuple[str, str]], message: str) -> Tuple[Optional[int], int]:
+    """
+    候補から最良のものを選ぶ
+
+    candidates: (クリーニング前, クリーニング後) の組のリスト（後者が空の候補は破棄済み）
+    戻り値: (選んだ候補の番号（全候補が破棄された場合はNone）, 破棄されなかった候補数)
+    """
+    best_index = None
+    best_score = float('-inf')
+    accepted = 0
+    for index, (raw_text, cleaned) in enumerate(candidates):
+        if not cleaned:
+            continue
+        accepted += 1
+        score = score_candidate(raw_text, cleaned, message)
+        if score > best_score:
+            best_index, best_score = index, score
+    return best_index, accepted
@@ -0,0 +1,164 @@
+"""
+会話要約 - 長くなった会話履歴の古いターンを短い要約にまとめる
+
+会話履歴が変わった会話のうち、要約されていないターンが溜まったものを記録しておき、
+バックグラウンドで定期的に要約する（生成キューが空いている時のみ、自動応答と同じ低優先度）。
+要約は会話履歴の隣に保存され、プロンプトでは要約済みのターンの代わりに使われる
+"""
+
+import asyncio
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from config import Config
+
+
+def extractive_summary(previous_summary: Optional[str], turns: List[Dict], max_chars: int) -> str:
+    """モデルを使わない要約（ユーザーの発言の冒頭を話題として並べる）"""
+    topics = []
+    for turn in turns:
+        topic = turn.get('user', '').replace('\n', ' ').strip().split('。')[0][:20]
+        if topic and topic not in topics:
+            topics.append(topic)
+
+    text = "、".join(f"「{topic}」" for topic in topics)
+    if text:
+        text += "について話しました。"
+    if previous_summary:
+        text = previous_summary + text
+
+    # 長すぎる場合は新しい話題の側を残す
+    if len(text) > max_chars:
+        text = "…" + text[-(max_chars - 1):]
+    return text
+
+
+class ConversationSummarizer:
+    """会話履歴のバックグラウンド要約"""
+
+    def __init__(
+        self,
+        interval: float = 60.0,
+        keep_turns: int = 4,
+        min_turns: int = 6,
+        max_chars: int = 200
+    ):
+        """
+        初期化
+
+        interval: 要約を実行する間隔（秒）
+        keep_turns: 要約せずにそのまま残す最新のターン数
+        min_turns: 要約されていない古いターンがこの件数以上溜まったら要約する
+        max_chars: 要約の最大文字数
+        """
+        self.interval = interval
+        self.keep_turns = keep_turns
+        self.min_turns = min_turns
+        self.max_chars = max_chars
+
+        self.memory = None
+        self._get_ai: Optional[Callable] = None
+        self._pending: Set[Tuple[str, Optional[str]]] = set()
+        self._task: Optional[asyncio.Task] = None
+
+        # 統計
+        self.rounds = 0
+        self.summaries = 0
+        self.fallbacks = 0
+        self.turns_summarized = 0
+        self.skipped_busy = 0
+
+    def start(self, memory, get_ai: Callable) -> asyncio.Task:
+        """
+        バックグラウンドの要約を開始（多重起動しない）
+
+        memory: 要約を保存するMemoryManager
+        get_ai: 応答可能なAIを返す関数（準備中はNone）
+        """
+        if self._task is None:
+            self.memory = memory
+            self._get_ai = get_ai
+            memory.add_listener(self.on_history_changed)
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    def on_history_changed(self, user_id: str, guild_id: Optional[str], context: List[Dict]):
+        """会話履歴の変更通知（要約されていないターンが溜まった会話を記録）"""
+        turns = context[1:] if context and 'summary' in context[0] else context
+        if len(turns) - self.keep_turns >= self.min_turns:
+            self._pending.add((user_id, guild_id))
+
+    async def _run(self):
+        """一定間隔で溜まった会話を要約するループ"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.summarize_pending()
+            except Exception as e:
+                print(f"会話要約エラー: {e}")
+
+    async def summarize_pending(self):
+        """記録済みの会話を要約（生成待ちのリクエストがあれば次の回に回す）"""
+        self.rounds += 1
+        ai = self._get_ai()
+        if ai is None:
+            return
+
+        while self._pending:
+            if self._is_busy(ai):
+                self.skipped_busy += 1
+                return
+            user_id, guild_id = self._pending.pop()
+            await self._summarize(ai, user_id, guild_id)
+
+    @staticmethod
+    def _is_busy(ai) -> bool:
+        """応答生成の待ちがあるか（要約は空いている時だけ行う）"""
+        scheduler = getattr(ai, 'scheduler', None)
+        return scheduler is not None and scheduler.get_stats()['queue_depth'] > 0
+
+    async def _summarize(self, ai, user_id: str, guild_id: Optional[str]):
+        """1会話の古いターンを要約して保存"""
+        context = await self.memory.get_prompt_context_async(user_id, guild_id)
+        summary = context[0] if context and 'summary' in context[0] else None
+        turns = context[1:] if summary else context
+        old_turns = turns[:-self.keep_turns] if self.keep_turns > 0 else turns
+        if len(old_turns) < self.min_turns:
+            return
+
+        previous_summary = summary['summary'] if summary else None
+        text = ""
+        summarize_turns = getattr(ai, 'summarize_turns', None)
+        if summarize_turns is not None:
+            text = await summarize_turns(previous_summary, old_turns)
+        if not text:
+            # モデルで要約できない場合（推論サーバー使用時・生成失敗時）
+            text = extractive_summary(previous_summary, old_turns, self.max_chars)
+            self.fallbacks += 1
+
+        covered_turns = (summary.get('covered_turns', 0) if summary else 0) + len(old_turns)
+        if await self.memory.set_summary_async(
+            user_id, guild_id, text[:self.max_chars], old_turns[-1]['timestamp'], covered_turns
+        ):
+            self.summaries += 1
+            self.turns_summarized += len(old_turns)
+
+    def get_stats(self) -> Dict:
+        """要約の統計を取得"""
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "pending": len(self._pending),
+            "rounds": self.rounds,
+            "summaries": self.summaries,
+            "fallbacks": self.fallbacks,
+            "turns_summarized": self.turns_summarized,
+            "skipped_busy": self.skipped_busy
+        }
+
+
+# グローバルインスタンス
+conversation_summarizer = ConversationSummarizer(
+    interval=Config.AI_SUMMARY_INTERVAL,
+    keep_turns=Config.AI_SUMMARY_KEEP_TURNS,
+    min_turns=Config.AI_SUMMARY_MIN_TURNS,
+    max_chars=Config.AI_SUMMARY_MAX_CHARS
+)
@@ -0,0 +1,340 @@
+"""
+データ統計 - 会話履歴・学習データの件数とサイズのカウンター
+
+保存先のバックエンドが書き込みのたびに増減を記録し、/status・/admin stats・サーバー統計は
+カウンターを返すだけにする（データ量によらず一定時間）。カウンターは変更からsave_interval秒後に
+小さなJSONにまとめて保存し、ファイルがない場合（初回・保存先の切り替え後）と前回正常に
+終了しなかった場合だけバックグラウンドで1回全体を数え直す
+"""
+
+import atexit
+import json
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from config import Config
+
+# カウンターの保存先（会話履歴の保存先ごと）
+STATS_DIR = "data/stats"
+
+# DMの会話を数えるキー
+DM_KEY = ""
+
+
+def stats_path(backend: str) -> str:
+    """会話履歴の保存先に対応するカウンターのファイル"""
+    return os.path.join(STATS_DIR, f"{backend}.json")
+
+
+def conversation_key(guild_id: Optional[str], user_id: str) -> Tuple[str, str]:
+    """再集計中に読み終えたかを判定する会話のキー"""
+    return (str(guild_id) if guild_id else DM_KEY, str(user_id))
+
+
+class DataStats:
+    """会話履歴・学習データのカウンター"""
+
+    def __init__(self, path: str, save_interval: float = 10.0):
+        """
+        初期化
+
+        path: カウンターの保存先
+        save_interval: 変更からこの秒数後に保存（その間の変更はまとめて保存）
+        """
+        self.path = path
+        self.save_interval = save_interval
+
+        # サーバーID（DMは空文字）→ {"users": 会話履歴のあるユーザー数, "conversations": 保持しているターン数}
+        self._guilds: Dict[str, Dict[str, int]] = {}
+        self._bytes = 0
+        self._training_rows = 0
+        self._training_bytes = 0
+
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._save_timer: Optional[threading.Timer] = None
+        self._rebuild_thread: Optional[threading.Thread] = None
+        # 再集計中の変更（再集計の結果に後から足す）
+        self._rebuilding = False
+        self._pending_guilds: Dict[str, Dict[str, int]] = {}
+        self._pending_bytes = 0
+        # 再集計で読み終えた会話（以降の変更は結果に含まれないため足す）と、
+        # まだ読んでいない会話のうち変更があったもの（読み込みに含まれるため足さない）
+        self._scanned = set()
+        self._touched = set()
+
+        self.ready = self._load()
+        self._started = False
+        self._storage = None
+
+    def _load(self) -> bool:
+        """保存済みのカウンターを読み込み（ない場合・壊れている場合・前回正常に終了しなかった場合はFalse）"""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if not data.get('clean'):
+                print("⚠️ 前回正常に終了しなかったため、データ統計を再集計します")
+                return False
+            self._guilds = data['guilds']
+            self._bytes = data['bytes']
+            self._training_rows = data['training_rows']
+            self._training_bytes = data['training_bytes']
+            return True
+        except Exception as e:
+            print(f"⚠️ データ統計を読み込めません（再集計します）: {e}")
+            return False
+
+    def start_rebuild(self, storage):
+        """
+        カウンターを使い始め、ない場合はバックグラウンドで全体を数え直す（多重起動しない）
+
+        storage: 会話履歴の保存先（scan_stats で全体を、scan_conversation で1会話を数え直す）
+        """
+        with self._lock:
+            if not self._started:
+                self._started = True
+                self._storage = storage
+                # 終了時に未保存のカウンターを正常終了の印を付けて保存
+                atexit.register(self.close)
+                # 実行中の印（異常終了した場合は次回起動時に再集計する）
+                self._dirty = True
+            if self.ready or self._rebuild_thread is not None:
+                rebuild = False
+            else:
+                rebuild = True
+                self._rebuilding = True
+                self._rebuild_thread = threading.Thread(
+                    target=self._rebuild, args=(storage,), name="data-stats-rebuild", daemon=True
+                )
+        if not rebuild:
+            self.save()
+            return
+        print("📊 データ統計を再集計中...")
+        self._rebuild_thread.start()
+
+    def _rebuild(self, storage):
+        """全体を数え直し、数え直し中の変更を足してカウンターにする"""
+        try:
+            guilds, nbytes = storage.scan_stats()
+            training_rows, training_bytes = self._scan_training_data()
+            while True:
+                # 一覧の取得後に作られた・削除された会話は読まれていないため、1件ずつ読み直す
+                with self._lock:
+                    touched = list(self._touched)
+                    if not touched:
+                        self._finish_rebuild(guilds, nbytes, training_rows, training_bytes)
+                        break
+                for guild_key, user_id in touched:
+                    users, conversations, size = storage.scan_conversation(user_id, guild_key or None)
+                    counts = guilds.setdefault(guild_key, {"users": 0, "conversations": 0})
+                    counts["users"] += users
+                    counts["conversations"] += conversations
+                    nbytes += size
+        except Exception as e:
+            print(f"データ統計の再集計エラー: {e}")
+            with self._lock:
+                self._reset_rebuild()
+                self._rebuild_thread = None
+            return
+
+        self.save()
+        print(f"✅ データ統計を再集計しました（{sum(counts['users'] for counts in guilds.values())}ユーザー）")
+
+    def _finish_rebuild(self, guilds: Dict[str, Dict[str, int]], nbytes: int, training_rows: int, training_bytes: int):
+        """数え直した結果に数え直し中の変更を足してカウンターにする（ロック取得済みで呼ぶ）"""
+        for guild_key, pending in self._pending_guilds.items():
+            counts = guilds.setdefault(guild_key, {"users": 0, "conversations": 0})
+            counts["users"] += pending["users"]
+            counts["conversations"] += pending["conversations"]
+        self._guilds = guilds
+        self._bytes = nbytes + self._pending_bytes
+        # 学習データは件数を毎回上書きするため、再集計中に記録された値があればそちらを使う
+        if not self._training_rows:
+            self._training_rows = training_rows
+            self._training_bytes = training_bytes
+        self._reset_rebuild()
+        self.ready = True
+        self._dirty = True
+
+    def _reset_rebuild(self):
+        """再集計中の状態を破棄（ロック取得済みで呼ぶ）"""
+        self._pending_guilds = {}
+        self._pending_bytes = 0
+        self._scanned = set()
+        self._touched = set()
+        self._rebuilding = False
+
+    def mark_scanned(self, guild_id: Optional[str], user_id: str):
+        """
+        再集計で会話を読んだことを記録
+
+        保存先はその会話への書き込みと同じロックを取得したまま呼ぶ（読み込みと変更の前後を確定させる）
+        """
+        with self._lock:
+            if self._rebuilding:
+                key = conversation_key(guild_id, user_id)
+                self._scanned.add(key)
+                self._touched.discard(key)
+
+    def scan_snapshot(self):
+        """
+        全体を一度に読む保存先が、読み込み時点で呼ぶ（それまでの変更は読み込み結果に含まれる）
+
+        保存先は書き込みと同じロックを取得したまま呼ぶ
+        """
+        with self._lock:
+            if self._rebuilding:
+                self._pending_guilds = {}
+                self._pending_bytes = 0
+
+    def _pending_target(self, guild_id: Optional[str], user_id: Optional[str]) -> bool:
+        """
+        再集計中の変更を結果に足すかどうか（ロック取得済みで呼ぶ）
+
+        会話を指定した変更は、再集計でその会話を読み終えた後のものだけ足す
+        （読む前の変更は読み込み結果に含まれる）
+        """
+        if user_id is None:
+            return True
+        key = conversation_key(guild_id, user_id)
+        if key in self._scanned:
+            return True
+        self._touched.add(key)
+        return False
+
+    @staticmethod
+    def _scan_training_data() -> tuple:
+        """学習データの件数とバイト数"""
+        from models.training_data import TRAINING_DATA_PATH
+        if not os.path.exists(TRAINING_DATA_PATH):
+            return 0, 0
+        with open(TRAINING_DATA_PATH, 'r', encoding='utf-8') as f:
+            return len(json.load(f)), os.path.getsize(TRAINING_DATA_PATH)
+
+    def record_change(
+        self,
+        guild_id: Optional[str],
+        users: int = 0,
+        conversations: int = 0,
+        user_id: Optional[str] = None
+    ):
+        """
+        会話履歴のユーザー数・ターン数の増減を記録
+
+        user_id: 変更した会話（会話ごとに読む保存先が指定、再集計中の変更の二重計上を防ぐ）
+        """
+        if not users and not conversations:
+            return
+        with self._lock:
+            if self._rebuilding:
+                if not self._pending_target(guild_id, user_id):
+                    return
+                guilds = self._pending_guilds
+            else:
+                guilds = self._guilds
+            counts = guilds.setdefault(guild_id or DM_KEY, {"users": 0, "conversations": 0})
+            counts["users"] += users
+            counts["conversations"] += conversations
+            self._schedule_save()
+
+    def record_bytes(self, delta: int, guild_id: Optional[str] = None, user_id: Optional[str] = None):
+        """会話履歴のディスク使用量の増減を記録（user_idはrecord_changeと同じ）"""
+        if not delta:
+            return
+        with self._lock:
+            if self._rebuilding:
+                if not self._pending_target(guild_id, user_id):
+                    return
+                self._pending_bytes += delta
+            else:
+                self._bytes += delta
+            self._schedule_save()
+
+    def set_training_data(self, rows: int, nbytes: int):
+        """学習データの件数とバイト数を記録（保存のたびに上書き）"""
+        with self._lock:
+            self._training_rows = rows
+            self._training_bytes = nbytes
+            self._schedule_save()
+
+    def _schedule_save(self):
+        """保存を予約（ロック取得済みで呼ぶ）"""
+        self._dirty = True
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_interval, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def save(self, clean: bool = False):
+        """
+        カウンターを保存（一時ファイルに書いてから置き換え、変更がない時・再集計中は保存しない）
+
+        clean: 正常終了の印（終了時のみTrue、それ以外の保存では次回起動時に再集計させる）
+        """
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not (self.ready and (self._dirty or clean)):
+                return
+            self._dirty = False
+            data = {
+                "guilds": {guild_key: dict(counts) for guild_key, counts in self._guilds.items()},
+                "bytes": self._bytes,
+                "training_rows": self._training_rows,
+                "training_bytes": self._training_bytes,
+                "clean": clean
+            }
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"データ統計の保存エラー: {e}")
+
+    def close(self):
+        """終了時の保存（保存先の未書き込みの変更を書き込んでから、正常終了の印を付ける）"""
+        if self._storage is not None:
+            try:
+                self._storage.flush()
+            except Exception as e:
+                print(f"会話履歴の書き込みエラー: {e}")
+        self.save(clean=True)
+
+    def get_guild(self, guild_id: Optional[str]) -> Dict:
+        """サーバーの会話履歴の統計"""
+        with self._lock:
+            counts = self._guilds.get(guild_id or DM_KEY, {"users": 0, "conversations": 0})
+            return {
+                "total_users": counts["users"],
+                "total_conversations": counts["conversations"]
+            }
+
+    def get_stats(self) -> Dict:
+        """全体の統計を取得"""
+        with self._lock:
+            users = sum(counts["users"] for counts in self._guilds.values())
+            conversations = sum(counts["conversations"] for counts in self._guilds.values())
+            return {
+                "ready": self.ready,
+                "servers": sum(
+                    1 for guild_key, counts in self._guilds.items()
+                    if guild_key != DM_KEY and counts["users"] > 0
+                ),
+                "users": users,
+                "conversations": conversations,
+                # ユーザーとAIの発言
+                "messages": conversations * 2,
+                "bytes": self._bytes,
+                "training_rows": self._training_rows,
+                "training_bytes": self._training_bytes
+            }
+
+
+# グローバルインスタンス
+data_stats = DataStats(stats_path(Config.MEMORY_BACKEND))
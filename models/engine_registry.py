@@ -0,0 +1,192 @@
+"""
+エンジンレジストリ - プロセス共有のAIエンジン管理
+
+LocalAIとMemoryManagerをプロセス内で1つだけ生成し、
+/chat・自動応答など全ての呼び出し元で共有する。
+ボット接続後にワーカースレッドでモデルをロード・ウォームアップし、準備状態を公開する
+"""
+
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional, Union
+
+from config import Config
+from models.local_ai import LocalAI
+from models.memory_manager import MemoryManager
+
+# psutilのインポートを安全に行う
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+# エンジンの準備状態
+STATE_IDLE = "idle"          # ロード未開始
+STATE_LOADING = "loading"    # モデルロード中
+STATE_WARMING = "warming"    # ウォームアップ生成中
+STATE_READY = "ready"        # 実モデルで応答可能
+STATE_DEGRADED = "degraded"  # ロード失敗（ダミーモードで応答）
+
+
+class EngineRegistry:
+    """プロセス共有エンジンのレジストリ"""
+
+    def __init__(self):
+        """初期化（モデルはstart_background_loadまたは最初の取得時にロード）"""
+        self._ai: Optional[Union[LocalAI, "RemoteAI"]] = None
+        self._memory: Optional[MemoryManager] = None
+        self._lock = threading.Lock()
+        self._memory_lock = threading.Lock()
+        self._load_task: Optional[asyncio.Task] = None
+
+        # 推論サーバーのURL（設定されていればモデルをこのプロセスでロードしない）
+        self.remote_urls = [url.strip() for url in Config.INFERENCE_SERVER_URLS.split(',') if url.strip()]
+
+        # 準備状態
+        self.state = STATE_IDLE
+        self.warmup_time = 0.0
+
+        # ロード統計
+        self.load_count = 0
+        self.load_time = 0.0
+        self.loaded_at: Optional[datetime] = None
+        self.rss_before_load_mb = 0.0
+        self.rss_after_load_mb = 0.0
+
+    def get_ai(self) -> Union[LocalAI, "RemoteAI"]:
+        """
+        共有LocalAIを取得（未ロードなら同期的にロード、スクリプト用）
+
+        バックグラウンドのロードを開始済みの場合、準備状態はウォームアップ後に_background_loadが変更する
+        """
+        if self._ensure_ai() and self._load_task is None:
+            self.state = STATE_READY if self._ai.use_real_model else STATE_DEGRADED
+        return self._ai
+
+    def _ensure_ai(self) -> bool:
+        """未ロードならロード（この呼び出しでロードした場合True、準備状態は変更しない）"""
+        if self._ai is None:
+            with self._lock:
+                if self._ai is None:
+                    self._ai = self._load_ai()
+                    return True
+        return False
+
+    def get_ready_ai(self) -> Optional[Union[LocalAI, "RemoteAI"]]:
+        """応答可能なLocalAIを取得（ロード・ウォームアップ中はNone）"""
+        if self.state in (STATE_READY, STATE_DEGRADED):
+            return self._ai
+        return None
+
+    def is_ready(self) -> bool:
+        """応答可能な状態かチェック"""
+        return self.get_ready_ai() is not None
+
+    def start_background_load(self) -> asyncio.Task:
+        """バックグラウンドでのロードとウォームアップを開始（多重起動しない）"""
+        if self._load_task is None:
+            self._load_task = asyncio.create_task(self._background_load())
+        return self._load_task
+
+    async def _background_load(self):
+        """ワーカースレッドでモデルをロードし、ウォームアップ生成を行う"""
+        try:
+            if self._ai is None:
+                self.state = STATE_LOADING
+                await asyncio.to_thread(self._ensure_ai)
+
+            if not self._ai.use_real_model:
+                self.state = STATE_DEGRADED
+                return
+
+            self.state = STATE_WARMING
+            # LocalAIは推論ワーカー上でウォームアップ（ワーカーごとの初期化も済ませる）
+            executor = getattr(self._ai, 'executor', None)
+            if executor is not None:
+                self.warmup_time = await executor.run(self._ai.warm_up)
+            else:
+                self.warmup_time = await asyncio.to_thread(self._ai.warm_up)
+            self.state = STATE_READY
+            print(f"🔥 ウォームアップ完了（{self.warmup_time:.2f}秒）")
+
+        except Exception as e:
+            print(f"❌ エンジン準備エラー: {e}")
+            self.state = STATE_DEGRADED if self._ai is not None else STATE_IDLE
+            if self._ai is None:
+                # 次回の呼び出しで再試行できるようにする
+                self._load_task = None
+
+    def get_memory(self) -> MemoryManager:
+        """共有MemoryManagerを取得"""
+        if self._memory is None:
+            with self._memory_lock:
+                if self._memory is None:
+                    self._memory = MemoryManager()
+        return self._memory
+
+    def is_loaded(self) -> bool:
+        """モデルがロード済みかチェック"""
+        return self._ai is not None
+
+    def _load_ai(self) -> Union[LocalAI, "RemoteAI"]:
+        """LocalAI（推論サーバー設定時はRemoteAI）を生成してロード統計を記録"""
+        self.rss_before_load_mb = self._get_rss_mb()
+        start_time = time.time()
+
+        if self.remote_urls:
+            from models.inference_client import RemoteAI
+            print(f"🌐 推論サーバーを使用します: {', '.join(self.remote_urls)}")
+            ai = RemoteAI(
+                self.remote_urls,
+                token=Config.INFERENCE_SERVER_TOKEN,
+                timeout=Config.INFERENCE_TIMEOUT
+            )
+        else:
+            ai = LocalAI()
+            memory = self.get_memory()
+            # 会話履歴が変わったら次のターンのプレフィックスを先にエンコード
+            memory.add_listener(ai.on_history_changed)
+            # 保存時に各ターンのトークン数を記録（プロンプト構築で数え直さない）
+            if ai.use_real_model:
+                memory.set_token_counter(ai.prompt_builder.name, ai.prompt_builder.count_turn)
+
+        self.load_time = time.time() - start_time
+        self.load_count += 1
+        self.loaded_at = datetime.now()
+        self.rss_after_load_mb = self._get_rss_mb()
+
+        print(f"🧠 AIエンジンをロードしました（{self.load_count}回目, {self.load_time:.2f}秒, "
+              f"RSS {self.rss_after_load_mb:.1f}MB）")
+        return ai
+
+    def _get_rss_mb(self) -> float:
+        """現在のプロセスの常駐メモリ（MB）を取得"""
+        if not PSUTIL_AVAILABLE:
+            return 0.0
+        try:
+            return psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
+        except Exception:
+            return 0.0
+
+    def get_stats(self) -> Dict:
+        """ロード統計を取得"""
+        return {
+            "loaded": self.is_loaded(),
+            "state": self.state,
+            "warmup_time": self.warmup_time,
+            "load_count": self.load_count,
+            "load_time": self.load_time,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "rss_mb": self._get_rss_mb(),
+            "model_rss_mb": max(0.0, self.rss_after_load_mb - self.rss_before_load_mb),
+            "use_real_model": self._ai.use_real_model if self._ai else False,
+            "generation": self._ai.get_generation_stats() if self._ai else None
+        }
+
+
+# グローバルインスタンス
+engine_registry = EngineRegistry()
@@ -0,0 +1,163 @@
+"""
+公平キュー - 優先度クラスとサーバー別の重み付き公平キューイング
+
+/chat（対話）を自動応答より優先し、同じ優先度の中ではサーバーごとに
+Start-time Fair Queueing で順番を決める。1分あたりのトークン上限を超えたサーバーは
+上限内のサーバーの処理が終わるまで後回しにする
+"""
+
+import asyncio
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from config import Config
+
+# 優先度クラス（小さいほど優先）
+PRIORITY_INTERACTIVE = 0  # /chat など応答を待っているユーザー
+PRIORITY_BACKGROUND = 1   # 自動応答
+
+# DMなどサーバーに属さないリクエストのキー
+NO_GUILD = "dm"
+
+
+class GuildUsage:
+    """サーバー別の使用量集計と1分あたりのトークン上限"""
+
+    def __init__(self, tokens_per_minute: int = 0):
+        """
+        初期化
+
+        tokens_per_minute: サーバーごとの1分あたり生成トークン上限（0で無制限）
+        """
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._window: Dict[str, Deque[Tuple[float, int]]] = defaultdict(deque)
+        self._totals: Dict[str, Dict[str, int]] = defaultdict(lambda: {"requests": 0, "tokens": 0})
+
+    def record(self, guild_id: Optional[str], tokens: int):
+        """1リクエスト分の使用量を記録（生成スレッドからも呼ばれる）"""
+        key = guild_id or NO_GUILD
+        with self._lock:
+            self._window[key].append((time.monotonic(), tokens))
+            self._totals[key]["requests"] += 1
+            self._totals[key]["tokens"] += tokens
+
+    def _recent_tokens(self, key: str) -> int:
+        """直近1分間のトークン数（ロック取得済みで呼ぶ）"""
+        window = self._window[key]
+        cutoff = time.monotonic() - 60
+        while window and window[0][0] < cutoff:
+            window.popleft()
+        return sum(tokens for _, tokens in window)
+
+    def is_over_quota(self, guild_id: Optional[str]) -> bool:
+        """1分あたりの上限を超えているかチェック"""
+        if self.tokens_per_minute <= 0:
+            return False
+        with self._lock:
+            return self._recent_tokens(guild_id or NO_GUILD) >= self.tokens_per_minute
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """サーバー別の使用量を取得"""
+        with self._lock:
+            return {
+                key: {
+                    "requests": totals["requests"],
+                    "tokens": totals["tokens"],
+                    "tokens_last_minute": self._recent_tokens(key),
+                    "quota": self.tokens_per_minute
+                }
+                for key, totals in self._totals.items()
+            }
+
+
+class FairQueue:
+    """優先度クラス + サーバー別重み付き公平キュー（asyncio.Queue互換のput/get）"""
+
+    def __init__(self, usage: Optional[GuildUsage] = None, weights: Optional[Dict[str, float]] = None):
+        """
+        初期化
+
+        usage: 上限判定に使うサーバー別使用量
+        weights: サーバーごとの重み（大きいほど多く処理される、未指定は1.0）
+        """
+        self.usage = usage
+        self.weights = weights or {}
+
+        # 優先度 → サーバー → (開始タグ, 終了タグ, 要素) の列
+        self._classes: Dict[int, Dict[str, Deque[Tuple[float, float, Any]]]] = defaultdict(lambda: defaultdict(deque))
+        self._virtual_time: Dict[int, float] = defaultdict(float)
+        self._last_finish: Dict[Tuple[int, str], float] = defaultdict(float)
+        self._size = 0
+        self._not_empty = asyncio.Event()
+
+    def put_nowait(self, item: Any, priority: int = PRIORITY_INTERACTIVE, guild_id: Optional[str] = None, cost: float = 1.0):
+        """要素を追加（costは推定生成トークン数）"""
+        key = guild_id or NO_GUILD
+        weight = self.weights.get(key, 1.0)
+
+        start = max(self._virtual_time[priority], self._last_finish[(priority, key)])
+        finish = start + cost / weight
+        self._last_finish[(priority, key)] = finish
+
+        self._classes[priority][key].append((start, finish, item))
+        self._size += 1
+        self._not_empty.set()
+
+    async def get(self) -> Any:
+        """次に処理する要素を取り出す（空なら待つ）"""
+        while self._size == 0:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self._pop()
+
+    def _pop(self) -> Any:
+        """最優先クラスの中で開始タグが最小の要素を取り出す（上限超過サーバーは後回し）"""
+        for priority in sorted(self._classes):
+            guilds = {key: queue for key, queue in self._classes[priority].items() if queue}
+            if not guilds:
+                continue
+
+            candidates = guilds
+            if self.usage is not None:
+                within_quota = {key: queue for key, queue in guilds.items() if not self.usage.is_over_quota(key)}
+                candidates = within_quota or guilds
+
+            key = min(candidates, key=lambda guild: candidates[guild][0][0])
+            start, _, item = candidates[key].popleft()
+            self._virtual_time[priority] = start
+            self._size -= 1
+            return item
+
+        raise IndexError("空のキューから取り出そうとしました")
+
+    def qsize(self) -> int:
+        """キュー内の要素数"""
+        return self._size
+
+    def qsize_by_priority(self) -> Dict[int, int]:
+        """優先度クラスごとの要素数"""
+        return {
+            priority: sum(len(queue) for queue in guilds.values())
+            for priority, guilds in self._classes.items()
+        }
+
+
+def parse_guild_weights(value: str) -> Dict[str, float]:
+    """「サーバーID:重み」のカンマ区切り設定を解析"""
+    weights = {}
+    for entry in value.split(','):
+        if ':' not in entry:
+            continue
+        guild_id, weight = entry.split(':', 1)
+        try:
+            weights[guild_id.strip()] = float(weight)
+        except ValueError:
+            print(f"⚠️ サーバーの重み設定が無効です: {entry}")
+    return weights
+
+
+# グローバルインスタンス
+guild_usage = GuildUsage(tokens_per_minute=Config.AI_GUILD_TOKENS_PER_MINUTE)
@@ -0,0 +1,168 @@
+"""
+生成制御 - 文末・文字数上限・取り消しで生成を打ち切るStoppingCriteria / LogitsProcessor
+
+_clean_responseで切り捨てられる部分を生成しないよう、バッチの行ごとに
+最初の文末記号・文字数上限・行ごとのトークン上限に達した時点で終了トークンを強制する。
+取り消された行も次のステップで終了させる
+"""
+
+from typing import List, Optional, Sequence
+
+# PyTorchとTransformersのインポートを安全に行う
+try:
+    import torch
+    import transformers
+    from transformers import LogitsProcessor, StoppingCriteria
+    TORCH_AVAILABLE = True
+except ImportError:
+    LogitsProcessor = StoppingCriteria = object
+    TORCH_AVAILABLE = False
+
+# 生成を打ち切る文末記号
+STOP_TERMINATORS = ('。', '！', '？')
+
+
+def _per_row_stopping_supported() -> bool:
+    """StoppingCriteriaが行ごとの判定（BoolTensor）を返せるバージョンかチェック"""
+    try:
+        major, minor = (int(part) for part in transformers.__version__.split('.')[:2])
+        return (major, minor) >= (4, 39)
+    except Exception:
+        return False
+
+
+class SentenceBoundaryTracker:
+    """バッチ各行が文末・文字数上限に達したかを追跡"""
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_length: int,
+        batch_size: int,
+        max_chars: int = 100,
+        terminators: Sequence[str] = STOP_TERMINATORS,
+        row_max_new_tokens: Optional[List[int]] = None,
+        stop_at_sentence: bool = True,
+        cancel_tokens: Optional[List] = None,
+        row_terminators: Optional[List[Sequence[str]]] = None,
+        row_max_chars: Optional[List[Optional[int]]] = None
+    ):
+        """
+        初期化
+
+        prompt_length: 左詰めパディング後のプロンプト長（生成部分の開始位置）
+        batch_size: バッチの行数
+        max_chars: 1応答の最大文字数
+        row_max_new_tokens: 行ごとの生成トークン上限（負荷に応じて短くした行など）
+        stop_at_sentence: 文末記号・文字数上限で打ち切るか（Falseの場合は行ごとの上限のみ）
+        cancel_tokens: 行ごとの取り消しトークン（Noneの行は取り消しなし）
+        row_terminators: 行ごとの文末記号（Noneの場合は全行でterminators、空の行は文末で打ち切らない）
+        row_max_chars: 行ごとの最大文字数（Noneの場合は全行でmax_chars、Noneの行は文字数で打ち切らない）
+        """
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.max_chars = max_chars
+        self.terminators = tuple(terminators)
+        self.row_max_new_tokens = row_max_new_tokens
+        self.stop_at_sentence = stop_at_sentence
+        self.cancel_tokens = cancel_tokens or [None] * batch_size
+        # stop_at_sentence=Falseの場合、既定では文末・文字数のどちらでも打ち切らない
+        self.row_terminators = row_terminators or [self.terminators if stop_at_sentence else ()] * batch_size
+        self.row_max_chars = row_max_chars or [max_chars if stop_at_sentence else None] * batch_size
+
+        self.finished: List[bool] = [False] * batch_size
+        self.cancelled: List[bool] = [False] * batch_size
+        self.stop_steps: List[Optional[int]] = [None] * batch_size
+        self._last_length = -1
+
+    def update(self, input_ids):
+        """現在の系列から各行の終了状態を更新（同じ長さでは再計算しない）"""
+        length = input_ids.shape[1]
+        if length == self._last_length:
+            return
+        self._last_length = length
+        step = length - self.prompt_length
+        if step <= 0:
+            return
+
+        special_ids = {self.tokenizer.eos_token_id, self.tokenizer.pad_token_id}
+        for row, finished in enumerate(self.finished):
+            if finished:
+                continue
+
+            # 取り消された行（元のメッセージの削除・期限切れ・置き換え）
+            token = self.cancel_tokens[row]
+            if token is not None and token.cancelled:
+                self.cancelled[row] = True
+                self._finish(row, step)
+                continue
+
+            # 自然に終了トークンを出した行・行ごとの上限に達した行
+            if int(input_ids[row, -1]) in special_ids:
+                self._finish(row, step)
+                continue
+            if self.row_max_new_tokens and step >= self.row_max_new_tokens[row]:
+                self._finish(row, step)
+                continue
+
+            terminators = self.row_terminators[row]
+            max_chars = self.row_max_chars[row]
+            if not terminators and max_chars is None:
+                continue
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True).strip()
+            if any(terminator in text for terminator in terminators) or (
+                max_chars is not None and len(text) >= max_chars
+            ):
+                self._finish(row, step)
+
+    def _finish(self, row: int, step: int):
+        """行を終了済みにする"""
+        self.finished[row] = True
+        self.stop_steps[row] = step
+
+    def all_finished(self) -> bool:
+        """全行が終了したかチェック"""
+        return all(self.finished)
+
+    def tokens_saved(self, max_new_tokens: int) -> int:
+        """上限まで生成した場合と比べて省いた行ごとのトークン数の合計"""
+        return sum(self.row_tokens_saved(row, max_new_tokens) for row in range(len(self.stop_steps)))
+
+    def row_tokens_saved(self, row: int, max_new_tokens: int) -> int:
+        """1行について上限まで生成した場合と比べて省いたトークン数"""
+        step = self.stop_steps[row]
+        if step is None:
+            return 0
+        limit = self.row_max_new_tokens[row] if self.row_max_new_tokens else max_new_tokens
+        return max(0, limit - step)
+
+
+class SentenceEndLogitsProcessor(LogitsProcessor):
+    """終了済みの行に終了トークンを強制するLogitsProcessor"""
+
+    def __init__(self, tracker: SentenceBoundaryTracker):
+        self.tracker = tracker
+
+    def __call__(self, input_ids, scores):
+        self.tracker.update(input_ids)
+        eos_token_id = self.tracker.tokenizer.eos_token_id
+        for row, finished in enumerate(self.tracker.finished):
+            if finished:
+                # min_new_tokensによる終了トークン抑制より優先する
+                scores[row, :] = -float('inf')
+                scores[row, eos_token_id] = 0.0
+        return scores
+
+
+class SentenceStoppingCriteria(StoppingCriteria):
+    """文末・文字数上限で生成を止めるStoppingCriteria"""
+
+    def __init__(self, tracker: SentenceBoundaryTracker):
+        self.tracker = tracker
+        self.per_row = _per_row_stopping_supported()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.tracker.update(input_ids)
+        if self.per_row:
+            return torch.tensor(self.tracker.finished, dtype=torch.bool, device=input_ids.device)
+        return self.tracker.all_finished()
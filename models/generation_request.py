@@ -0,0 +1,62 @@
+"""
+生成リクエスト - スケジューラーとLocalAIの間で受け渡す1件分の生成要求
+"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from models.cancellation import CancellationToken
+from models.fair_queue import PRIORITY_INTERACTIVE
+
+
+class GenerationRequest:
+    """1件の応答生成リクエスト"""
+
+    def __init__(
+        self,
+        message: str,
+        context: List[Dict],
+        on_partial: Optional[Callable[[str], None]] = None,
+        guild_id: Optional[str] = None,
+        prompt: Optional[str] = None,
+        max_new_tokens: Optional[int] = None,
+        deadline: Optional[float] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        estimated_tokens: float = 1.0,
+        cancel_token: Optional[CancellationToken] = None,
+        conversation_key: Optional[Tuple[str, Optional[str]]] = None,
+        template_fallback: bool = True,
+        record_usage: bool = True,
+        summary: bool = False
+    ):
+        """
+        初期化
+
+        message: ユーザーのメッセージ
+        context: 会話履歴
+        on_partial: 生成途中のテキストを受け取るコールバック（ストリーミング用、生成スレッドから呼ばれる）
+        guild_id: リクエスト元のサーバーID（DMの場合はNone）
+        prompt: 構築済みのプロンプト（Noneの場合は生成時に構築）
+        max_new_tokens: このリクエストの生成トークン上限（Noneの場合は設定値）
+        deadline: この時刻（time.monotonic）までに生成が始まらなければ破棄
+        priority: 優先度クラス（PRIORITY_INTERACTIVE / PRIORITY_BACKGROUND）
+        estimated_tokens: 公平キューで使う推定生成トークン数
+        cancel_token: 取り消しトークン（取り消されたら生成を途中で止める）
+        conversation_key: 会話の (user_id, guild_id)（プレフィックスKVキャッシュのキー）
+        template_fallback: 生成エラー時にテンプレート応答を返す（Falseの場合はFALLBACK_RESPONSE）
+        record_usage: サーバー別の使用量に記録する（ウォームアップなどユーザーの要求でない生成はFalse）
+        summary: 会話要約の生成（文末で打ち切らず、応答のクリーニング・候補の選択・使用量の記録を行わない）
+        """
+        self.message = message
+        self.context = context
+        self.on_partial = on_partial
+        self.guild_id = guild_id
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.deadline = deadline
+        self.priority = priority
+        self.estimated_tokens = estimated_tokens
+        self.cancel_token = cancel_token
+        self.conversation_key = conversation_key
+        self.template_fallback = template_fallback
+        self.record_usage = record_usage and not summary
+        self.summary = summary
@@ -0,0 +1,280 @@
+"""
+推論クライアント - 別プロセスの推論サーバーを使うLocalAI互換クライアント
+
+複数の推論サーバー（localhost HTTP / Unixソケット / 他ホスト）に
+処理中リクエスト数が最も少ないものから振り分ける
+"""
+
+import asyncio
+import json
+import time
+from typing import Callable, Dict, List, Optional
+
+import aiohttp
+
+from models.batch_scheduler import DeadlineExceeded
+from models.cancellation import REASON_EXPIRED, CancellationToken, GenerationCancelled
+from models.fair_queue import PRIORITY_INTERACTIVE
+from models.local_ai import LocalAI
+from models.training_data import TRAINING_DATA_PATH, append_training_data
+
+
+class InferenceUnavailable(Exception):
+    """推論サーバーが応答できない（準備中・過負荷など）"""
+
+
+class InferenceFailed(Exception):
+    """推論サーバーでの生成が失敗した（サーバー自体は応答できるため、除外・再試行しない）"""
+
+
+class InferenceEndpoint:
+    """1台の推論サーバー"""
+
+    def __init__(self, url: str):
+        """
+        初期化
+
+        url: http://host:port 形式、または unix:/path/to.sock 形式
+        """
+        self.url = url
+        if url.startswith("unix:"):
+            self.socket_path = url[len("unix:"):]
+            self.base_url = "http://localhost"
+        else:
+            self.socket_path = None
+            self.base_url = url.rstrip('/')
+
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        # 振り分け・統計用
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.unhealthy_until = 0.0
+
+    def session(self) -> aiohttp.ClientSession:
+        """HTTPセッションを取得（イベントループ上で遅延生成）"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.UnixConnector(path=self.socket_path) if self.socket_path else None
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def is_healthy(self) -> bool:
+        """一時的な除外期間中でないかチェック"""
+        return time.monotonic() >= self.unhealthy_until
+
+    def mark_unhealthy(self, cooldown: float):
+        """一定時間振り分け対象から外す"""
+        self.errors += 1
+        self.unhealthy_until = time.monotonic() + cooldown
+
+    def get_stats(self) -> Dict:
+        """サーバーごとの統計を取得"""
+        return {
+            "url": self.url,
+            "healthy": self.is_healthy(),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_latency_ms": self.total_latency / self.requests * 1000 if self.requests else 0.0
+        }
+
+    async def close(self):
+        """HTTPセッションを閉じる"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class RemoteAI:
+    """推論サーバーを使うLocalAI互換クライアント"""
+
+    def __init__(
+        self,
+        urls: List[str],
+        token: Optional[str] = None,
+        timeout: float = 120.0,
+        unhealthy_cooldown: float = 10.0
+    ):
+        """
+        初期化
+
+        urls: 推論サーバーのURL一覧
+        token: サーバーと共有する認証トークン
+        timeout: 1リクエストのタイムアウト（秒）
+        unhealthy_cooldown: 失敗したサーバーを振り分けから外す時間（秒）
+        """
+        self.endpoints = [InferenceEndpoint(url) for url in urls]
+        self.token = token
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.unhealthy_cooldown = unhealthy_cooldown
+
+        # LocalAIと同じ属性（呼び出し側の互換用）
+        self.use_real_model = True
+        self.training_data_path = TRAINING_DATA_PATH
+        self.fallback_count = 0
+        self._round_robin = 0
+
+    def warm_up(self) -> float:
+        """ウォームアップ（各サーバー側で実施済みのため何もしない）"""
+        return 0.0
+
+    async def generate_response(
+        self,
+        message: str,
+        context: List[Dict],
+        on_partial: Optional[Callable[[str], None]] = None,
+        guild_id: Optional[str] = None,
+        max_new_tokens: Optional[int] = None,
+        deadline: Optional[float] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        cancel_token: Optional[CancellationToken] = None,
+        user_id: Optional[str] = None
+    ) -> str:
+        """
+        推論サーバーで応答を生成（全サーバーが使えない場合はダミー応答）
+
+        user_id: LocalAIとの互換用（会話履歴の変更はサーバーに届かないため、
+        プレフィックスKVキャッシュはこのプロセスでモデルをロードした場合のみ有効）
+        """
+        if cancel_token is None:
+            return await self._generate(message, context, on_partial, guild_id, max_new_tokens, deadline, priority)
+        
+        # 取り消されたら接続を切り、サーバー側の生成も止めさせる
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(
+            self._generate(message, context, on_partial, guild_id, max_new_tokens, deadline, priority)
+        )
+        cancel_token.add_callback(lambda: loop.call_soon_threadsafe(task.cancel))
+        # 期限切れは誰も cancelled を確認しないと検知されないため、期限の時刻に取り消す
+        expiry = None
+        if cancel_token.expires_at is not None:
+            expiry = loop.call_at(
+                loop.time() + cancel_token.expires_at - time.monotonic(),
+                cancel_token.cancel, REASON_EXPIRED
+            )
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if cancel_token.cancelled:
+                raise GenerationCancelled(cancel_token.reason)
+            task.cancel()
+            raise
+        finally:
+            if expiry is not None:
+                expiry.cancel()
+
+    async def _generate(
+        self,
+        message: str,
+        context: List[Dict],
+        on_partial: Optional[Callable[[str], None]],
+        guild_id: Optional[str],
+        max_new_tokens: Optional[int],
+        deadline: Optional[float],
+        priority: int
+    ) -> str:
+        """サーバーを選んで生成を依頼（失敗したら別のサーバーを試す）"""
+        payload = {
+            "message": message,
+            "context": context,
+            "guild_id": guild_id,
+            "stream": on_partial is not None,
+            "max_new_tokens": max_new_tokens,
+            "priority": priority,
+            # 時計はプロセスごとに異なるため残り時間で渡す
+            "deadline_in": deadline - time.monotonic() if deadline is not None else None
+        }
+
+        tried = set()
+        while len(tried) < len(self.endpoints):
+            endpoint = self._pick_endpoint(tried)
+            tried.add(endpoint.url)
+            try:
+                return await self._request(endpoint, payload, on_partial)
+            except (aiohttp.ClientError, asyncio.TimeoutError, InferenceUnavailable) as e:
+                print(f"推論サーバーエラー ({endpoint.url}): {e}")
+                endpoint.mark_unhealthy(self.unhealthy_cooldown)
+
+        self.fallback_count += 1
+        return LocalAI.generate_template_response(message, context)
+
+    def _pick_endpoint(self, exclude: set) -> InferenceEndpoint:
+        """処理中リクエストが最も少ないサーバーを選ぶ（同数ならラウンドロビン）"""
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.url not in exclude]
+        healthy = [endpoint for endpoint in candidates if endpoint.is_healthy()] or candidates
+
+        self._round_robin = (self._round_robin + 1) % len(healthy)
+        rotated = healthy[self._round_robin:] + healthy[:self._round_robin]
+        return min(rotated, key=lambda endpoint: endpoint.in_flight)
+
+    async def _request(
+        self,
+        endpoint: InferenceEndpoint,
+        payload: Dict,
+        on_partial: Optional[Callable[[str], None]]
+    ) -> str:
+        """1台のサーバーに生成を依頼"""
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        start_time = time.monotonic()
+        endpoint.in_flight += 1
+        try:
+            async with endpoint.session().post(
+                f"{endpoint.base_url}/generate",
+                json=payload,
+                headers=headers,
+                timeout=self.timeout
+            ) as response:
+                if response.status == 503:
+                    raise InferenceUnavailable((await response.json()).get("error", "unavailable"))
+                if response.status in (409, 500, 504) and response.content_type == "application/json":
+                    raise self._server_error(await response.json())
+                if response.status == 504:
+                    raise DeadlineExceeded()
+                response.raise_for_status()
+
+                if not payload["stream"]:
+                    return (await response.json())["response"]
+
+                # NDJSON: 途中経過の行の後に最終応答の行が届く
+                async for line in response.content:
+                    if not line.strip():
+                        continue
+                    data = json.loads(line)
+                    if "partial" in data:
+                        on_partial(data["partial"])
+                    elif "error" in data:
+                        raise self._server_error(data)
+                    elif "response" in data:
+                        return data["response"]
+                raise InferenceUnavailable("ストリームが途中で終了しました")
+        finally:
+            endpoint.in_flight -= 1
+            endpoint.requests += 1
+            endpoint.total_latency += time.monotonic() - start_time
+
+    @staticmethod
+    def _server_error(data: Dict) -> Exception:
+        """サーバーが返した生成の失敗を、ローカルで生成した場合と同じ例外にする"""
+        error = data.get("error")
+        if error == "deadline exceeded":
+            return DeadlineExceeded()
+        if error == "cancelled":
+            return GenerationCancelled(data.get("reason"))
+        return InferenceFailed(data.get("detail") or error)
+
+    async def update_learning_data(self, user_id: str, message: str, response: str):
+        """学習データの更新（ボット側に保存）"""
+        append_training_data(user_id, message, response, self.training_data_path)
+
+    def get_generation_stats(self) -> Dict:
+        """生成統計を取得（サーバーごと）"""
+        return {
+            "remote": [endpoint.get_stats() for endpoint in self.endpoints],
+            "fallback_count": self.fallback_count
+        }
+
+    async def close(self):
+        """全サーバーへのセッションを閉じる"""
+        for endpoint in self.endpoints:
+            await endpoint.close()
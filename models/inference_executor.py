@@ -0,0 +1,106 @@
+"""
+推論エグゼキューター - 生成専用のスレッドプール
+
+デフォルトエグゼキューターで複数のgenerateが全コアを取り合わないよう、
+ワーカー数を制限し、各ワーカーにtorchの演算スレッド数（と任意でCPUアフィニティ）を割り当てる
+"""
+
+import asyncio
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+# PyTorchのインポートを安全に行う
+try:
+    import torch
+    TORCH_AVAILABLE = True
+except ImportError:
+    TORCH_AVAILABLE = False
+
+
+class InferenceExecutor:
+    """生成専用の制限付きスレッドプール"""
+
+    def __init__(self, workers: int = 1, threads_per_worker: int = 0, pin_cpus: bool = False):
+        """
+        初期化
+
+        workers: 同時に生成を実行するワーカー数
+        threads_per_worker: 各ワーカーのtorch演算スレッド数（0の場合はCPU数をワーカー数で等分）
+        pin_cpus: 各ワーカーを専用のCPUコアに固定するか（Linuxのみ）
+        """
+        self.workers = max(1, workers)
+        self.cpu_count = os.cpu_count() or 1
+        self.threads_per_worker = threads_per_worker or max(1, self.cpu_count // self.workers)
+        self.pin_cpus = pin_cpus
+
+        self._worker_ids = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="inference",
+            initializer=self._init_worker
+        )
+
+        # メトリクス
+        self.started_at = time.monotonic()
+        self.pending = 0
+        self.busy_time = [0.0] * self.workers
+        self.completed = [0] * self.workers
+
+    def _init_worker(self):
+        """ワーカースレッドの初期化（演算スレッド数・CPUアフィニティの設定）"""
+        index = next(self._worker_ids) % self.workers
+        self._local.index = index
+
+        if TORCH_AVAILABLE:
+            # OpenMPのスレッド数は呼び出したスレッドの並列領域に適用される
+            torch.set_num_threads(self.threads_per_worker)
+
+        if self.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            first = index * self.threads_per_worker
+            cpus = {cpu % self.cpu_count for cpu in range(first, first + self.threads_per_worker)}
+            try:
+                # Linuxではpid 0は呼び出したスレッド自身
+                os.sched_setaffinity(0, cpus)
+            except OSError as e:
+                print(f"CPUアフィニティ設定エラー: {e}")
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """関数をワーカーで実行して結果を待つ"""
+        with self._lock:
+            self.pending += 1
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._run_tracked, func, args)
+
+    def _run_tracked(self, func: Callable[..., Any], args: tuple) -> Any:
+        """実行時間を記録しながら関数を実行"""
+        with self._lock:
+            self.pending -= 1
+        index = getattr(self._local, 'index', 0)
+        start_time = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.busy_time[index] += time.monotonic() - start_time
+                self.completed[index] += 1
+
+    def get_stats(self) -> Dict:
+        """エグゼキューターのメトリクスを取得"""
+        elapsed = max(1e-9, time.monotonic() - self.started_at)
+        return {
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "pin_cpus": self.pin_cpus,
+            "queue_depth": self.pending,
+            "utilization": [busy / elapsed for busy in self.busy_time],
+            "completed": list(self.completed)
+        }
+
+    def shutdown(self):
+        """ワーカーを停止"""
+        self._executor.shutdown(wait=False)
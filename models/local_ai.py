@@ -5,20 +5,51 @@
 """
 
 import asyncio
-import json
-import os
 import random
-from datetime import datetime
-from typing import List, Dict, Optional
+import threading
+from typing import Callable, List, Dict, Optional, Sequence
+
+from models.batch_scheduler import BatchScheduler
+from models.candidate_scoring import select_candidate
+from models.cancellation import (
+    CancellationGroup, CancellationToken, GenerationCancelled, cancellation_registry
+)
+from models.generation_controls import (
+    STOP_TERMINATORS,
+    SentenceBoundaryTracker,
+    SentenceEndLogitsProcessor,
+    SentenceStoppingCriteria
+)
+from models.fair_queue import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, guild_usage, parse_guild_weights
+from models.generation_request import GenerationRequest
+from models.inference_executor import InferenceExecutor
+from models.pattern_filter import (
+    BLOCKED_PATTERNS, BlockedPatternLogitsProcessor, PatternTokenIndex, blocked_pattern_settings
+)
+from models.precision import apply_precision, precision_context
+from models.prefix_cache import PrefixEntry, PrefixKVCache, encode_prefix, expand_past_key_values
+from models.prompt_builder import QUESTION_LABEL, PromptBuilder
+from models.response_cache import ResponseCache
+from models.single_flight import SingleFlight
+from models.speculative import SpeculativeDecoder
+from models.training_data import TRAINING_DATA_PATH, append_training_data
+from models.streaming import BatchTextStreamer
 
 # PyTorchとTransformersのインポートを安全に行う
 try:
     import torch
-    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList, StoppingCriteriaList
     TORCH_AVAILABLE = True
 except ImportError:
     TORCH_AVAILABLE = False
 
+# 応答生成に失敗した場合の応答
+FALLBACK_RESPONSE = "申し訳ございません。うまく応答できませんでした。"
+
+# プロンプト予算に対するトークナイズ時の上限の余裕（特殊トークン・境界の結合の差）
+PROMPT_TOKEN_MARGIN = 8
+
+
 
 class LocalAI:
     """ローカル日本語AIモデル"""
@@ -30,10 +61,67 @@ class LocalAI:
         self.device = None
         self.tokenizer = None
         self.model = None
+        self.pattern_index: Optional[PatternTokenIndex] = None
+        # トークナイザーの設定（truncationなど）は呼び出しごとに書き換わるため、スレッド間で排他
+        self._tokenizer_lock = threading.Lock()
+        # モデルがない場合は文字数を予算の目安にする
+        self.prompt_builder = self._create_prompt_builder(len, "chars")
+        self.speculative: Optional[SpeculativeDecoder] = None
         self.use_real_model = False
         
+        # 推論精度（fp32 / bf16 / int8）
+        self.precision = "fp32"
+        self.precision_report: Optional[Dict] = None
+        
         # 学習データのパス
-        self.training_data_path = "data/conversations/training_data.json"
+        self.training_data_path = TRAINING_DATA_PATH
+        
+        # 生成統計
+        self.generated_tokens = 0
+        self.generation_time = 0.0
+        self.tokens_saved = 0
+        
+        # 複数候補生成の統計
+        self._reset_candidate_stats()
+        
+        # 禁止パターンの統計（生成中の禁止回数・生成後の破棄件数）
+        self._reset_pattern_stats()
+        
+        # 繰り返し届く短いメッセージ用の応答キャッシュ
+        self.response_cache = ResponseCache(
+            max_entries=Config.AI_CACHE_MAX_ENTRIES,
+            ttl_seconds=Config.AI_CACHE_TTL,
+            per_guild=Config.AI_CACHE_PER_GUILD,
+            bypass_rate=Config.AI_CACHE_BYPASS_RATE
+        )
+        
+        # 同時に届いた同一プロンプトの生成を1回にまとめる
+        self.single_flight = SingleFlight(resample_rate=Config.AI_SINGLE_FLIGHT_RESAMPLE_RATE)
+        
+        # 会話ごとの「前回: …」部分のpast_key_values（履歴が変わった時点で先にエンコード）
+        self.prefix_cache = PrefixKVCache(
+            max_entries=Config.AI_PREFIX_CACHE_MAX_ENTRIES if Config.AI_PREFIX_CACHE_ENABLED else 0,
+            max_bytes=int(Config.AI_PREFIX_CACHE_MAX_MB * 1024 ** 2)
+        )
+        self._pending_prefixes: Dict[tuple, str] = {}
+        self._prefill_tasks = set()
+        
+        # 生成専用のスレッドプール（ワーカーごとに演算スレッドを分割）
+        self.executor = InferenceExecutor(
+            workers=Config.AI_INFERENCE_WORKERS,
+            threads_per_worker=Config.AI_THREADS_PER_WORKER,
+            pin_cpus=Config.AI_PIN_CPUS
+        )
+        
+        # 同時に届いたリクエストをまとめて生成するスケジューラー
+        self.scheduler = BatchScheduler(
+            self._generate_batch_sync,
+            max_batch_size=Config.AI_BATCH_MAX_SIZE,
+            window_ms=Config.AI_BATCH_WINDOW_MS,
+            executor=self.executor,
+            usage=guild_usage,
+            guild_weights=parse_guild_weights(Config.AI_GUILD_WEIGHTS)
+        )
         
         # モデルの初期化を試行
         self._initialize_model()
@@ -68,6 +156,17 @@ class LocalAI:
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
             
+            # バッチ生成ではプロンプト末尾を揃えるため左詰めパディング
+            self.tokenizer.padding_side = "left"
+            # 上限を超えた場合も末尾の「回答:」を残すため先頭側を切り詰める
+            self.tokenizer.truncation_side = "left"
+            
+            # トークン数の予算でプロンプトを組み立てる
+            self.prompt_builder = self._create_prompt_builder(self._count_tokens, self.model_name)
+            
+            # 禁止パターンを完成させるトークンの索引（生成中のフィルター用）
+            self.pattern_index = PatternTokenIndex(self.tokenizer)
+            
             # モデルのロード（Apple Silicon最適化）
             model_kwargs = {
                 "low_cpu_mem_usage": True,
@@ -90,6 +189,21 @@ class LocalAI:
             # モデルをデバイスに移動
             self.model = self.model.to(self.device)
             self.model.eval()
+            
+            # 推論精度モードの適用（失敗・品質低下時はfp32に戻す）
+            if Config.AI_PRECISION != "fp32":
+                self._apply_precision(Config.AI_PRECISION, model_kwargs)
+            
+            # 投機的デコーディング用のドラフトモデル（設定時のみ）
+            if Config.AI_DRAFT_MODEL_NAME:
+                self.speculative = SpeculativeDecoder.load(
+                    Config.AI_DRAFT_MODEL_NAME,
+                    self.model,
+                    self.device,
+                    min_acceptance=Config.AI_SPECULATIVE_MIN_ACCEPTANCE,
+                    baseline_rate=Config.AI_SPECULATIVE_BASELINE_RATE
+                )
+            
             self.use_real_model = True
             
             print("✅ 日本語モデルのロードが完了しました")
@@ -100,19 +214,190 @@ class LocalAI:
             print(f"❌ モデルロードエラー: {e}")
             print("🔄 ダミーモードに切り替えます")
             self._reset_to_dummy_mode()
+    
+    def _apply_precision(self, mode: str, model_kwargs: Dict):
+        """推論精度モードを適用"""
+        from config import Config
+        print(f"🔢 推論精度 {mode} を適用中...")
+        
+        model, active, report = apply_precision(
+            self.model,
+            self.tokenizer,
+            self.device,
+            mode,
+            max_loss_increase=Config.AI_PRECISION_MAX_LOSS_INCREASE
+        )
+        self.precision_report = report
+        
+        if report["fallback"]:
+            print(f"⚠️ {mode} を使用できません（{report['reason']}）。fp32に戻します")
+            if report["mutated"]:
+                # 変換したモデルは使わずfp32で読み直す（変換前に中止した場合はそのまま使う）
+                del model
+                self.model = None
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name,
+                    **model_kwargs
+                ).to(self.device)
+            self.model.eval()
+            self.precision = "fp32"
+            return
+        
+        self.model = model
+        self.model.eval()
+        self.precision = active
+        print(f"✅ 推論精度: {active}（重み {report['fp32_size_mb']:.1f}MB → {report['size_mb']:.1f}MB, "
+              f"loss {report['fp32_loss']:.3f} → {report['loss']:.3f}）")
+    
+    def _create_prompt_builder(self, count_tokens: Callable[[str], int], name: str) -> PromptBuilder:
+        """設定値でプロンプトビルダーを作成"""
+        from config import Config
+        return PromptBuilder(
+            count_tokens,
+            name,
+            max_tokens=Config.AI_PROMPT_MAX_TOKENS,
+            context_tokens=Config.AI_PROMPT_CONTEXT_TOKENS
+        )
+    
+    def _tokenize_ids(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        """トークンID列（add_special_tokens=Trueでプロンプトのトークナイズと同じ結果）"""
+        with self._tokenizer_lock:
+            return self.tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"]
+    
+    def _count_tokens(self, text: str) -> int:
+        """文字列のトークン数（特殊トークンを含めない）"""
+        return len(self._tokenize_ids(text))
+    
     def _reset_to_dummy_mode(self):
         """ダミーモードにリセット"""
         self.use_real_model = False
         self.tokenizer = None
         self.model = None
+        self.prompt_builder = self._create_prompt_builder(len, "chars")
+
+    async def generate_response(
+        self,
+        message: str,
+        context: List[Dict],
+        on_partial: Optional[Callable[[str], None]] = None,
+        guild_id: Optional[str] = None,
+        max_new_tokens: Optional[int] = None,
+        deadline: Optional[float] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        cancel_token: Optional[CancellationToken] = None,
+        user_id: Optional[str] = None
+    ) -> str:
+        """
+        メッセージに対する応答を生成
+
+        on_partial: 生成途中のテキストを受け取るコールバック（イベントループ上で呼ばれる）
+        guild_id: リクエスト元のサーバーID（キャッシュのスコープに使用）
+        max_new_tokens: 生成トークン上限の上書き（負荷が高い時の短縮用）
+        deadline: この時刻（time.monotonic）までに生成が始まらなければDeadlineExceededを送出
+        priority: 優先度クラス（/chatはPRIORITY_INTERACTIVE、自動応答はPRIORITY_BACKGROUND）
+        cancel_token: 取り消しトークン（取り消されたら生成を途中で止め、GenerationCancelledを送出）
+        user_id: 会話履歴の持ち主（会話ごとのプレフィックスKVキャッシュに使用）
+        """
+        error_response = self._validate_message(message)
+        if error_response:
+            return error_response
+        
+        # ダミーモードの場合はバッチ化せずに即座に返す
+        if not self.use_real_model:
+            return self._generate_dummy_response(message, context)
+        
+        # 同じプロンプトへの最近の応答があれば再利用
+        from config import Config
+        # 質問のトークナイズ（トークナイザーのロック待ちを含む）はイベントループの外で行う
+        prompt = await asyncio.to_thread(self._build_prompt, message, context)
+        cache_key = None
+        if Config.AI_CACHE_ENABLED:
+            cache_key = self.response_cache.make_key(prompt, guild_id)
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+        
+        # 呼び出し元のタスクがキャンセルされた場合も生成を止められるよう常にトークンを持たせる
+        if cancel_token is None:
+            cancel_token = CancellationToken()
+        
+        async def start(shared_token: CancellationGroup, emit: Optional[Callable[[str], None]]) -> str:
+            # 生成スレッドからのコールバックをイベントループに渡す
+            thread_callback = None
+            if emit is not None:
+                loop = asyncio.get_running_loop()
+                thread_callback = lambda text: loop.call_soon_threadsafe(emit, text)
+            
+            # 同時期のリクエストとまとめてバッチ生成
+            response = await self.scheduler.submit(
+                GenerationRequest(
+                    message, context, thread_callback,
+                    guild_id=guild_id,
+                    prompt=prompt,
+                    max_new_tokens=max_new_tokens,
+                    deadline=deadline,
+                    priority=priority,
+                    estimated_tokens=max_new_tokens or Config.AI_MAX_TOKENS,
+                    cancel_token=shared_token,
+                    conversation_key=(user_id, guild_id) if user_id is not None else None
+                )
+            )
+            
+            # 途中で止めた応答は使わない
+            if shared_token.cancelled:
+                raise GenerationCancelled(shared_token.reason)
+            
+            # 生成に成功した応答のみキャッシュ（短縮生成の応答は除く）
+            if cache_key is not None and max_new_tokens is None and response != FALLBACK_RESPONSE:
+                self.response_cache.put(cache_key, response)
+            return response
+        
+        # 同じプロンプトの生成が処理中なら相乗りして結果を共有
+        response = await self.single_flight.run(
+            (prompt, max_new_tokens, priority), cancel_token, start, on_partial
+        )
+        if cancel_token.cancelled:
+            raise GenerationCancelled(cancel_token.reason)
+        return response
+        
+    async def summarize_turns(self, previous_summary: Optional[str], turns: List[Dict]) -> str:
+        """
+        会話のターンを短い要約にまとめる（自動応答と同じ低優先度で生成）
 
-    async def generate_response(self, message: str, context: List[Dict]) -> str:
-        """メッセージに対する応答を生成"""
-        return await asyncio.to_thread(self._generate_sync, message, context)
+        previous_summary: これまでの要約（ある場合は新しいターンと合わせてまとめ直す）
+        戻り値: 要約（生成できなかった場合は空文字）
+        """
+        if not self.use_real_model or not turns:
+            return ""
         
+        from config import Config
+        response = await self.scheduler.submit(
+            GenerationRequest(
+                "", [],
+                prompt=self.prompt_builder.build_summary_prompt(previous_summary, turns),
+                max_new_tokens=Config.AI_SUMMARY_MAX_TOKENS,
+                priority=PRIORITY_BACKGROUND,
+                estimated_tokens=Config.AI_SUMMARY_MAX_TOKENS,
+                template_fallback=False,
+                summary=True
+            )
+        )
+        return "" if response == FALLBACK_RESPONSE else response
+    
     def _generate_sync(self, message: str, context: List[Dict]) -> str:
         """同期的な応答生成"""
-        # 入力の検証
+        error_response = self._validate_message(message)
+        if error_response:
+            return error_response
+        
+        # ダミーモードの場合
+        if not self.use_real_model:
+            return self._generate_dummy_response(message, context)
+        
+        return self._generate_batch_sync([GenerationRequest(message, context)])[0]
+    
+    def _validate_message(self, message: str) -> Optional[str]:
+        """入力の検証（問題があればその旨の応答を返す）"""
         if not message or len(message.strip()) == 0:
             return "何かメッセージをお聞かせください。"
         
@@ -120,18 +405,35 @@ class LocalAI:
         if len(message) > 500:
             return "メッセージが長すぎます。もう少し短くしてください。"
         
-        # ダミーモードの場合
-        if not self.use_real_model:
-            return self._generate_dummy_response(message, context)
-        
-        # 実際のAIモデルでの生成
+        return None
+    
+    def _generate_batch_sync(self, requests: List[GenerationRequest]) -> List[str]:
+        """複数リクエストの同期バッチ生成"""
         try:
-            return self._generate_real_response(message, context)
+            return self._generate_real_batch(requests)
         except Exception as e:
+            # 投機的デコーディングに対応しない組み合わせの場合は無効化して生成し直す
+            if self.speculative is not None and self.speculative.enabled and len(requests) == 1:
+                self.speculative.disable(f"生成エラー: {e}")
+                return self._generate_batch_sync(requests)
+            # past_key_valuesの受け渡しに対応しない場合も同様
+            if self.prefix_cache.enabled and len(requests) == 1 and requests[0].conversation_key is not None:
+                self.prefix_cache.disable(f"生成エラー: {e}")
+                return self._generate_batch_sync(requests)
             print(f"AI生成エラー: {e}")
-            return self._generate_dummy_response(message, context)
+            return [
+                self._generate_dummy_response(request.message, request.context) if request.template_fallback
+                else FALLBACK_RESPONSE
+                for request in requests
+            ]
 
-    def _generate_dummy_response(self, message: str, context: List[Dict]) -> str:
+    @staticmethod
+    def generate_template_response(message: str, context: List[Dict]) -> str:
+        """モデルを使わないテンプレート応答（高負荷時の代替）"""
+        return LocalAI._generate_dummy_response(message, context)
+    
+    @staticmethod
+    def _generate_dummy_response(message: str, context: List[Dict]) -> str:
         """ダミー応答の生成"""
         responses = [
             f"「{message}」について考えてみますね。",
@@ -150,60 +452,427 @@ class LocalAI:
 
     def _generate_real_response(self, message: str, context: List[Dict]) -> str:
         """実際のAIモデルでの応答生成"""
+        return self._generate_real_batch([GenerationRequest(message, context)])[0]
+    
+    def _generate_real_batch(self, requests: List[GenerationRequest]) -> List[str]:
+        """実際のAIモデルでのバッチ応答生成（左詰めパディングで1回のgenerate）"""
+        import time
+        start_time = time.time()
+        
         # プロンプトの作成
-        prompt = self._build_prompt(message, context)
+        prompts = [
+            request.prompt or self._build_prompt(request.message, request.context)
+            for request in requests
+        ]
+        
+        # トークナイズ（プロンプトは予算内で組み立て済み、超えた場合は先頭側を切り詰め）
+        from config import Config
+        with self._tokenizer_lock:
+            inputs = self.tokenizer(
+                prompts, 
+                return_tensors="pt", 
+                max_length=Config.AI_PROMPT_MAX_TOKENS + PROMPT_TOKEN_MARGIN,
+                truncation=True,
+                padding=True
+            ).to(self.device)
+        
+        # 1リクエストにつき複数の候補を同じ生成で作り、クリーニング後に最良のものを選ぶ
+        # （要約だけのバッチは選ばないため1つ）
+        num_candidates = max(1, Config.AI_NUM_CANDIDATES)
+        if all(request.summary for request in requests):
+            num_candidates = 1
         
-        # トークナイズ
-        inputs = self.tokenizer(
-            prompt, 
-            return_tensors="pt", 
-            max_length=400,  # より短い制限で安全性向上
-            truncation=True
-        ).to(self.device)
+        # 1件だけのバッチはドラフトモデルで先読みする（候補は1つに絞り、応答速度を優先）
+        speculative = self.speculative.choose(len(requests)) if self.speculative else None
+        if speculative is not None:
+            num_candidates = 1
+        
+        # 1件だけのバッチは会話のプレフィックスのエンコード済み結果を使い、続きだけをエンコード
+        # （パディングのない1件のみ対象。ドラフトモデルとの検証とは併用しない）
+        prefix_entry = None
+        if len(requests) == 1 and speculative is None:
+            prefix_entry = self._lookup_prefix(requests[0], prompts[0], inputs.input_ids)
+        
+        def per_row(values: List) -> List:
+            """リクエストごとの値を候補の行ごとに展開（generateの行の並びに合わせる）"""
+            return [value for value in values for _ in range(num_candidates)]
+        
+        # サーバーごとの禁止パターン
+        guild_patterns = [blocked_pattern_settings.get_patterns(request.guild_id) for request in requests]
+        
+        # ストリーミング要求がある行のみ途中経過を通知（各リクエストの最初の候補のみ）
+        streamer = None
+        if any(request.on_partial for request in requests):
+            streamer = BatchTextStreamer(
+                self.tokenizer,
+                [
+                    self._wrap_partial_callback(request.on_partial, patterns) if candidate == 0 else None
+                    for request, patterns in zip(requests, guild_patterns) for candidate in range(num_candidates)
+                ],
+                chunk_chars=Config.AI_STREAM_CHUNK_CHARS
+            )
+        
+        # 行ごとの生成トークン上限（負荷に応じて短縮されたリクエストあり）
+        row_max_new_tokens = per_row([request.max_new_tokens or Config.AI_MAX_TOKENS for request in requests])
+        max_new_tokens = max(row_max_new_tokens)
+        
+        # 最初の文末・文字数上限・行ごとの上限で行ごとに生成を打ち切る
+        logits_processor = LogitsProcessorList()
+        stopping_criteria = StoppingCriteriaList()
+        
+        # 禁止パターンを完成させるトークンを生成中に禁止（生成後に応答ごと破棄されるのを防ぐ）
+        pattern_processor = None
+        if Config.AI_DECODE_PATTERN_FILTER and self.pattern_index is not None:
+            pattern_processor = BlockedPatternLogitsProcessor(
+                self.pattern_index,
+                per_row(guild_patterns),
+                prompt_length=inputs.input_ids.shape[1]
+            )
+            logits_processor.append(pattern_processor)
+        
+        # 取り消された行も1ステップごとに確認して止める
+        cancel_tokens = per_row([request.cancel_token for request in requests])
+        # 要約の行は最初の文末で止めず、要約の文字数上限でのみ打ち切る
+        summary_rows = per_row([request.summary for request in requests])
+        tracker = None
+        if (Config.AI_STOP_AT_SENTENCE or min(row_max_new_tokens) < max_new_tokens
+                or any(cancel_tokens) or any(summary_rows)):
+            tracker = SentenceBoundaryTracker(
+                self.tokenizer,
+                prompt_length=inputs.input_ids.shape[1],
+                batch_size=len(requests) * num_candidates,
+                max_chars=Config.AI_MAX_RESPONSE_CHARS,
+                row_max_new_tokens=row_max_new_tokens,
+                stop_at_sentence=Config.AI_STOP_AT_SENTENCE,
+                cancel_tokens=cancel_tokens,
+                row_terminators=[
+                    () if summary or not Config.AI_STOP_AT_SENTENCE else STOP_TERMINATORS
+                    for summary in summary_rows
+                ],
+                row_max_chars=[
+                    Config.AI_SUMMARY_MAX_CHARS if summary
+                    else Config.AI_MAX_RESPONSE_CHARS if Config.AI_STOP_AT_SENTENCE else None
+                    for summary in summary_rows
+                ]
+            )
+            # ドラフトモデルとの検証ではLogitsProcessorが不採用になりうる先読みトークンにも呼ばれ、
+            # 終了状態が先読みの分だけ進んでしまうため、採用済みの系列で判定する停止条件だけを使う
+            if not speculative:
+                logits_processor.append(SentenceEndLogitsProcessor(tracker))
+            stopping_criteria.append(SentenceStoppingCriteria(tracker))
         
         # より安全で制御された生成パラメータ（設定ファイルから読み込み）
-        from config import Config
-        with torch.no_grad():
-            outputs = self.model.generate(
-                inputs.input_ids,
-                max_new_tokens=Config.AI_MAX_TOKENS,     # 設定ファイルから読み込み
-                min_new_tokens=5,                        # 最低限の長さ
-                temperature=Config.AI_TEMPERATURE,       # 設定ファイルから読み込み
-                do_sample=True,
-                top_p=0.8,               # より制限的
-                top_k=20,                # 語彙を制限
-                repetition_penalty=1.2,   # 繰り返し強く抑制
-                no_repeat_ngram_size=3,   # より長いn-gramの繰り返し防止
-                pad_token_id=self.tokenizer.pad_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
-                bad_words_ids=[[self.tokenizer.unk_token_id]] if hasattr(self.tokenizer, 'unk_token_id') else None
+        # （投機的デコードの計測フックは生成中だけ登録する）
+        if speculative is not None:
+            self.speculative.begin(self.model, speculative)
+        try:
+            with torch.no_grad(), precision_context(self.precision):
+                outputs = self.model.generate(
+                    inputs.input_ids,
+                    attention_mask=inputs.attention_mask,
+                    max_new_tokens=max_new_tokens,           # 設定ファイル（または負荷に応じた短縮値）
+                    min_new_tokens=min(5, max_new_tokens),   # 最低限の長さ
+                    temperature=Config.AI_TEMPERATURE,       # 設定ファイルから読み込み
+                    do_sample=True,
+                    num_return_sequences=num_candidates,     # リクエストごとの候補数
+                    top_p=0.8,               # より制限的
+                    top_k=20,                # 語彙を制限
+                    repetition_penalty=1.2,   # 繰り返し強く抑制
+                    no_repeat_ngram_size=3,   # より長いn-gramの繰り返し防止
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    bad_words_ids=[[self.tokenizer.unk_token_id]] if hasattr(self.tokenizer, 'unk_token_id') else None,
+                    logits_processor=logits_processor,
+                    stopping_criteria=stopping_criteria,
+                    streamer=streamer,
+                    assistant_model=self.speculative.draft_model if speculative else None,
+                    **({"past_key_values": expand_past_key_values(prefix_entry, num_candidates)} if prefix_entry else {})
+                )
+        finally:
+            if speculative is not None:
+                self.speculative.end()
+        
+        # プロンプト部分を除いた生成トークンのみをデコード
+        prompt_length = inputs.input_ids.shape[1]
+        generated = outputs[:, prompt_length:]
+        
+        row_tokens = [int(tokens) for tokens in (generated != self.tokenizer.pad_token_id).sum(dim=1).tolist()]
+        self.generated_tokens += sum(row_tokens)
+        
+        # サーバー別の使用量を記録（1分あたりの上限判定に使用）
+        for index, request in enumerate(requests):
+            rows = range(index * num_candidates, (index + 1) * num_candidates)
+            if request.record_usage:
+                guild_usage.record(request.guild_id, sum(row_tokens[row] for row in rows))
+            
+            # 取り消されたリクエストは候補の行をまとめて1件として記録
+            if tracker and tracker.cancelled[rows[0]]:
+                cancellation_registry.record_running(
+                    cancel_tokens[rows[0]], sum(tracker.row_tokens_saved(row, max_new_tokens) for row in rows)
+                )
+        if tracker:
+            self.tokens_saved += tracker.tokens_saved(max_new_tokens)
+        if pattern_processor:
+            self.pattern_interventions += pattern_processor.interventions
+        if speculative is not None:
+            self.speculative.record(speculative, sum(row_tokens), time.time() - start_time)
+        if prefix_entry is not None:
+            self.prefix_cache.record_hit(prefix_entry)
+        self.generation_time += time.time() - start_time
+        
+        responses = []
+        for index, (request, patterns) in enumerate(zip(requests, guild_patterns)):
+            rows = range(index * num_candidates, (index + 1) * num_candidates)
+            
+            # 要約は応答のクリーニング・候補の選択・候補の統計の対象外（最初の行を使う）
+            if request.summary:
+                summary_text = self._clean_summary(
+                    self.tokenizer.decode(generated[rows[0]], skip_special_tokens=True)
+                )
+                responses.append(summary_text or FALLBACK_RESPONSE)
+                continue
+            
+            candidates = []
+            for row in rows:
+                raw_text = self.tokenizer.decode(generated[row], skip_special_tokens=True).strip()
+                
+                # 応答のクリーニング
+                candidates.append((raw_text, self._clean_response(raw_text, patterns)))
+            
+            best, accepted = select_candidate(candidates, request.message)
+            self._record_candidates(candidates, best, accepted, [row_tokens[row] for row in rows])
+            responses.append(candidates[best][1] if best is not None else FALLBACK_RESPONSE)
+        
+        return responses
+    
+    def _lookup_prefix(self, request: GenerationRequest, prompt: str, input_ids) -> Optional[PrefixEntry]:
+        """リクエストの会話のエンコード済みプレフィックスを取得（プロンプトと一致しない場合はNone）"""
+        if not self.prefix_cache.enabled or request.conversation_key is None:
+            return None
+        # 長い質問で履歴の予算が減った場合はプレフィックスが異なる
+        prefix_text = self._build_prefix(request.context)
+        if not prefix_text or not prompt.startswith(prefix_text):
+            return None
+        
+        entry = self.prefix_cache.get(request.conversation_key, prefix_text)
+        if entry is None:
+            return None
+        
+        # 切り詰めなどでトークン列が一致しない場合は使わない
+        length = len(entry.token_ids)
+        if input_ids.shape[1] <= length or tuple(input_ids[0, :length].tolist()) != entry.token_ids:
+            self.prefix_cache.record_miss()
+            return None
+        return entry
+    
+    def on_history_changed(self, user_id: str, guild_id: Optional[str], context: List[Dict]):
+        """会話履歴の変更通知（古いプレフィックスを破棄し、次のターン用を先にエンコード）"""
+        key = (user_id, guild_id)
+        self.prefix_cache.invalidate(key)
+        
+        prefix_text = self._build_prefix(context)
+        if not (self.use_real_model and self.prefix_cache.enabled and prefix_text):
+            self._pending_prefixes.pop(key, None)
+            return
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループ外（スクリプトなど）からの変更は次のターンで通常どおりエンコード
+            return
+        
+        self._pending_prefixes[key] = prefix_text
+        task = loop.create_task(self._prefill_prefix(key, prefix_text))
+        self._prefill_tasks.add(task)
+        task.add_done_callback(self._prefill_tasks.discard)
+    
+    async def _prefill_prefix(self, key: tuple, prefix_text: str):
+        """推論ワーカーでプレフィックスをエンコードしてキャッシュ"""
+        try:
+            entry = await self.executor.run(self._encode_prefix, prefix_text)
+        except Exception as e:
+            self.prefix_cache.disable(f"エンコードエラー: {e}")
+            return
+        
+        # エンコード中にさらに履歴が変わった場合は古い結果を捨てる
+        if self._pending_prefixes.get(key) != prefix_text:
+            return
+        del self._pending_prefixes[key]
+        if entry is not None:
+            self.prefix_cache.put(key, entry)
+    
+    def _encode_prefix(self, prefix_text: str) -> Optional[PrefixEntry]:
+        """プレフィックスのpast_key_valuesを作成（推論ワーカー上で呼ぶ）"""
+        with precision_context(self.precision):
+            return encode_prefix(
+                self.model,
+                lambda text: self._tokenize_ids(text, add_special_tokens=True),
+                prefix_text,
+                QUESTION_LABEL,
+                self.device
             )
+    
+    def _reset_pattern_stats(self):
+        """禁止パターンの統計をリセット"""
+        self.pattern_interventions = 0
+        self.posthoc_checked = 0
+        self.posthoc_pattern_rejections = 0
+        self.posthoc_short_rejections = 0
+    
+    async def prepare_patterns(self, patterns: Sequence[str]):
+        """追加された禁止パターンの索引を生成スレッドの外で作成（/filter add 時）"""
+        if self.pattern_index is not None:
+            await asyncio.to_thread(self.pattern_index.prepare, patterns)
+    
+    def _get_pattern_stats(self) -> Dict:
+        """禁止パターンの統計を取得"""
+        from config import Config
+        return {
+            "decode_filter": Config.AI_DECODE_PATTERN_FILTER,
+            # パターンの途中まで生成された行で続きを禁止した回数
+            "interventions": self.pattern_interventions,
+            "checked": self.posthoc_checked,
+            # 生成後にパターンを含むとして破棄した候補数（生成中のフィルターをすり抜けたもの）
+            "pattern_rejections": self.posthoc_pattern_rejections,
+            "short_rejections": self.posthoc_short_rejections,
+            "pattern_rejection_rate": self.posthoc_pattern_rejections / self.posthoc_checked if self.posthoc_checked else 0.0
+        }
+    
+    def _reset_candidate_stats(self):
+        """複数候補生成の統計をリセット"""
+        self.candidate_requests = 0
+        self.candidate_requests_accepted = 0
+        self.candidate_rescued = 0
+        self.candidates_generated = 0
+        self.candidates_accepted = 0
+        self.candidate_extra_tokens = 0
+    
+    def _record_candidates(self, candidates: List, best: Optional[int], accepted: int, tokens: List[int]):
+        """候補生成の採用率とコストを記録"""
+        self.candidate_requests += 1
+        self.candidates_generated += len(candidates)
+        self.candidates_accepted += accepted
+        self.candidate_extra_tokens += sum(tokens[1:])
+        if best is not None:
+            self.candidate_requests_accepted += 1
+            # 最初の候補だけなら定型文になっていたリクエスト
+            if not candidates[0][1]:
+                self.candidate_rescued += 1
+    
+    def warm_up(self) -> float:
+        """ウォームアップ生成（初回リクエストでの初期化コストを先に払う）"""
+        import time
+        start_time = time.time()
         
-        # デコードと後処理
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        response = response.replace(prompt, "").strip()
+        # 禁止パターンの索引を先に作っておく（語彙全体のデコードが必要なため）
+        if self.pattern_index is not None:
+            self.pattern_index.prepare(blocked_pattern_settings.all_patterns())
         
-        # 応答のクリーニング
-        response = self._clean_response(response)
+        # バッチ（パディングあり）の経路も通すため長さの違う2件で生成
+        # （ウォームアップ分はDMの使用量・1分あたりの上限に含めない）
+        self._generate_batch_sync([
+            GenerationRequest("こんにちは", [], record_usage=False),
+            GenerationRequest("今日はいい天気ですね。何をしましょうか？", [], record_usage=False)
+        ])
         
-        return response if response else "申し訳ございません。うまく応答できませんでした。"
-    def _build_prompt(self, message: str, context: List[Dict]) -> str:
-        """対話プロンプトの構築（改善版）"""
-        # より制御しやすいシンプルなプロンプト
-        prompt = ""
+        # ウォームアップ分は生成統計に含めない
+        self.generated_tokens = 0
+        self.generation_time = 0.0
+        self.tokens_saved = 0
+        self._reset_candidate_stats()
+        self._reset_pattern_stats()
+        self.prompt_builder.reset_stats()
+        return time.time() - start_time
+    
+    def _wrap_partial_callback(
+        self,
+        on_partial: Optional[Callable[[str], None]],
+        patterns: Sequence[str] = BLOCKED_PATTERNS
+    ) -> Optional[Callable[[str], None]]:
+        """途中テキストを表示用に整形してから渡すコールバックを作成"""
+        if on_partial is None:
+            return None
         
-        # コンテキストは最新の1つのみ（混乱を避ける）
-        if context and len(context) > 0:
-            last_conv = context[-1]
-            if 'user' in last_conv and 'assistant' in last_conv:
-                prompt += f"前回: {last_conv['user']} → {last_conv['assistant']}\n"
+        def callback(text: str):
+            preview = self._preview_text(text, patterns)
+            if preview:
+                on_partial(preview)
         
-        prompt += f"質問: {message}\n回答:"
-        return prompt
+        return callback
+    
+    def _preview_text(self, text: str, patterns: Sequence[str] = BLOCKED_PATTERNS) -> str:
+        """生成途中のテキストを表示用に整形（最終的に_clean_responseで残る範囲のみ）"""
+        import re
+        text = re.sub(r'\s+', ' ', text.replace('\n', ' ')).strip()
+        
+        # 破棄される予定の応答は途中表示しない
+        if any(pattern in text.lower() for pattern in patterns):
+            return ""
+        
+        # 最初の文まで（未完の文は省略記号を付ける）
+        if '。' in text:
+            text = text.split('。')[0].strip() + '。'
+        else:
+            text += '…'
+        
+        from config import Config
+        return text[:Config.AI_MAX_RESPONSE_CHARS]
+    
+    def get_generation_stats(self) -> Dict:
+        """生成統計を取得"""
+        return {
+            "generated_tokens": self.generated_tokens,
+            "generation_time": self.generation_time,
+            "tokens_per_second": self.generated_tokens / self.generation_time if self.generation_time else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "cancellation": cancellation_registry.get_stats(),
+            "precision": self.precision,
+            "precision_report": self.precision_report,
+            "batching": self.scheduler.get_stats(),
+            "cache": self.response_cache.get_stats(),
+            "single_flight": self.single_flight.get_stats(),
+            "candidates": self._get_candidate_stats(),
+            "pattern_filter": self._get_pattern_stats(),
+            "speculative": self.speculative.get_stats() if self.speculative else None,
+            "prefix_cache": self.prefix_cache.get_stats(),
+            "prompt": self.prompt_builder.get_stats()
+        }
     
-    def _clean_response(self, response: str) -> str:
-        """応答のクリーニング（強化版）"""
+    def _get_candidate_stats(self) -> Dict:
+        """複数候補生成の統計を取得"""
+        from config import Config
+        return {
+            "num_candidates": max(1, Config.AI_NUM_CANDIDATES),
+            # 少なくとも1候補が採用できたリクエストの割合
+            "acceptance_rate": self.candidate_requests_accepted / self.candidate_requests if self.candidate_requests else 0.0,
+            # 候補1つあたりの採用率（クリーニングで破棄されなかった割合）
+            "candidate_acceptance_rate": self.candidates_accepted / self.candidates_generated if self.candidates_generated else 0.0,
+            "rescued": self.candidate_rescued,
+            # 2つ目以降の候補に使ったトークン数（複数候補の追加コスト）
+            "extra_tokens": self.candidate_extra_tokens,
+            "extra_token_ratio": self.candidate_extra_tokens / self.generated_tokens if self.generated_tokens else 0.0
+        }
+    
+    def _build_prompt(self, message: str, context: List[Dict]) -> str:
+        """対話プロンプトの構築（トークン数の予算内で、質問と回答の書き出しは必ず残す）"""
+        return self.prompt_builder.build(message, context)
+    
+    def _build_prefix(self, context: List[Dict]) -> str:
+        """会話履歴から作るプロンプトの先頭部分（同じ会話の次のターンで共通）"""
+        return self.prompt_builder.build_context(context)
+    
+    @staticmethod
+    def _clean_summary(text: str) -> str:
+        """要約の整形（空白をまとめ、要約の最大文字数に切り詰める）"""
+        import re
+        from config import Config
+        return re.sub(r'\s+', ' ', text).strip()[:Config.AI_SUMMARY_MAX_CHARS]
+    
+    def _clean_response(self, response: str, patterns: Sequence[str] = BLOCKED_PATTERNS) -> str:
+        """応答のクリーニング（強化版、patternsはサーバーで有効な禁止パターン）"""
+        self.posthoc_checked += 1
         if not response:
+            self.posthoc_short_rejections += 1
             return ""
         
         # 基本的なクリーニング
@@ -218,6 +887,7 @@ class LocalAI:
         
         # 短すぎる場合は除外
         if len(response) < 3:
+            self.posthoc_short_rejections += 1
             return ""
         
         # 長すぎる場合は最初の文のみ
@@ -229,47 +899,17 @@ class LocalAI:
                 response += '。'
         
         # 異常なパターンを検出して除外
-        if any(pattern in response.lower() for pattern in [
-            'http', 'www.', 'chatroom', 'website', 'translation', 
-            'contact me', 'support', 'blog', 'english'
-        ]):
+        if any(pattern in response.lower() for pattern in patterns):
+            self.posthoc_pattern_rejections += 1
             return ""
         
-        # 100文字を超える場合は切り詰め
-        if len(response) > 100:
-            response = response[:100] + "..."
+        # 上限文字数を超える場合は切り詰め
+        from config import Config
+        if len(response) > Config.AI_MAX_RESPONSE_CHARS:
+            response = response[:Config.AI_MAX_RESPONSE_CHARS] + "..."
         
         return response
         
     async def update_learning_data(self, user_id: str, message: str, response: str):
         """学習データの更新（簡略版）"""
-        try:
-            # データの保存（シンプル版）
-            data = {
-                "user_id": user_id,
-                "timestamp": datetime.now().isoformat(),
-                "message": message[:100],  # 長さ制限
-                "response": response[:200]  # 長さ制限
-            }
-            
-            os.makedirs(os.path.dirname(self.training_data_path), exist_ok=True)
-            
-            # 既存データの読み込み
-            training_data = []
-            if os.path.exists(self.training_data_path):
-                with open(self.training_data_path, 'r', encoding='utf-8') as f:
-                    training_data = json.load(f)
-            
-            # 新しいデータを追加
-            training_data.append(data)
-            
-            # 最新の1000件のみ保持
-            if len(training_data) > 1000:
-                training_data = training_data[-1000:]
-            
-            # データを保存
-            with open(self.training_data_path, 'w', encoding='utf-8') as f:
-                json.dump(training_data, f, ensure_ascii=False, indent=2)
-                
-        except Exception as e:
-            print(f"学習データ保存エラー: {e}")
\ No newline at end of file
+        append_training_data(user_id, message, response, self.training_data_path)
@@ -2,47 +2,229 @@
 記憶管理 - サーバー別会話履歴管理
 
 ユーザーとサーバーごとに会話履歴を管理する改善版
+（保存先はmemory_storageのバックエンド: JSONファイルまたはSQLite）
+
+イベントループからは *_async のメソッドを使う（ファイル入出力を専用のスレッドで行い、
+変更通知はイベントループ上で行う）。同期版のメソッドはスクリプト用
 """
 
-import json
-import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Optional
+from functools import partial
+from typing import Callable, List, Dict, Optional
+
+from models.data_stats import data_stats
+from models.memory_storage import MemoryStorage, create_storage
 
 
 class MemoryManager:
     """サーバー別会話履歴管理クラス"""
     
-    def __init__(self):
-        self.memory_path = "data/conversations/memories/"
-        os.makedirs(self.memory_path, exist_ok=True)
-        
-    def _get_file_path(self, user_id: str, guild_id: Optional[str] = None) -> str:
-        """ファイルパスを取得（サーバー別）"""
-        if guild_id:
-            # サーバー別の履歴
-            server_dir = os.path.join(self.memory_path, f"guild_{guild_id}")
-            os.makedirs(server_dir, exist_ok=True)
-            return os.path.join(server_dir, f"{user_id}.json")
-        else:
-            # DM用の履歴
-            dm_dir = os.path.join(self.memory_path, "direct_messages")
-            os.makedirs(dm_dir, exist_ok=True)
-            return os.path.join(dm_dir, f"{user_id}.json")
+    def __init__(self, storage: Optional[MemoryStorage] = None):
+        """
+        初期化
+        
+        storage: 会話履歴の保存先（Noneの場合はMEMORY_BACKENDの設定に従う）
+        """
+        from config import Config
+        self.storage = storage or create_storage(Config.MEMORY_BACKEND)
+        
+        # 件数・サイズのカウンター（書き込み時に更新、ない場合は1回だけ数え直す）
+        self.stats = data_stats
+        self.storage.set_stats(self.stats)
+        self.stats.start_rebuild(self.storage)
+        
+        # 非同期版のメソッドがファイル入出力を行うスレッド
+        self._io_executor = ThreadPoolExecutor(
+            max_workers=Config.MEMORY_IO_WORKERS,
+            thread_name_prefix="memory-io"
+        )
+        
+        # 会話履歴の変更通知先（user_id, guild_id, 変更後のプロンプト用の履歴を受け取る）
+        self._listeners: List[Callable[[str, Optional[str], List[Dict]], None]] = []
+        
+        # 保存時に各ターンのトークン数を記録する関数（プロンプト構築で履歴を数え直さないため）
+        self._token_counter: Optional[Callable[[Dict], int]] = None
+        self._token_counter_name: Optional[str] = None
+        
+    def set_token_counter(self, name: str, counter: Callable[[Dict], int]):
+        """ターンのトークン数を数える関数を登録（nameはトークナイザーの識別名）"""
+        self._token_counter_name = name
+        self._token_counter = counter
+        
+    def add_listener(self, listener: Callable[[str, Optional[str], List[Dict]], None]):
+        """会話履歴が変わった時に呼ばれるコールバックを登録"""
+        self._listeners.append(listener)
+        
+    async def _run_io(self, func: Callable, *args, **kwargs):
+        """ファイル入出力を専用のスレッドで実行"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._io_executor, partial(func, *args, **kwargs)
+        )
+        
+    def _notify(self, user_id: str, guild_id: Optional[str], conversations: List[Dict]):
+        """会話履歴の変更を通知（非同期版ではイベントループ上で呼ばれる）"""
+        for listener in self._listeners:
+            try:
+                listener(user_id, guild_id, conversations)
+            except Exception as e:
+                print(f"会話履歴の変更通知エラー: {e}")
         
     def get_context(self, user_id: str, guild_id: Optional[str] = None) -> List[Dict]:
         """ユーザーの会話履歴を取得"""
-        file_path = self._get_file_path(user_id, guild_id)
+        try:
+            data = self.storage.load(user_id, guild_id)
+            if data is not None:
+                return data.get('conversations', [])
+        except Exception as e:
+            print(f"会話履歴読み込みエラー: {e}")
+        
+        return []
+        
+    async def get_context_async(self, user_id: str, guild_id: Optional[str] = None) -> List[Dict]:
+        """ユーザーの会話履歴を取得（非同期版）"""
+        return await self._run_io(self.get_context, user_id, guild_id)
         
+    def get_prompt_context(self, user_id: str, guild_id: Optional[str] = None) -> List[Dict]:
+        """プロンプト用の会話履歴（要約がある場合は先頭に要約、その後に要約に含まれないターン）"""
         try:
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    return data.get('conversations', [])
+            data = self.storage.load(user_id, guild_id)
+            if data is not None:
+                return self._prompt_context(self._backfill_tokens(user_id, guild_id, data))
         except Exception as e:
             print(f"会話履歴読み込みエラー: {e}")
         
         return []
+    
+    async def get_prompt_context_async(self, user_id: str, guild_id: Optional[str] = None) -> List[Dict]:
+        """プロンプト用の会話履歴（非同期版）"""
+        return await self._run_io(self.get_prompt_context, user_id, guild_id)
+    
+    @staticmethod
+    def _prompt_context(data: Dict) -> List[Dict]:
+        """保存データからプロンプト用の会話履歴を作成"""
+        conversations = data.get('conversations', [])
+        summary = data.get('summary')
+        if not summary:
+            return conversations
+        covered_until = summary.get('covered_until', '')
+        return [summary] + [conv for conv in conversations if conv.get('timestamp', '') > covered_until]
+    
+    def _backfill_tokens(self, user_id: str, guild_id: Optional[str], data: Dict) -> Dict:
+        """
+        プロンプトに使うターン・要約のうちトークン数が未記録のものを数えて保存し、反映したデータを返す
+
+        古い形式の履歴やトークナイザーの変更で未記録の分を、プロンプト構築（イベントループ上）の
+        たびに数え直さないよう、ファイル入出力と同じスレッドで1回だけ数える
+        """
+        if self._token_counter is None:
+            return data
+        name = self._token_counter_name
+        items = []
+        try:
+            for turn in self._prompt_context(data):
+                if name in (turn.get('tokens') or {}):
+                    continue
+                if 'summary' in turn:
+                    items.append({"updated_at": turn.get('updated_at'), "tokens": {name: self._token_counter(turn)}})
+                elif 'user' in turn and 'assistant' in turn:
+                    items.append({"timestamp": turn.get('timestamp'), "tokens": {name: self._token_counter(turn)}})
+        except Exception as e:
+            print(f"トークン数の計算エラー: {e}")
+            return data
+        if not items:
+            return data
+        
+        data = dict(data)
+        self.storage.apply_tokens(data, items)
+        try:
+            self.storage.save_tokens(user_id, guild_id, items)
+        except Exception as e:
+            print(f"トークン数の保存エラー: {e}")
+        return data
+    
+    def get_summary(self, user_id: str, guild_id: Optional[str] = None) -> Optional[Dict]:
+        """会話の要約を取得（未作成ならNone）"""
+        context = self.get_prompt_context(user_id, guild_id)
+        if context and 'summary' in context[0]:
+            return context[0]
+        return None
+    
+    def set_summary(
+        self,
+        user_id: str,
+        guild_id: Optional[str],
+        text: str,
+        covered_until: str,
+        covered_turns: int
+    ) -> bool:
+        """
+        会話の要約を保存（会話履歴の隣に保存し、プロンプトでは要約済みのターンの代わりに使う）
+        
+        covered_until: 要約に含めた最後のターンのtimestamp
+        covered_turns: 要約に含めたターンの累計数
+        戻り値: 保存したか（要約中に履歴が削除・入れ替わった場合は保存しない）
+        """
+        data = self._save_summary(user_id, guild_id, text, covered_until, covered_turns)
+        if data is None:
+            return False
+        self._notify(user_id, guild_id, self._prompt_context(data))
+        return True
+    
+    async def set_summary_async(
+        self,
+        user_id: str,
+        guild_id: Optional[str],
+        text: str,
+        covered_until: str,
+        covered_turns: int
+    ) -> bool:
+        """会話の要約を保存（非同期版）"""
+        data = await self._run_io(self._save_summary, user_id, guild_id, text, covered_until, covered_turns)
+        if data is None:
+            return False
+        self._notify(user_id, guild_id, self._prompt_context(data))
+        return True
+    
+    def _save_summary(
+        self,
+        user_id: str,
+        guild_id: Optional[str],
+        text: str,
+        covered_until: str,
+        covered_turns: int
+    ) -> Optional[Dict]:
+        """要約を保存し、保存後の会話データを返す（保存しなかった場合はNone）"""
+        try:
+            data = self.storage.load(user_id, guild_id)
+            
+            # 要約の元になったターンが残っているか確認
+            if data is None or not any(
+                conv.get('timestamp') == covered_until for conv in data.get('conversations', [])
+            ):
+                return None
+            
+            summary = {
+                "summary": text,
+                "covered_until": covered_until,
+                "covered_turns": covered_turns,
+                "updated_at": datetime.now().isoformat()
+            }
+            if self._token_counter is not None:
+                try:
+                    summary["tokens"] = {self._token_counter_name: self._token_counter(summary)}
+                except Exception as e:
+                    print(f"トークン数の計算エラー: {e}")
+            
+            self.storage.save_summary(user_id, guild_id, summary)
+            data['summary'] = summary
+                
+        except Exception as e:
+            print(f"会話要約保存エラー: {e}")
+            return None
+        
+        return self._backfill_tokens(user_id, guild_id, data)
         
     def add_conversation(
         self, 
@@ -54,55 +236,85 @@ class MemoryManager:
         message_type: str = "command"
     ):
         """会話を記録（改善版）"""
-        file_path = self._get_file_path(user_id, guild_id)
+        data = self._save_conversation(user_id, user_message, ai_response, guild_id, channel_id, message_type)
+        if data is not None:
+            self._notify(user_id, guild_id, self._prompt_context(data))
+        
+    async def add_conversation_async(
+        self, 
+        user_id: str, 
+        user_message: str, 
+        ai_response: str,
+        guild_id: Optional[str] = None,
+        channel_id: Optional[str] = None,
+        message_type: str = "command"
+    ):
+        """会話を記録（非同期版）"""
+        data = await self._run_io(
+            self._save_conversation, user_id, user_message, ai_response, guild_id, channel_id, message_type
+        )
+        if data is not None:
+            self._notify(user_id, guild_id, self._prompt_context(data))
+        
+    def _save_conversation(
+        self, 
+        user_id: str, 
+        user_message: str, 
+        ai_response: str,
+        guild_id: Optional[str],
+        channel_id: Optional[str],
+        message_type: str
+    ) -> Optional[Dict]:
+        """会話を保存し、保存後の会話データを返す（失敗した場合はNone）"""
+        # 新しい会話を追加
+        conversation = {
+            "timestamp": datetime.now().isoformat(),
+            "user": user_message[:500],  # 長さ制限
+            "assistant": ai_response[:500],  # 長さ制限
+            "channel_id": channel_id,
+            "type": message_type  # "command" or "auto_response"
+        }
+        
+        # トークン数（トークナイザーごと）
+        if self._token_counter is not None:
+            try:
+                conversation["tokens"] = {self._token_counter_name: self._token_counter(conversation)}
+            except Exception as e:
+                print(f"トークン数の計算エラー: {e}")
         
         try:
-            # 既存のデータを読み込み
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-            else:
-                data = {
-                    "user_id": user_id,
-                    "guild_id": guild_id,
-                    "created_at": datetime.now().isoformat(),
-                    "conversations": []
-                }
-                
-            # 新しい会話を追加
-            conversation = {
-                "timestamp": datetime.now().isoformat(),
-                "user": user_message[:500],  # 長さ制限
-                "assistant": ai_response[:500],  # 長さ制限
-                "channel_id": channel_id,
-                "type": message_type  # "command" or "auto_response"
-            }
-            
-            data['conversations'].append(conversation)
-            
-            # 最新の30件のみ保持（サーバー別で効率化）
-            if len(data['conversations']) > 30:
-                data['conversations'] = data['conversations'][-30:]
-                
-            # 保存
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-                
+            data = self.storage.append(user_id, guild_id, conversation)
         except Exception as e:
             print(f"会話履歴保存エラー: {e}")
+            return None
+        return self._backfill_tokens(user_id, guild_id, data)
             
     def clear_memory(self, user_id: str, guild_id: Optional[str] = None):
         """ユーザーの会話履歴をクリア"""
-        file_path = self._get_file_path(user_id, guild_id)
+        if self._delete(user_id, guild_id):
+            self._notify(user_id, guild_id, [])
+            
+    async def clear_memory_async(self, user_id: str, guild_id: Optional[str] = None):
+        """ユーザーの会話履歴をクリア（非同期版）"""
+        if await self._run_io(self._delete, user_id, guild_id):
+            self._notify(user_id, guild_id, [])
+            
+    def _delete(self, user_id: str, guild_id: Optional[str]) -> bool:
+        """会話データを削除（成功したか）"""
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            self.storage.delete(user_id, guild_id)
         except Exception as e:
             print(f"会話履歴削除エラー: {e}")
+            return False
+        return True
             
     def export_memory(self, user_id: str, guild_id: Optional[str] = None) -> str:
-        """会話履歴をエクスポート"""
-        conversations = self.get_context(user_id, guild_id)
+        """会話履歴をエクスポート（保持している全てのターン）"""
+        try:
+            conversations = self.storage.load_history(user_id, guild_id)
+        except Exception as e:
+            print(f"会話履歴読み込みエラー: {e}")
+            conversations = []
         if not conversations:
             return "会話履歴がありません。"
             
@@ -120,28 +332,40 @@ class MemoryManager:
             
         return export_text
     
+    async def export_memory_async(self, user_id: str, guild_id: Optional[str] = None) -> str:
+        """会話履歴をエクスポート（非同期版）"""
+        return await self._run_io(self.export_memory, user_id, guild_id)
+    
+    def flush(self):
+        """未書き込みの会話履歴を書き込む"""
+        try:
+            self.storage.flush()
+        except Exception as e:
+            print(f"会話履歴書き込みエラー: {e}")
+    
+    async def flush_async(self):
+        """未書き込みの会話履歴を書き込む（非同期版）"""
+        await self._run_io(self.flush)
+    
+    def get_cache_stats(self) -> Optional[Dict]:
+        """会話キャッシュの統計（キャッシュを使っていない場合はNone）"""
+        get_stats = getattr(self.storage, 'get_stats', None)
+        return get_stats() if get_stats is not None else None
+    
     def get_server_stats(self, guild_id: str) -> Dict:
-        """サーバーの統計情報を取得"""
-        server_dir = os.path.join(self.memory_path, f"guild_{guild_id}")
-        
-        if not os.path.exists(server_dir):
-            return {"total_users": 0, "total_conversations": 0}
-        
-        total_users = 0
-        total_conversations = 0
-        
+        """サーバーの統計情報を取得（再集計が終わるまでは保存先から数える）"""
+        if self.stats.ready:
+            return self.stats.get_guild(guild_id)
         try:
-            for file in os.listdir(server_dir):
-                if file.endswith('.json'):
-                    total_users += 1
-                    file_path = os.path.join(server_dir, file)
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        total_conversations += len(data.get('conversations', []))
+            return self.storage.guild_stats(guild_id)
         except Exception as e:
             print(f"統計取得エラー: {e}")
-        
-        return {
-            "total_users": total_users,
-            "total_conversations": total_conversations
-        }
\ No newline at end of file
+            return {"total_users": 0, "total_conversations": 0}
+    
+    def get_data_stats(self) -> Dict:
+        """全体の件数・サイズの統計を取得"""
+        return self.stats.get_stats()
+    
+    async def get_server_stats_async(self, guild_id: str) -> Dict:
+        """サーバーの統計情報を取得（非同期版）"""
+        return await self._run_io(self.get_server_stats, guild_id)
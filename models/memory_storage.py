@@ -0,0 +1,1385 @@
+"""
+会話履歴の保存先 - MemoryManagerのストレージバックエンド
+
+json: ユーザーごとのJSONファイル（data/conversations/memories/guild_<id>/<user_id>.json）
+segment: 会話ごとの追記専用のJSON Linesセグメント（data/conversations/segments/guild_<id>/<user_id>/）、
+         1ターンの保存は1行の追記で、数千ターンを保持しても1件あたりのコストが増えない
+sqlite: DATABASE_PATHのSQLite（WALモード、(guild_id, user_id, timestamp) の索引、
+        追記はまとめてコミットし、1件あたりのコストは履歴の量やユーザー数によらず一定）
+
+どちらもCachedMemoryStorageで包み、よく使われる会話はメモリ上から読み書きする
+（変更は一定間隔でまとめて書き込む）
+"""
+
+import atexit
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+# 1会話あたりに読み込む最新のターン数（json・sqliteはこれより古いターンを削除）
+MAX_TURNS = 30
+
+# バックエンドの種類
+BACKEND_JSON = "json"
+BACKEND_SQLITE = "sqlite"
+BACKEND_SEGMENT = "segment"
+
+
+class MemoryStorage:
+    """会話履歴の保存先（バックエンドの共通インターフェース）"""
+
+    # 件数・サイズの増減の記録先（DataStats、未設定なら記録しない）
+    stats = None
+
+    def load(self, user_id: str, guild_id: Optional[str]) -> Optional[Dict]:
+        """
+        会話データを読み込み（存在しない場合はNone）
+
+        戻り値: {"user_id", "guild_id", "created_at", "conversations": [...], "summary"（ある場合）}
+        """
+        raise NotImplementedError
+
+    def append(self, user_id: str, guild_id: Optional[str], conversation: Dict) -> Dict:
+        """ターンを追加し、追加後の会話データを返す（MAX_TURNSを超えた古いターンは削除）"""
+        raise NotImplementedError
+
+    def append_many(self, user_id: str, guild_id: Optional[str], conversations: List[Dict]):
+        """複数のターンをまとめて追加（キャッシュからの書き込み用）"""
+        for conversation in conversations:
+            self.append(user_id, guild_id, conversation)
+
+    def load_history(self, user_id: str, guild_id: Optional[str]) -> List[Dict]:
+        """保持している全てのターン（古い順、エクスポート用）"""
+        data = self.load(user_id, guild_id)
+        return data['conversations'] if data is not None else []
+
+    def save_summary(self, user_id: str, guild_id: Optional[str], summary: Dict):
+        """会話の要約を保存"""
+        raise NotImplementedError
+
+    def save_tokens(self, user_id: str, guild_id: Optional[str], items: List[Dict]):
+        """
+        後から数えたトークン数を保存（記録がなかった古いターン・要約の分）
+
+        items: {"timestamp"（ターン）または "updated_at"（要約）, "tokens"} のリスト
+        （既に削除・更新されたターン・要約の分は保存しない）
+        """
+
+    @staticmethod
+    def apply_tokens(data: Dict, items: List[Dict]) -> bool:
+        """会話データにトークン数を反映（ターン・要約は新しいdictに置き換える、反映した場合はTrue）"""
+        turn_tokens = {item['timestamp']: item['tokens'] for item in items if 'timestamp' in item}
+        changed = False
+        conversations = []
+        for conversation in data.get('conversations', []):
+            tokens = turn_tokens.get(conversation.get('timestamp'))
+            if tokens:
+                conversation = dict(conversation, tokens=dict(conversation.get('tokens') or {}, **tokens))
+                changed = True
+            conversations.append(conversation)
+        data['conversations'] = conversations
+
+        summary = data.get('summary')
+        for item in items:
+            if 'updated_at' in item and summary and summary.get('updated_at') == item['updated_at']:
+                data['summary'] = dict(summary, tokens=dict(summary.get('tokens') or {}, **item['tokens']))
+                changed = True
+        return changed
+
+    def delete(self, user_id: str, guild_id: Optional[str]):
+        """会話データを削除"""
+        raise NotImplementedError
+
+    def guild_stats(self, guild_id: str) -> Dict:
+        """サーバーのユーザー数・保持している会話数"""
+        raise NotImplementedError
+
+    def scan_stats(self) -> Tuple[Dict[str, Dict[str, int]], int]:
+        """
+        全体を数え直す（カウンターがない場合の再集計用）
+
+        戻り値: (サーバーID（DMは空文字）→ {"users", "conversations"}, 会話履歴のバイト数)
+        会話ごとに読む保存先は、会話を読むたびに書き込みと同じロックの中で_mark_scannedを呼び、
+        全体を一度に読む保存先は読み込み時点で_scan_snapshotを呼ぶ（再集計中の変更を二重に数えない）
+        """
+        raise NotImplementedError
+
+    def scan_conversation(self, user_id: str, guild_id: Optional[str]) -> Tuple[int, int, int]:
+        """
+        1会話を数え直す（再集計の一覧に含まれなかった会話用、_mark_scannedも行う）
+
+        戻り値: (ユーザー数（0か1）, ターン数, バイト数)
+        """
+        raise NotImplementedError
+
+    def set_stats(self, stats):
+        """件数・サイズの増減の記録先を設定"""
+        self.stats = stats
+
+    def _record_change(
+        self,
+        guild_id: Optional[str],
+        users: int = 0,
+        conversations: int = 0,
+        user_id: Optional[str] = None
+    ):
+        """ユーザー数・ターン数の増減を記録（会話ごとに読む保存先はuser_idを指定）"""
+        if self.stats is not None:
+            self.stats.record_change(guild_id, users, conversations, user_id=user_id)
+
+    def _record_bytes(self, delta: int, guild_id: Optional[str] = None, user_id: Optional[str] = None):
+        """ディスク使用量の増減を記録（会話ごとに読む保存先はguild_id・user_idを指定）"""
+        if self.stats is not None:
+            self.stats.record_bytes(delta, guild_id, user_id)
+
+    def _mark_scanned(self, user_id: str, guild_id: Optional[str]):
+        """再集計で会話を読んだことを記録（書き込みと同じロックの中で呼ぶ）"""
+        if self.stats is not None:
+            self.stats.mark_scanned(guild_id, user_id)
+
+    def _scan_snapshot(self):
+        """再集計の読み込み時点を記録（書き込みと同じロックの中で呼ぶ）"""
+        if self.stats is not None:
+            self.stats.scan_snapshot()
+
+    def flush(self):
+        """未書き込みの変更を書き込む"""
+
+    def close(self):
+        """保存先を閉じる"""
+        self.flush()
+
+    @staticmethod
+    def new_record(user_id: str, guild_id: Optional[str]) -> Dict:
+        """新しい会話データ"""
+        return {
+            "user_id": user_id,
+            "guild_id": guild_id,
+            "created_at": datetime.now().isoformat(),
+            "conversations": []
+        }
+
+
+class JsonMemoryStorage(MemoryStorage):
+    """ユーザーごとのJSONファイルに保存"""
+
+    def __init__(self, memory_path: str = "data/conversations/memories/"):
+        self.memory_path = memory_path
+        os.makedirs(self.memory_path, exist_ok=True)
+        # 書き込みと再集計の読み込みの順序を守るロック
+        self._lock = threading.RLock()
+
+    def _get_file_path(self, user_id: str, guild_id: Optional[str] = None) -> str:
+        """ファイルパスを取得（サーバー別）"""
+        if guild_id:
+            # サーバー別の履歴
+            server_dir = os.path.join(self.memory_path, f"guild_{guild_id}")
+            os.makedirs(server_dir, exist_ok=True)
+            return os.path.join(server_dir, f"{user_id}.json")
+        else:
+            # DM用の履歴
+            dm_dir = os.path.join(self.memory_path, "direct_messages")
+            os.makedirs(dm_dir, exist_ok=True)
+            return os.path.join(dm_dir, f"{user_id}.json")
+
+    def load(self, user_id: str, guild_id: Optional[str]) -> Optional[Dict]:
+        file_path = self._get_file_path(user_id, guild_id)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write(self, user_id: str, guild_id: Optional[str], data: Dict):
+        """会話データを書き込み（一時ファイルに書いてから置き換え、書き込み途中のファイルを読ませない）"""
+        file_path = self._get_file_path(user_id, guild_id)
+        old_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, file_path)
+        self._record_bytes(os.path.getsize(file_path) - old_size, guild_id, user_id)
+
+    def append(self, user_id: str, guild_id: Optional[str], conversation: Dict) -> Dict:
+        return self._append(user_id, guild_id, [conversation])
+
+    def append_many(self, user_id: str, guild_id: Optional[str], conversations: List[Dict]):
+        self._append(user_id, guild_id, conversations)
+
+    def _append(self, user_id: str, guild_id: Optional[str], conversations: List[Dict]) -> Dict:
+        """ターンを追加して1回で書き込み"""
+        with self._lock:
+            data = self.load(user_id, guild_id)
+            is_new = data is None
+            if is_new:
+                data = self.new_record(user_id, guild_id)
+            before = len(data['conversations'])
+            data['conversations'].extend(conversations)
+
+            # 最新の件数のみ保持（サーバー別で効率化）
+            if len(data['conversations']) > MAX_TURNS:
+                data['conversations'] = data['conversations'][-MAX_TURNS:]
+
+            self._write(user_id, guild_id, data)
+            self._record_change(
+                guild_id, users=int(is_new), conversations=len(data['conversations']) - before, user_id=user_id
+            )
+        return data
+
+    def save_summary(self, user_id: str, guild_id: Optional[str], summary: Dict):
+        with self._lock:
+            data = self.load(user_id, guild_id)
+            if data is None:
+                return
+            data['summary'] = summary
+            self._write(user_id, guild_id, data)
+
+    def save_tokens(self, user_id: str, guild_id: Optional[str], items: List[Dict]):
+        with self._lock:
+            data = self.load(user_id, guild_id)
+            if data is not None and self.apply_tokens(data, items):
+                self._write(user_id, guild_id, data)
+
+    def delete(self, user_id: str, guild_id: Optional[str]):
+        with self._lock:
+            data = self.load(user_id, guild_id)
+            if data is None:
+                return
+            file_path = self._get_file_path(user_id, guild_id)
+            size = os.path.getsize(file_path)
+            os.remove(file_path)
+            self._record_change(
+                guild_id, users=-1, conversations=-len(data.get('conversations', [])), user_id=user_id
+            )
+            self._record_bytes(-size, guild_id, user_id)
+
+    def scan_stats(self) -> Tuple[Dict[str, Dict[str, int]], int]:
+        guilds: Dict[str, Dict[str, int]] = {}
+        nbytes = 0
+        for root, _, files in os.walk(self.memory_path):
+            directory = os.path.basename(root)
+            if directory.startswith('guild_'):
+                guild_id = directory[len('guild_'):]
+            elif directory == 'direct_messages':
+                guild_id = None
+            else:
+                continue
+            counts = guilds.setdefault(guild_id or "", {"users": 0, "conversations": 0})
+            for file in files:
+                if not file.endswith('.json'):
+                    continue
+                users, conversations, size = self.scan_conversation(file[:-len('.json')], guild_id)
+                counts["users"] += users
+                counts["conversations"] += conversations
+                nbytes += size
+        return guilds, nbytes
+
+    def scan_conversation(self, user_id: str, guild_id: Optional[str]) -> Tuple[int, int, int]:
+        with self._lock:
+            self._mark_scanned(user_id, guild_id)
+            file_path = self._get_file_path(user_id, guild_id)
+            if not os.path.exists(file_path):
+                return 0, 0, 0
+            size = os.path.getsize(file_path)
+            try:
+                data = self.load(user_id, guild_id)
+            except Exception as e:
+                print(f"⚠️ {file_path} を読み込めません: {e}")
+                return 0, 0, size
+            return 1, len(data.get('conversations', [])), size
+
+    def guild_stats(self, guild_id: str) -> Dict:
+        server_dir = os.path.join(self.memory_path, f"guild_{guild_id}")
+        total_users = 0
+        total_conversations = 0
+
+        if os.path.exists(server_dir):
+            for file in os.listdir(server_dir):
+                if file.endswith('.json'):
+                    total_users += 1
+                    with open(os.path.join(server_dir, file), 'r', encoding='utf-8') as f:
+                        total_conversations += len(json.load(f).get('conversations', []))
+
+        return {
+            "total_users": total_users,
+            "total_conversations": total_conversations
+        }
+
+    def iter_records(self) -> Iterator[Dict]:
+        """保存されている全ての会話データ（移行用）"""
+        for root, _, files in os.walk(self.memory_path):
+            directory = os.path.basename(root)
+            for file in sorted(files):
+                if not file.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except Exception as e:
+                    print(f"⚠️ {os.path.join(root, file)} を読み込めません: {e}")
+                    continue
+
+                # ユーザーIDとサーバーIDはファイルの場所から補う
+                data.setdefault('user_id', file[:-len('.json')])
+                if 'guild_id' not in data:
+                    data['guild_id'] = directory[len('guild_'):] if directory.startswith('guild_') else None
+                yield data
+
+
+class SQLiteMemoryStorage(MemoryStorage):
+    """SQLite（WALモード）に保存"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS memories (
+            guild_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            summary TEXT,
+            turn_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            user_message TEXT NOT NULL,
+            ai_response TEXT NOT NULL,
+            channel_id TEXT,
+            message_type TEXT,
+            tokens TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_key
+            ON conversations (guild_id, user_id, timestamp);
+    """
+
+    # 古いターンの削除はこの件数を超えて溜まってからまとめて行う
+    TRIM_SLACK = 10
+
+    def __init__(self, db_path: str = "data/bot.db", batch_size: int = 32, commit_interval: float = 1.0):
+        """
+        初期化
+
+        db_path: データベースファイルのパス
+        batch_size: この件数の追記が溜まったらコミット
+        commit_interval: 追記からこの秒数以内にコミット（その間の追記はまとめてコミット）
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # トランザクションは自前で管理（複数の追記を1回のコミットにまとめる）
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.RLock()
+        self._disk_bytes = self._disk_size()
+        self._pending_writes = 0
+        self._flush_timer: Optional[threading.Timer] = None
+
+        # 終了時に未コミットの追記を書き込む
+        atexit.register(self.close)
+
+    @staticmethod
+    def _key(user_id: str, guild_id: Optional[str]) -> Tuple[str, str]:
+        """(guild_id, user_id) のキー（DMはguild_idを空文字で保存）"""
+        return (guild_id or "", user_id)
+
+    def load(self, user_id: str, guild_id: Optional[str]) -> Optional[Dict]:
+        key = self._key(user_id, guild_id)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created_at, summary FROM memories WHERE guild_id = ? AND user_id = ?", key
+            ).fetchone()
+            if row is None:
+                return None
+            rows = self._conn.execute(
+                "SELECT timestamp, user_message, ai_response, channel_id, message_type, tokens "
+                "FROM conversations WHERE guild_id = ? AND user_id = ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                key + (MAX_TURNS,)
+            ).fetchall()
+
+        conversations = []
+        for timestamp, user_message, ai_response, channel_id, message_type, tokens in reversed(rows):
+            conversation = {
+                "timestamp": timestamp,
+                "user": user_message,
+                "assistant": ai_response,
+                "channel_id": channel_id,
+                "type": message_type
+            }
+            if tokens:
+                conversation["tokens"] = json.loads(tokens)
+            conversations.append(conversation)
+
+        data = {
+            "user_id": user_id,
+            "guild_id": guild_id,
+            "created_at": row[0],
+            "conversations": conversations
+        }
+        if row[1]:
+            data["summary"] = json.loads(row[1])
+        return data
+
+    def append(self, user_id: str, guild_id: Optional[str], conversation: Dict) -> Dict:
+        with self._lock:
+            self.append_many(user_id, guild_id, [conversation])
+            return self.load(user_id, guild_id)
+
+    def append_many(self, user_id: str, guild_id: Optional[str], conversations: List[Dict]):
+        key = self._key(user_id, guild_id)
+        with self._lock:
+            self._begin()
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO memories (guild_id, user_id, created_at) VALUES (?, ?, ?)",
+                key + (datetime.now().isoformat(),)
+            )
+            self._insert_rows([key + self._conversation_values(conversation) for conversation in conversations])
+            self._conn.execute(
+                "UPDATE memories SET turn_count = turn_count + ? WHERE guild_id = ? AND user_id = ?",
+                (len(conversations),) + key
+            )
+            turn_count = self._conn.execute(
+                "SELECT turn_count FROM memories WHERE guild_id = ? AND user_id = ?", key
+            ).fetchone()[0]
+            # 会話数はload()が返す件数（削除待ちの古いターンは数えない）
+            self._record_change(
+                guild_id,
+                users=cursor.rowcount,
+                conversations=min(turn_count, MAX_TURNS) - min(turn_count - len(conversations), MAX_TURNS)
+            )
+            if turn_count > MAX_TURNS + self.TRIM_SLACK:
+                self._trim(key)
+
+            self._pending_writes += len(conversations)
+            self._maybe_commit()
+
+    @staticmethod
+    def _conversation_values(conversation: Dict) -> Tuple:
+        """conversationsテーブルの列の値"""
+        return (
+            conversation["timestamp"],
+            conversation.get("user", ""),
+            conversation.get("assistant", ""),
+            conversation.get("channel_id"),
+            conversation.get("type"),
+            json.dumps(conversation["tokens"]) if conversation.get("tokens") else None
+        )
+
+    def _trim(self, key: Tuple[str, str]):
+        """保持件数を超えた古いターンを削除（ロック取得済みで呼ぶ）"""
+        self._conn.execute(
+            "DELETE FROM conversations WHERE guild_id = ? AND user_id = ? AND id NOT IN ("
+            "SELECT id FROM conversations WHERE guild_id = ? AND user_id = ? "
+            "ORDER BY timestamp DESC, id DESC LIMIT ?)",
+            key + key + (MAX_TURNS,)
+        )
+        self._conn.execute(
+            "UPDATE memories SET turn_count = ? WHERE guild_id = ? AND user_id = ?", (MAX_TURNS,) + key
+        )
+
+    def save_summary(self, user_id: str, guild_id: Optional[str], summary: Dict):
+        with self._lock:
+            self._begin()
+            self._conn.execute(
+                "UPDATE memories SET summary = ? WHERE guild_id = ? AND user_id = ?",
+                (json.dumps(summary, ensure_ascii=False),) + self._key(user_id, guild_id)
+            )
+            self._pending_writes += 1
+            self._maybe_commit()
+
+    def save_tokens(self, user_id: str, guild_id: Optional[str], items: List[Dict]):
+        key = self._key(user_id, guild_id)
+        with self._lock:
+            self._begin()
+            # 既存のトークン数（別のトークナイザーの分）に追加
+            rows = []
+            for item in items:
+                if 'timestamp' not in item:
+                    continue
+                row = self._conn.execute(
+                    "SELECT tokens FROM conversations WHERE guild_id = ? AND user_id = ? AND timestamp = ?",
+                    key + (item['timestamp'],)
+                ).fetchone()
+                if row is not None:
+                    tokens = dict(json.loads(row[0]) if row[0] else {}, **item['tokens'])
+                    rows.append((json.dumps(tokens),) + key + (item['timestamp'],))
+            self._conn.executemany(
+                "UPDATE conversations SET tokens = ? WHERE guild_id = ? AND user_id = ? AND timestamp = ?", rows
+            )
+
+            summary_items = [item for item in items if 'updated_at' in item]
+            if summary_items:
+                row = self._conn.execute(
+                    "SELECT summary FROM memories WHERE guild_id = ? AND user_id = ?", key
+                ).fetchone()
+                data = {"summary": json.loads(row[0])} if row is not None and row[0] else {}
+                if self.apply_tokens(data, summary_items):
+                    self._conn.execute(
+                        "UPDATE memories SET summary = ? WHERE guild_id = ? AND user_id = ?",
+                        (json.dumps(data['summary'], ensure_ascii=False),) + key
+                    )
+
+            self._pending_writes += len(items)
+            self._maybe_commit()
+
+    def delete(self, user_id: str, guild_id: Optional[str]):
+        key = self._key(user_id, guild_id)
+        with self._lock:
+            self._begin()
+            row = self._conn.execute(
+                "SELECT turn_count FROM memories WHERE guild_id = ? AND user_id = ?", key
+            ).fetchone()
+            self._conn.execute("DELETE FROM conversations WHERE guild_id = ? AND user_id = ?", key)
+            self._conn.execute("DELETE FROM memories WHERE guild_id = ? AND user_id = ?", key)
+            if row is not None:
+                self._record_change(guild_id, users=-1, conversations=-min(row[0], MAX_TURNS))
+            # ユーザーが明示的に削除した履歴はすぐに反映
+            self._commit()
+
+    def guild_stats(self, guild_id: str) -> Dict:
+        with self._lock:
+            total_users, total_conversations = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(MIN(turn_count, ?)), 0) FROM memories WHERE guild_id = ?",
+                (MAX_TURNS, guild_id)
+            ).fetchone()
+        return {
+            "total_users": total_users,
+            "total_conversations": total_conversations
+        }
+
+    def import_records(self, records: Iterable[Dict], batch_size: int = 500) -> Tuple[int, int, int]:
+        """
+        会話データをまとめて取り込む（移行用、既に存在する会話は飛ばす）
+
+        戻り値: (取り込んだ会話数, 取り込んだターン数, 飛ばした会話数)
+        """
+        imported = turns = skipped = 0
+        rows = []
+        with self._lock:
+            self._begin()
+            for data in records:
+                key = self._key(str(data['user_id']), data.get('guild_id'))
+                conversations = data.get('conversations', [])[-MAX_TURNS:]
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO memories (guild_id, user_id, created_at, summary, turn_count) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    key + (
+                        data.get('created_at') or datetime.now().isoformat(),
+                        json.dumps(data['summary'], ensure_ascii=False) if data.get('summary') else None,
+                        len(conversations)
+                    )
+                )
+                if cursor.rowcount == 0:
+                    skipped += 1
+                    continue
+
+                rows.extend(key + self._conversation_values(conversation) for conversation in conversations)
+                self._record_change(key[0], users=1, conversations=len(conversations))
+                imported += 1
+                turns += len(conversations)
+                if len(rows) >= batch_size:
+                    self._insert_rows(rows)
+                    rows = []
+            self._insert_rows(rows)
+            self._commit()
+        return imported, turns, skipped
+
+    def _insert_rows(self, rows):
+        """ターンをまとめて挿入（ロック取得済みで呼ぶ）"""
+        if rows:
+            self._conn.executemany(
+                "INSERT INTO conversations (guild_id, user_id, timestamp, user_message, ai_response, "
+                "channel_id, message_type, tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def _begin(self):
+        """トランザクションを開始（開始済みなら何もしない、ロック取得済みで呼ぶ）"""
+        if not self._conn.in_transaction:
+            self._conn.execute("BEGIN")
+
+    def _maybe_commit(self):
+        """追記が溜まっていればコミット、そうでなければcommit_interval後にコミット（ロック取得済みで呼ぶ）"""
+        if self._pending_writes >= self.batch_size:
+            self._commit()
+        elif self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.commit_interval, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _commit(self):
+        """コミット（ロック取得済みで呼ぶ）"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._conn.in_transaction:
+            self._conn.execute("COMMIT")
+        self._pending_writes = 0
+
+        disk_bytes = self._disk_size()
+        self._record_bytes(disk_bytes - self._disk_bytes)
+        self._disk_bytes = disk_bytes
+
+    def _disk_size(self) -> int:
+        """データベースとWALファイルの合計サイズ"""
+        return sum(
+            os.path.getsize(path) for path in (self.db_path, self.db_path + "-wal") if os.path.exists(path)
+        )
+
+    def scan_stats(self) -> Tuple[Dict[str, Dict[str, int]], int]:
+        guilds: Dict[str, Dict[str, int]] = {}
+        with self._lock:
+            for guild_id, users in self._conn.execute("SELECT guild_id, COUNT(*) FROM memories GROUP BY guild_id"):
+                guilds.setdefault(guild_id, {"users": 0, "conversations": 0})["users"] = users
+            # 会話数はload()が返す件数（会話ごとにMAX_TURNSまで、削除待ちの古いターンは数えない）
+            for guild_id, turns in self._conn.execute(
+                "SELECT guild_id, SUM(MIN(turns, ?)) FROM ("
+                "SELECT guild_id, COUNT(*) AS turns FROM conversations GROUP BY guild_id, user_id"
+                ") GROUP BY guild_id",
+                (MAX_TURNS,)
+            ):
+                guilds.setdefault(guild_id, {"users": 0, "conversations": 0})["conversations"] = turns
+            # 読み込みまでの変更は結果に含まれ、以降の変更だけを足す
+            self._scan_snapshot()
+            self._disk_bytes = self._disk_size()
+            return guilds, self._disk_bytes
+
+    def scan_conversation(self, user_id: str, guild_id: Optional[str]) -> Tuple[int, int, int]:
+        key = self._key(user_id, guild_id)
+        with self._lock:
+            self._mark_scanned(user_id, guild_id)
+            users = self._conn.execute(
+                "SELECT COUNT(*) FROM memories WHERE guild_id = ? AND user_id = ?", key
+            ).fetchone()[0]
+            turns = self._conn.execute(
+                "SELECT MIN(COUNT(*), ?) FROM conversations WHERE guild_id = ? AND user_id = ?", (MAX_TURNS,) + key
+            ).fetchone()[0]
+        # ディスク使用量はデータベース全体でscan_statsに含まれる
+        return users, turns, 0
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            try:
+                self._commit()
+                self._conn.close()
+            except sqlite3.ProgrammingError:
+                # 既に閉じている
+                pass
+
+
+class SegmentMemoryStorage(MemoryStorage):
+    """
+    会話ごとの追記専用セグメント（JSON Lines）に保存
+
+    ターンの追加はアクティブなセグメントへの1行の追記（write 1回）で、履歴の量によらず一定。
+    最新のターンはセグメントの末尾から逆向きに読み、全体を読み込まない。
+    セグメントが増えた会話はバックグラウンドでまとめ直し、保持件数を超えた古いターンを削除する
+
+    保存形式（<memory_path>/guild_<id>/<user_id>/、DMは direct_messages/<user_id>/）:
+      meta.json      作成日時と要約
+      000001.jsonl   1行1ターン {"turn": {...}}。まとめ直したセグメントは先頭行が {"base": {...}} で、
+                     それより古いセグメントは読まない（まとめ直し途中で止まっても重複しない）
+    """
+
+    # 会話ごとのロック（キーのハッシュで割り当てる数）
+    LOCK_STRIPES = 64
+    # 末尾から読む単位（バイト）
+    READ_BLOCK = 8192
+
+    def __init__(
+        self,
+        memory_path: str = "data/conversations/segments/",
+        retention: int = 2000,
+        segment_bytes: int = 256 * 1024,
+        max_segments: int = 8,
+        compact_interval: float = 300.0
+    ):
+        """
+        初期化
+
+        memory_path: 保存先のディレクトリ
+        retention: 1会話あたりに保持するターン数（まとめ直しの時に古いターンを削除）
+        segment_bytes: アクティブなセグメントがこのサイズを超えたら次のセグメントに追記
+        max_segments: セグメントがこの数を超えた会話をまとめ直す
+        compact_interval: まとめ直しを実行する間隔（秒）
+        """
+        self.memory_path = memory_path
+        self.retention = retention
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.compact_interval = compact_interval
+        os.makedirs(self.memory_path, exist_ok=True)
+
+        self._stripes = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._lock = threading.Lock()
+        # 会話 → (アクティブなセグメントのパス, サイズ, 読む対象のセグメント数, 読み込み範囲のターン数)
+        self._active: Dict[Tuple[str, Optional[str]], Tuple[str, int, int, int]] = {}
+        # まとめ直しの対象の会話
+        self._compact_candidates = set()
+
+        self._stop = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_loop, name="memory-compactor", daemon=True)
+        self._compactor.start()
+
+    def _stripe(self, key: Hashable) -> threading.Lock:
+        """会話のロック"""
+        return self._stripes[hash(key) % self.LOCK_STRIPES]
+
+    def _conversation_dir(self, user_id: str, guild_id: Optional[str]) -> str:
+        """会話のディレクトリ（サーバー別）"""
+        parent = f"guild_{guild_id}" if guild_id else "direct_messages"
+        return os.path.join(self.memory_path, parent, str(user_id))
+
+    @staticmethod
+    def _segment_name(index: int) -> str:
+        return f"{index:06d}.jsonl"
+
+    @staticmethod
+    def _list_segments(directory: str) -> List[str]:
+        """セグメントのパス（古い順）"""
+        if not os.path.isdir(directory):
+            return []
+        return [
+            os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.endswith('.jsonl')
+        ]
+
+    def _read_meta(self, directory: str) -> Optional[Dict]:
+        meta_path = os.path.join(directory, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_meta(self, directory: str, meta: Dict, user_id: str, guild_id: Optional[str]):
+        """meta.jsonを書き込み（一時ファイルに書いてから置き換え、会話のロック取得済みで呼ぶ）"""
+        meta_path = os.path.join(directory, "meta.json")
+        old_size = os.path.getsize(meta_path) if os.path.exists(meta_path) else 0
+        temp_path = meta_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, meta_path)
+        self._record_bytes(os.path.getsize(meta_path) - old_size, guild_id, user_id)
+
+    @classmethod
+    def _reverse_lines(cls, path: str) -> Iterator[bytes]:
+        """ファイルの行を末尾から順に返す（末尾側のブロックだけを読む）"""
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b''
+            while position > 0:
+                step = min(cls.READ_BLOCK, position)
+                position -= step
+                f.seek(position)
+                lines = (f.read(step) + remainder).split(b'\n')
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line:
+                        yield line
+            if remainder:
+                yield remainder
+
+    @staticmethod
+    def _parse_line(line: bytes) -> Optional[Dict]:
+        """セグメントの1行（書き込み途中で壊れた行はNone）"""
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    def _tail_turns(self, directory: str, count: Optional[int]) -> List[Dict]:
+        """最新のターンを末尾から読む（countがNoneなら保持している全て、古い順で返す）"""
+        turns: List[Dict] = []
+        for path in reversed(self._list_segments(directory)):
+            for line in self._reverse_lines(path):
+                record = self._parse_line(line)
+                if record is None:
+                    continue
+                if 'base' in record:
+                    return turns[::-1]
+                if 'turn' in record:
+                    turns.append(record['turn'])
+                    if count is not None and len(turns) >= count:
+                        return turns[::-1]
+        return turns[::-1]
+
+    def load(self, user_id: str, guild_id: Optional[str]) -> Optional[Dict]:
+        directory = self._conversation_dir(user_id, guild_id)
+        with self._stripe((user_id, guild_id)):
+            meta = self._read_meta(directory)
+            if meta is None:
+                return None
+            conversations = self._tail_turns(directory, MAX_TURNS)
+
+        data = {
+            "user_id": user_id,
+            "guild_id": guild_id,
+            "created_at": meta.get("created_at"),
+            "conversations": conversations
+        }
+        if meta.get("summary"):
+            data["summary"] = meta["summary"]
+        # 追記済みの行は書き換えないため、後から数えたトークン数はmeta.jsonから反映
+        if meta.get("tokens"):
+            self.apply_tokens(data, [
+                {"timestamp": timestamp, "tokens": tokens} for timestamp, tokens in meta["tokens"].items()
+            ])
+        return data
+
+    def load_history(self, user_id: str, guild_id: Optional[str]) -> List[Dict]:
+        with self._stripe((user_id, guild_id)):
+            return self._tail_turns(self._conversation_dir(user_id, guild_id), self.retention)
+
+    def _active_segment(self, key: Tuple[str, Optional[str]], directory: str) -> Tuple[str, int, int, int]:
+        """
+        追記先のセグメント（会話のロック取得済みで呼ぶ）
+
+        ターン数はload()が返す件数（MAX_TURNSまで）で、統計の会話数に使う（末尾のMAX_TURNS件だけ読んで数える）
+        """
+        active = self._active.get(key)
+        if active is not None:
+            return active
+
+        segments = self._list_segments(directory)
+        if not segments:
+            active = (os.path.join(directory, self._segment_name(1)), 0, 1, 0)
+        else:
+            path = segments[-1]
+            size = os.path.getsize(path)
+            if size:
+                # 前回の書き込みが途中で止まっていたら、次の行と繋がらないよう改行を補う
+                with open(path, 'rb+') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')
+                        size += 1
+            active = (path, size, len(segments), len(self._tail_turns(directory, MAX_TURNS)))
+            if len(segments) > self.max_segments:
+                with self._lock:
+                    self._compact_candidates.add(key)
+        self._active[key] = active
+        return active
+
+    def append(self, user_id: str, guild_id: Optional[str], conversation: Dict) -> Dict:
+        self.append_many(user_id, guild_id, [conversation])
+        return self.load(user_id, guild_id)
+
+    def append_many(self, user_id: str, guild_id: Optional[str], conversations: List[Dict]):
+        key = (user_id, guild_id)
+        directory = self._conversation_dir(user_id, guild_id)
+        payload = "".join(
+            json.dumps({"turn": conversation}, ensure_ascii=False) + "\n" for conversation in conversations
+        ).encode('utf-8')
+
+        with self._stripe(key):
+            if not os.path.exists(os.path.join(directory, "meta.json")):
+                os.makedirs(directory, exist_ok=True)
+                self._write_meta(directory, {"created_at": datetime.now().isoformat()}, user_id, guild_id)
+                self._record_change(guild_id, users=1, user_id=user_id)
+
+            path, size, segments, turns = self._active_segment(key, directory)
+            if size >= self.segment_bytes:
+                # 次のセグメントに切り替え
+                index = int(os.path.basename(path)[:-len('.jsonl')]) + 1
+                path, size, segments = os.path.join(directory, self._segment_name(index)), 0, segments + 1
+                if segments > self.max_segments:
+                    with self._lock:
+                        self._compact_candidates.add(key)
+
+            # 1回のwriteで追記
+            with open(path, 'ab') as f:
+                f.write(payload)
+            visible = min(turns + len(conversations), MAX_TURNS)
+            self._active[key] = (path, size + len(payload), segments, visible)
+            self._record_change(guild_id, conversations=visible - turns, user_id=user_id)
+            self._record_bytes(len(payload), guild_id, user_id)
+
+    def save_summary(self, user_id: str, guild_id: Optional[str], summary: Dict):
+        directory = self._conversation_dir(user_id, guild_id)
+        with self._stripe((user_id, guild_id)):
+            meta = self._read_meta(directory)
+            if meta is None:
+                return
+            meta["summary"] = summary
+            self._write_meta(directory, meta, user_id, guild_id)
+
+    def save_tokens(self, user_id: str, guild_id: Optional[str], items: List[Dict]):
+        directory = self._conversation_dir(user_id, guild_id)
+        with self._stripe((user_id, guild_id)):
+            meta = self._read_meta(directory)
+            if meta is None:
+                return
+            # 読み込み範囲のターンの分だけ残す（meta.jsonが履歴の量に比例して大きくならない）
+            timestamps = {turn.get('timestamp') for turn in self._tail_turns(directory, MAX_TURNS)}
+            stored = {
+                timestamp: tokens for timestamp, tokens in meta.get("tokens", {}).items() if timestamp in timestamps
+            }
+            for item in items:
+                if item.get('timestamp') in timestamps:
+                    stored[item['timestamp']] = dict(stored.get(item['timestamp'], {}), **item['tokens'])
+            meta["tokens"] = stored
+            summary_data = {"summary": meta["summary"]} if meta.get("summary") else {}
+            if self.apply_tokens(summary_data, items):
+                meta["summary"] = summary_data["summary"]
+            self._write_meta(directory, meta, user_id, guild_id)
+
+    def delete(self, user_id: str, guild_id: Optional[str]):
+        key = (user_id, guild_id)
+        with self._stripe(key):
+            directory = self._conversation_dir(user_id, guild_id)
+            if not os.path.isdir(directory):
+                return
+            turns = self._active[key][3] if key in self._active else len(self._tail_turns(directory, MAX_TURNS))
+            size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+            shutil.rmtree(directory)
+            self._active.pop(key, None)
+            self._record_change(guild_id, users=-1, conversations=-turns, user_id=user_id)
+            self._record_bytes(-size, guild_id, user_id)
+        with self._lock:
+            self._compact_candidates.discard(key)
+
+    def guild_stats(self, guild_id: str) -> Dict:
+        server_dir = os.path.join(self.memory_path, f"guild_{guild_id}")
+        total_users = 0
+        total_conversations = 0
+
+        if os.path.exists(server_dir):
+            for user_id in os.listdir(server_dir):
+                data = self.load(user_id, guild_id)
+                if data is not None:
+                    total_users += 1
+                    total_conversations += len(data['conversations'])
+
+        return {
+            "total_users": total_users,
+            "total_conversations": total_conversations
+        }
+
+    def _compact_loop(self):
+        """一定間隔でセグメントの増えた会話をまとめ直すループ"""
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"会話履歴のまとめ直しエラー: {e}")
+
+    def compact(self):
+        """セグメントの増えた会話をまとめ直す"""
+        with self._lock:
+            keys = list(self._compact_candidates)
+            self._compact_candidates.clear()
+        for user_id, guild_id in keys:
+            self._compact_conversation(user_id, guild_id)
+
+    def _compact_conversation(self, user_id: str, guild_id: Optional[str]):
+        """
+        1会話のセグメントを1つにまとめ、保持件数を超えた古いターンを削除
+
+        まとめたセグメントは一時ファイルに書いてから新しい番号で置き換えるため、
+        途中で止まっても履歴を失わず、読み込みも先頭行のbaseから先の古いセグメントを読まない
+        """
+        key = (user_id, guild_id)
+        directory = self._conversation_dir(user_id, guild_id)
+        with self._stripe(key):
+            segments = self._list_segments(directory)
+            if len(segments) <= 1:
+                return
+            turns = self._tail_turns(directory, None)
+            kept = turns[-self.retention:]
+
+            index = int(os.path.basename(segments[-1])[:-len('.jsonl')]) + 1
+            path = os.path.join(directory, self._segment_name(index))
+            lines = [json.dumps({"base": {"compacted_at": datetime.now().isoformat()}}) + "\n"]
+            lines.extend(json.dumps({"turn": turn}, ensure_ascii=False) + "\n" for turn in kept)
+            payload = "".join(lines).encode('utf-8')
+            temp_path = path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_path, path)
+
+            old_size = sum(os.path.getsize(old_path) for old_path in segments)
+            for old_path in segments:
+                os.remove(old_path)
+            visible = min(len(kept), MAX_TURNS)
+            self._active[key] = (path, len(payload), 1, visible)
+            self._record_change(guild_id, conversations=visible - min(len(turns), MAX_TURNS), user_id=user_id)
+            self._record_bytes(len(payload) - old_size, guild_id, user_id)
+
+    def import_records(self, records: Iterable[Dict]) -> Tuple[int, int, int]:
+        """
+        会話データをまとめて取り込む（移行用、既に存在する会話は飛ばす）
+
+        戻り値: (取り込んだ会話数, 取り込んだターン数, 飛ばした会話数)
+        """
+        imported = turns = skipped = 0
+        for data in records:
+            user_id, guild_id = str(data['user_id']), data.get('guild_id')
+            directory = self._conversation_dir(user_id, guild_id)
+            if os.path.exists(os.path.join(directory, "meta.json")):
+                skipped += 1
+                continue
+
+            os.makedirs(directory, exist_ok=True)
+            conversations = data.get('conversations', [])[-self.retention:]
+            if conversations:
+                self.append_many(user_id, guild_id, conversations)
+            meta = {"created_at": data.get('created_at') or datetime.now().isoformat()}
+            if data.get('summary'):
+                meta["summary"] = data['summary']
+            with self._stripe((user_id, guild_id)):
+                # ターンのない会話はappend_manyを通らないため、ここでユーザー数に数える
+                is_new = not os.path.exists(os.path.join(directory, "meta.json"))
+                self._write_meta(directory, meta, user_id, guild_id)
+                if is_new:
+                    self._record_change(guild_id, users=1, user_id=user_id)
+            imported += 1
+            turns += len(conversations)
+        return imported, turns, skipped
+
+    def scan_stats(self) -> Tuple[Dict[str, Dict[str, int]], int]:
+        guilds: Dict[str, Dict[str, int]] = {}
+        nbytes = 0
+        for parent in os.listdir(self.memory_path):
+            if parent.startswith("guild_"):
+                guild_key = parent[len("guild_"):]
+            elif parent == "direct_messages":
+                guild_key = ""
+            else:
+                continue
+            counts = guilds.setdefault(guild_key, {"users": 0, "conversations": 0})
+            for user_id in os.listdir(os.path.join(self.memory_path, parent)):
+                users, conversations, size = self.scan_conversation(user_id, guild_key or None)
+                counts["users"] += users
+                counts["conversations"] += conversations
+                nbytes += size
+        return guilds, nbytes
+
+    def scan_conversation(self, user_id: str, guild_id: Optional[str]) -> Tuple[int, int, int]:
+        directory = self._conversation_dir(user_id, guild_id)
+        with self._stripe((user_id, guild_id)):
+            self._mark_scanned(user_id, guild_id)
+            if not os.path.isdir(directory):
+                return 0, 0, 0
+            size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+            if not os.path.exists(os.path.join(directory, "meta.json")):
+                return 0, 0, size
+            return 1, len(self._tail_turns(directory, MAX_TURNS)), size
+
+    def close(self):
+        self._stop.set()
+
+
+class CachedMemoryStorage(MemoryStorage):
+    """
+    ライトバックキャッシュ（よく使われる会話をメモリ上に保持し、変更はまとめて書き込む）
+
+    キャッシュにある会話の読み込みはディスクに触れない。追記・要約の保存はキャッシュを更新して
+    未書き込みとして記録し、flush_interval秒後（と終了時）にまとめて保存先に書き込む。
+    同じ会話への操作は会話ごとのロックで直列化する（/chatと自動応答が同時でもターンを失わない）。
+    キャッシュの会話データは置き換えるだけで変更しないため、読み込みの結果は浅いコピーで済む
+    """
+
+    # 会話ごとのロック（キーのハッシュで割り当てる数）
+    LOCK_STRIPES = 64
+
+    def __init__(self, backend: MemoryStorage, max_entries: int = 1024, flush_interval: float = 5.0):
+        """
+        初期化
+
+        backend: 書き込み先のバックエンド
+        max_entries: 保持する最大会話数（超えたら最も古く使われた書き込み済みの会話から削除）
+        flush_interval: 変更からこの秒数後にまとめて書き込む
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+
+        # (user_id, guild_id) → 会話データ（保存先に存在しない会話はNone）
+        self._entries: "OrderedDict[Hashable, Optional[Dict]]" = OrderedDict()
+        # 未書き込みの変更: (user_id, guild_id) → {"turns": [...], "summary": {...}（ある場合）}
+        self._dirty: Dict[Hashable, Dict] = {}
+        # 書き込み中の会話（書き込みが終わるまでキャッシュから削除しない）
+        self._flushing = set()
+        # 会話ごとの削除回数（書き込みに失敗した変更を、その間に削除された会話へ戻さないため）
+        self._delete_generations: Dict[Hashable, int] = {}
+
+        self._lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        # 保存先への書き込み・削除の順序を守るロック
+        self._write_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        self._closed = False
+
+        # 統計
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.turns_flushed = 0
+        self.write_errors = 0
+
+        # 終了時に未書き込みの変更を書き込む
+        atexit.register(self.close)
+
+    def _stripe(self, key: Hashable) -> threading.Lock:
+        """会話のロック"""
+        return self._stripes[hash(key) % self.LOCK_STRIPES]
+
+    def _cached(self, key: Hashable) -> Optional[Dict]:
+        """キャッシュから取得（なければ保存先から読み込んで保持、会話のロック取得済みで呼ぶ）"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        data = self.backend.load(*key)
+        self._store(key, data)
+        return data
+
+    def _store(self, key: Hashable, data: Optional[Dict]):
+        """キャッシュに保持（上限を超えたら書き込み済みの古いものから削除）"""
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            excess = len(self._entries) - self.max_entries
+            if excess <= 0:
+                return
+            # 未書き込みの会話は削除できないため、一時的に上限を超えることがある
+            evictable = [
+                oldest for oldest in self._entries
+                if oldest != key and oldest not in self._dirty and oldest not in self._flushing
+            ][:excess]
+            for oldest in evictable:
+                del self._entries[oldest]
+                self.evictions += 1
+
+    def _mark_dirty(
+        self,
+        key: Hashable,
+        turns: List[Dict] = (),
+        summary: Optional[Dict] = None,
+        tokens: List[Dict] = ()
+    ):
+        """未書き込みの変更を記録し、書き込みを予約"""
+        with self._lock:
+            changes = self._dirty.setdefault(key, {"turns": []})
+            changes["turns"].extend(turns)
+            if summary is not None:
+                changes["summary"] = summary
+            if tokens:
+                changes.setdefault("tokens", []).extend(tokens)
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    @staticmethod
+    def _copy(data: Optional[Dict]) -> Optional[Dict]:
+        """呼び出し側が変更してもキャッシュに影響しないコピー"""
+        return dict(data) if data is not None else None
+
+    def load(self, user_id: str, guild_id: Optional[str]) -> Optional[Dict]:
+        key = (user_id, guild_id)
+        with self._stripe(key):
+            return self._copy(self._cached(key))
+
+    def append(self, user_id: str, guild_id: Optional[str], conversation: Dict) -> Dict:
+        key = (user_id, guild_id)
+        with self._stripe(key):
+            data = self._cached(key) or self.new_record(user_id, guild_id)
+            data = dict(data, conversations=(data['conversations'] + [conversation])[-MAX_TURNS:])
+            self._store(key, data)
+            self._mark_dirty(key, turns=[conversation])
+        return self._copy(data)
+
+    def load_history(self, user_id: str, guild_id: Optional[str]) -> List[Dict]:
+        # キャッシュには最新のターンしかないため、書き込んでから保存先から読む
+        self.flush()
+        return self.backend.load_history(user_id, guild_id)
+
+    def save_summary(self, user_id: str, guild_id: Optional[str], summary: Dict):
+        key = (user_id, guild_id)
+        with self._stripe(key):
+            data = self._cached(key)
+            if data is None:
+                return
+            self._store(key, dict(data, summary=summary))
+            self._mark_dirty(key, summary=summary)
+
+    def save_tokens(self, user_id: str, guild_id: Optional[str], items: List[Dict]):
+        key = (user_id, guild_id)
+        with self._stripe(key):
+            data = self._cached(key)
+            if data is None:
+                return
+            data = dict(data)
+            if self.apply_tokens(data, items):
+                self._store(key, data)
+                self._mark_dirty(key, tokens=items)
+
+    def delete(self, user_id: str, guild_id: Optional[str]):
+        key = (user_id, guild_id)
+        with self._stripe(key):
+            with self._lock:
+                self._dirty.pop(key, None)
+                self._delete_generations[key] = self._delete_generations.get(key, 0) + 1
+            self._store(key, None)
+            # 書き込み中の変更より後に削除する
+            self._write_lock.acquire()
+        try:
+            self.backend.delete(user_id, guild_id)
+        finally:
+            self._write_lock.release()
+
+    def guild_stats(self, guild_id: str) -> Dict:
+        self.flush()
+        return self.backend.guild_stats(guild_id)
+
+    def set_stats(self, stats):
+        # 件数・サイズは書き込み時にバックエンドが記録する
+        self.backend.set_stats(stats)
+
+    def scan_stats(self) -> Tuple[Dict[str, Dict[str, int]], int]:
+        self.flush()
+        return self.backend.scan_stats()
+
+    def scan_conversation(self, user_id: str, guild_id: Optional[str]) -> Tuple[int, int, int]:
+        self.flush()
+        return self.backend.scan_conversation(user_id, guild_id)
+
+    def flush(self):
+        """未書き込みの変更を会話ごとにまとめて書き込む"""
+        with self._flush_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                keys = list(self._dirty)
+
+            for key in keys:
+                with self._stripe(key):
+                    with self._lock:
+                        changes = self._dirty.pop(key, None)
+                        if changes is None:
+                            continue
+                        self._flushing.add(key)
+                        generation = self._delete_generations.get(key, 0)
+                    # 次の削除・書き込みがこの書き込みを追い越さないよう、会話のロック中に取得
+                    self._write_lock.acquire()
+                try:
+                    self._write_changes(key, changes, generation)
+                finally:
+                    self._write_lock.release()
+                    with self._lock:
+                        self._flushing.discard(key)
+
+            try:
+                self.backend.flush()
+            except Exception as e:
+                print(f"会話履歴の書き込みエラー: {e}")
+
+    def _write_changes(self, key: Hashable, changes: Dict, generation: int):
+        """
+        1会話分の変更を書き込み（失敗した変更は次回に再試行）
+
+        generation: 変更を取り出した時点の会話の削除回数（書き込み中に削除された場合は再試行しない）
+        """
+        turns = changes["turns"]
+        summary = changes.get("summary")
+        try:
+            if turns:
+                self.backend.append_many(*key, turns)
+                turns = []
+            if summary is not None:
+                self.backend.save_summary(*key, summary)
+            if changes.get("tokens"):
+                self.backend.save_tokens(*key, changes["tokens"])
+            with self._lock:
+                self.flushes += 1
+                self.turns_flushed += len(changes["turns"])
+        except Exception as e:
+            print(f"会話履歴の書き込みエラー: {e}")
+            with self._lock:
+                self.write_errors += 1
+                # 書き込み中に削除された会話の変更は破棄（削除待ちの間に戻すと削除後に書き込まれる）
+                if self._delete_generations.get(key, 0) != generation:
+                    return
+                # 失敗した変更を、書き込み中に追加された変更より前に戻す
+                newer = self._dirty.get(key, {"turns": []})
+                retry = {"turns": turns + newer["turns"]}
+                if "summary" in newer or summary is not None:
+                    retry["summary"] = newer.get("summary", summary)
+                # トークン数は読み込み時に数え直せるため、失敗した分は再試行しない
+                if newer.get("tokens"):
+                    retry["tokens"] = newer["tokens"]
+                self._dirty[key] = retry
+            self._mark_dirty(key)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.flush()
+        self.backend.close()
+
+    def get_stats(self) -> Dict:
+        """キャッシュの統計を取得"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "dirty": len(self._dirty),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "flushes": self.flushes,
+                "turns_flushed": self.turns_flushed,
+                "write_errors": self.write_errors
+            }
+
+
+def create_storage(backend: str) -> MemoryStorage:
+    """設定値からバックエンドを作成（MEMORY_CACHE_MAX_ENTRIESが0より大きければキャッシュで包む）"""
+    from config import Config
+    if backend == BACKEND_SQLITE:
+        storage = SQLiteMemoryStorage(Config.DATABASE_PATH)
+    elif backend == BACKEND_SEGMENT:
+        storage = SegmentMemoryStorage(
+            retention=Config.MEMORY_RETENTION_TURNS,
+            compact_interval=Config.MEMORY_COMPACT_INTERVAL
+        )
+    else:
+        if backend != BACKEND_JSON:
+            print(f"⚠️ 不明な保存先 '{backend}' のためjsonを使用します")
+        storage = JsonMemoryStorage()
+
+    if Config.MEMORY_CACHE_MAX_ENTRIES > 0:
+        return CachedMemoryStorage(
+            storage,
+            max_entries=Config.MEMORY_CACHE_MAX_ENTRIES,
+            flush_interval=Config.MEMORY_FLUSH_INTERVAL
+        )
+    return storage
@@ -0,0 +1,201 @@
+"""
+パターンフィルター - 不適切なパターンを生成中に出させないLogitsProcessor
+
+_clean_responseで応答ごと破棄される文字列（http, blog など）を、トークン列の
+前方一致で追跡し、パターンを完成させるトークンをデコード中に禁止する。
+禁止するパターンはサーバーごとに設定できる
+"""
+
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+
+# PyTorchとTransformersのインポートを安全に行う
+try:
+    from transformers import LogitsProcessor
+except ImportError:
+    LogitsProcessor = object
+
+# 応答として不適切なパターン（含まれる応答は破棄）
+BLOCKED_PATTERNS = [
+    'http', 'www.', 'chatroom', 'website', 'translation',
+    'contact me', 'support', 'blog', 'english'
+]
+
+
+class PatternTokenIndex:
+    """語彙の各トークン文字列から、パターンを完成させるトークンを引く索引"""
+
+    def __init__(self, tokenizer):
+        """
+        初期化
+
+        tokenizer: 語彙を取得するトークナイザー
+        """
+        self.tokenizer = tokenizer
+        self._token_texts: Optional[List[str]] = None
+        self._completions: Dict[str, List[List[int]]] = {}
+        self._lock = threading.Lock()
+
+    def _texts(self) -> List[str]:
+        """語彙の各トークンの文字列（小文字、初回のみデコード）"""
+        if self._token_texts is None:
+            special_ids = set(self.tokenizer.all_special_ids)
+            self._token_texts = [
+                "" if token_id in special_ids else self.tokenizer.decode([token_id]).lower()
+                for token_id in range(len(self.tokenizer))
+            ]
+        return self._token_texts
+
+    def completions(self, pattern: str) -> List[List[int]]:
+        """
+        パターンを完成させるトークンIDの一覧（語彙全体を走査するため、
+        生成中に初めて呼ばれないよう prepare で事前に作っておく）
+
+        戻り値のk番目: パターンの先頭k文字まで出力済みのときに禁止するトークン
+        （0番目はパターン全体を含むトークンで、常に禁止する）
+        """
+        with self._lock:
+            if pattern not in self._completions:
+                result: List[List[int]] = [[] for _ in pattern]
+                for token_id, text in enumerate(self._texts()):
+                    if not text:
+                        continue
+                    if pattern in text:
+                        result[0].append(token_id)
+                        continue
+                    for k in range(1, len(pattern)):
+                        if text.startswith(pattern[k:]):
+                            result[k].append(token_id)
+                self._completions[pattern] = result
+            return self._completions[pattern]
+
+    def prepare(self, patterns: Sequence[str]):
+        """パターンの索引を事前に作成（ウォームアップ時・パターン追加時に呼ぶ）"""
+        for pattern in patterns:
+            self.completions(pattern)
+
+
+class BlockedPatternLogitsProcessor(LogitsProcessor):
+    """行ごとの禁止パターンを完成させるトークンを禁止するLogitsProcessor"""
+
+    def __init__(self, index: PatternTokenIndex, row_patterns: List[Sequence[str]], prompt_length: int):
+        """
+        初期化
+
+        index: パターンとトークンの索引
+        row_patterns: バッチの行ごとの禁止パターン（空の行はフィルターなし）
+        prompt_length: 左詰めパディング後のプロンプト長（生成部分の開始位置）
+        """
+        self.index = index
+        self.row_patterns = row_patterns
+        self.prompt_length = prompt_length
+        self.tail_tokens = max((len(pattern) for patterns in row_patterns for pattern in patterns), default=0)
+
+        # パターンの途中まで出力された状態で続きを禁止した回数
+        self.interventions = 0
+
+    def __call__(self, input_ids, scores):
+        for row, patterns in enumerate(self.row_patterns):
+            if not patterns:
+                continue
+            tail = self._tail(input_ids, row)
+
+            banned = set()
+            intervened = False
+            for pattern in patterns:
+                completions = self.index.completions(pattern)
+                banned.update(completions[0])
+                for k in range(1, len(pattern)):
+                    if completions[k] and tail.endswith(pattern[:k]):
+                        banned.update(completions[k])
+                        intervened = True
+
+            if banned:
+                scores[row, list(banned)] = -float('inf')
+            # 行ごと・ステップごとに1回（複数のパターン・長さが一致しても1回）
+            if intervened:
+                self.interventions += 1
+        return scores
+
+    def _tail(self, input_ids, row: int) -> str:
+        """生成済み部分の末尾（最長パターンの文字数分のトークン）を小文字で取得"""
+        start = max(self.prompt_length, input_ids.shape[1] - self.tail_tokens)
+        if start >= input_ids.shape[1]:
+            return ""
+        return self.index.tokenizer.decode(input_ids[row, start:], skip_special_tokens=True).lower()
+
+
+class BlockedPatternSettings:
+    """サーバーごとの禁止パターン設定"""
+
+    def __init__(self):
+        """初期化"""
+        self.config_path = "data/config/blocked_patterns.json"
+        # サーバーID → {"disabled": 無効にした既定パターン, "extra": 追加パターン}
+        self.guilds: Dict[str, Dict[str, List[str]]] = {}
+        self._load_config()
+
+    def _load_config(self):
+        """設定ファイルの読み込み"""
+        try:
+            if os.path.exists(self.config_path):
+                with open(self.config_path, 'r', encoding='utf-8') as f:
+                    self.guilds = json.load(f).get('guilds', {})
+        except Exception as e:
+            print(f"禁止パターン設定の読み込みエラー: {e}")
+            self.guilds = {}
+
+    def _save_config(self):
+        """設定ファイルの保存"""
+        try:
+            os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
+            with open(self.config_path, 'w', encoding='utf-8') as f:
+                json.dump({'guilds': self.guilds}, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"禁止パターン設定の保存エラー: {e}")
+
+    def get_patterns(self, guild_id: Optional[str]) -> List[str]:
+        """サーバーで有効な禁止パターン（DMは既定のパターン）"""
+        settings = self.guilds.get(guild_id or "", {})
+        disabled = set(settings.get('disabled', []))
+        patterns = [pattern for pattern in BLOCKED_PATTERNS if pattern not in disabled]
+        return patterns + [pattern for pattern in settings.get('extra', []) if pattern not in patterns]
+
+    def all_patterns(self) -> List[str]:
+        """いずれかのサーバーで使われうる禁止パターン（既定＋追加）"""
+        patterns = list(BLOCKED_PATTERNS)
+        for settings in self.guilds.values():
+            patterns += [pattern for pattern in settings.get('extra', []) if pattern not in patterns]
+        return patterns
+
+    def add_pattern(self, guild_id: str, pattern: str) -> bool:
+        """パターンを有効化（既定のパターンは無効化を解除、それ以外は追加）"""
+        pattern = pattern.lower()
+        settings = self.guilds.setdefault(guild_id, {'disabled': [], 'extra': []})
+        if pattern in settings['disabled']:
+            settings['disabled'].remove(pattern)
+        elif pattern in BLOCKED_PATTERNS or pattern in settings['extra']:
+            return False
+        else:
+            settings['extra'].append(pattern)
+        self._save_config()
+        return True
+
+    def remove_pattern(self, guild_id: str, pattern: str) -> bool:
+        """パターンを無効化（既定のパターンは無効化、追加したパターンは削除）"""
+        pattern = pattern.lower()
+        settings = self.guilds.setdefault(guild_id, {'disabled': [], 'extra': []})
+        if pattern in settings['extra']:
+            settings['extra'].remove(pattern)
+        elif pattern in BLOCKED_PATTERNS and pattern not in settings['disabled']:
+            settings['disabled'].append(pattern)
+        else:
+            return False
+        self._save_config()
+        return True
+
+
+# グローバルインスタンス
+blocked_pattern_settings = BlockedPatternSettings()
@@ -0,0 +1,173 @@
+"""
+推論精度モード - CPU向けのbfloat16 / 動的int8量子化
+
+fp32モデルを指定の精度に変換し、組み込みの確認用テキストで品質を検査する。
+変換や検査に失敗した場合はfp32にフォールバックする
+"""
+
+import contextlib
+import os
+from typing import Dict, List, Optional, Tuple
+
+# PyTorchのインポートを安全に行う
+try:
+    import torch
+    TORCH_AVAILABLE = True
+except ImportError:
+    TORCH_AVAILABLE = False
+
+# psutilのインポートを安全に行う
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+PRECISION_MODES = ("fp32", "bf16", "int8")
+
+# 品質確認用のテキスト（教師強制での平均負対数尤度を比較）
+QUALITY_CHECK_TEXTS = [
+    "質問: おはようございます\n回答: おはようございます。今日もよろしくお願いします。",
+    "質問: 好きな食べ物は何ですか？\n回答: 私はカレーライスが好きです。",
+    "質問: 明日の天気はどうなるでしょうか\n回答: 晴れるといいですね。",
+]
+
+
+def get_rss_mb() -> float:
+    """現在のプロセスの常駐メモリ（MB）を取得"""
+    if not PSUTIL_AVAILABLE:
+        return 0.0
+    try:
+        return psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
+    except Exception:
+        return 0.0
+
+
+def get_model_size_mb(model) -> float:
+    """モデルの重みサイズ（MB）を取得（量子化済みの重みも含む）"""
+    total_bytes = 0
+    for tensor in model.state_dict().values():
+        if hasattr(tensor, 'element_size'):
+            total_bytes += tensor.numel() * tensor.element_size()
+        elif isinstance(tensor, tuple):
+            # 動的量子化Linearのpacked params（重み, バイアス）
+            for item in tensor:
+                if hasattr(item, 'element_size'):
+                    total_bytes += item.numel() * item.element_size()
+    return total_bytes / 1024 ** 2
+
+
+def evaluate_quality(model, tokenizer, device, texts: Optional[List[str]] = None) -> float:
+    """確認用テキストでの平均負対数尤度（低いほど良い）"""
+    texts = texts or QUALITY_CHECK_TEXTS
+    losses = []
+    with torch.no_grad():
+        for text in texts:
+            inputs = tokenizer(text, return_tensors="pt").to(device)
+            outputs = model(**inputs, labels=inputs.input_ids)
+            losses.append(float(outputs.loss))
+    return sum(losses) / len(losses)
+
+
+def _convert_conv1d_to_linear(model):
+    """GPT-2のConv1D層をnn.Linearに置き換える（動的量子化の対象にするため）"""
+    from transformers.pytorch_utils import Conv1D
+
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if not isinstance(child, Conv1D):
+                continue
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features, bias=child.bias is not None)
+            linear.weight.data = child.weight.data.t().contiguous()
+            if child.bias is not None:
+                linear.bias.data = child.bias.data
+            setattr(module, child_name, linear)
+    return model
+
+
+def convert_model(model, mode: str):
+    """モデルを指定の精度に変換"""
+    if mode == "bf16":
+        return model.to(torch.bfloat16)
+    if mode == "int8":
+        model = _convert_conv1d_to_linear(model)
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def apply_precision(
+    model,
+    tokenizer,
+    device,
+    mode: str,
+    max_loss_increase: float = 0.15
+) -> Tuple[object, str, Dict]:
+    """
+    モデルに精度モードを適用して品質を確認
+
+    戻り値: (モデル, 実際に有効な精度モード, レポート)
+    レポートのfallbackとmutatedがTrueの場合、返されるモデルは変換済み（または変換途中）のため
+    呼び出し側でfp32モデルを再ロードすること（mutatedがFalseならfp32の重みはそのまま使える）
+    """
+    report = {
+        "requested": mode,
+        "active": "fp32",
+        "fallback": False,
+        # fp32の重みを変換したか（フォールバック時に再ロードが必要か）
+        "mutated": False,
+        "reason": None,
+        "fp32_loss": None,
+        "loss": None,
+        "fp32_size_mb": 0.0,
+        "size_mb": 0.0,
+        "fp32_rss_mb": get_rss_mb(),
+        "rss_mb": 0.0
+    }
+
+    if not TORCH_AVAILABLE or mode == "fp32":
+        report["size_mb"] = report["fp32_size_mb"] = get_model_size_mb(model) if TORCH_AVAILABLE else 0.0
+        report["rss_mb"] = report["fp32_rss_mb"]
+        return model, "fp32", report
+
+    if mode not in PRECISION_MODES:
+        report.update(fallback=True, reason=f"不明な精度モード: {mode}")
+        return model, "fp32", report
+
+    # 低精度モードはCPUのみ対応（CUDAはfloat16、MPSはfloat32で動作）
+    if device.type != "cpu":
+        report.update(fallback=True, reason=f"{device.type}では{mode}に非対応")
+        return model, "fp32", report
+
+    try:
+        report["fp32_size_mb"] = get_model_size_mb(model)
+        report["fp32_loss"] = evaluate_quality(model, tokenizer, device)
+
+        report["mutated"] = True
+        model = convert_model(model, mode)
+        with precision_context(mode):
+            loss = evaluate_quality(model, tokenizer, device)
+
+        report["loss"] = loss
+        report["size_mb"] = get_model_size_mb(model)
+        report["rss_mb"] = get_rss_mb()
+
+        # 品質劣化が許容範囲を超える場合はフォールバック
+        fp32_loss = report["fp32_loss"]
+        if loss != loss or loss > fp32_loss * (1 + max_loss_increase):
+            report.update(fallback=True, reason=f"品質低下 (loss {fp32_loss:.3f} → {loss:.3f})")
+            return model, "fp32", report
+
+    except Exception as e:
+        report.update(fallback=True, reason=str(e))
+        return model, "fp32", report
+
+    report["active"] = mode
+    return model, mode, report
+
+
+def precision_context(mode: str):
+    """生成時に使う精度のコンテキスト（bf16はautocast）"""
+    if TORCH_AVAILABLE and mode == "bf16":
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
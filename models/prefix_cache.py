@@ -0,0 +1,211 @@
+"""
+プレフィックスKVキャッシュ - 会話ごとの「前回: … → …」部分のpast_key_valuesを保持
+
+_build_promptのプロンプトは、同じ会話の次のターンでは前回のやり取りから作る
+同じプレフィックスで始まる。会話履歴が変わった時点でプレフィックスを先に
+エンコードしておき、次の生成では新しい「質問:」以降だけをエンコードする
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+# PyTorchとTransformersのインポートを安全に行う
+try:
+    import torch
+    TORCH_AVAILABLE = True
+except ImportError:
+    TORCH_AVAILABLE = False
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    # 古いtransformersはタプル形式のpast_key_valuesをそのまま受け取る
+    DynamicCache = None
+
+
+class PrefixEntry:
+    """1会話分のエンコード済みプレフィックス"""
+
+    def __init__(self, prefix_text: str, token_ids: Tuple[int, ...], past_key_values, nbytes: int, encode_time: float):
+        """
+        初期化
+
+        prefix_text: プレフィックスの文字列（プロンプトと一致するか確認に使う）
+        token_ids: プレフィックスのトークンID
+        past_key_values: レイヤーごとの (key, value) テンソルの組（バッチサイズ1）
+        nbytes: テンソルの合計バイト数
+        encode_time: プレフィックスのエンコードにかかった時間（秒、節約できる時間の見積もり）
+        """
+        self.prefix_text = prefix_text
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.nbytes = nbytes
+        self.encode_time = encode_time
+
+
+class PrefixKVCache:
+    """会話ごとのプレフィックスKVキャッシュ（LRU・メモリ上限付き）"""
+
+    def __init__(self, max_entries: int = 32, max_bytes: int = 256 * 1024 ** 2):
+        """
+        初期化
+
+        max_entries: 保持する最大会話数（超えたら最も古く使われたものから削除）
+        max_bytes: 保持するテンソルの合計バイト数の上限
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = max_entries > 0 and max_bytes > 0
+        self.disabled_reason: Optional[str] = None
+
+        self._entries: "OrderedDict[Hashable, PrefixEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # 統計
+        self.prefills = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.time_saved = 0.0
+        self.tokens_saved = 0
+
+    def get(self, key: Hashable, prefix_text: str) -> Optional[PrefixEntry]:
+        """会話のプレフィックスを取得（プロンプトのプレフィックスと一致しない場合はNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.prefix_text != prefix_text:
+                # 履歴の変更通知より先に届いたリクエストなど
+                self.stale += 1
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def record_hit(self, entry: PrefixEntry):
+        """キャッシュを使って生成したことを記録"""
+        with self._lock:
+            self.hits += 1
+            self.time_saved += entry.encode_time
+            self.tokens_saved += len(entry.token_ids)
+
+    def record_miss(self):
+        """プロンプトがキャッシュと食い違い使えなかったことを記録"""
+        with self._lock:
+            self.misses += 1
+
+    def put(self, key: Hashable, entry: PrefixEntry):
+        """会話のプレフィックスを保存（上限を超えたら古いものから削除）"""
+        if not self.enabled or entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.nbytes
+            self.prefills += 1
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """会話履歴が変わったプレフィックスを破棄"""
+        with self._lock:
+            if self._remove(key):
+                self.invalidations += 1
+
+    def _remove(self, key: Hashable) -> bool:
+        """エントリを削除（ロック取得済みで呼ぶ）"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry.nbytes
+        return True
+
+    def disable(self, reason: str):
+        """プレフィックスキャッシュを無効化"""
+        with self._lock:
+            self.enabled = False
+            self.disabled_reason = reason
+            self._entries.clear()
+            self._bytes = 0
+        print(f"⚠️ プレフィックスKVキャッシュを無効にしました: {reason}")
+
+    def get_stats(self) -> Dict:
+        """キャッシュの統計を取得"""
+        with self._lock:
+            lookups = self.hits + self.misses + self.stale
+            return {
+                "enabled": self.enabled,
+                "disabled_reason": self.disabled_reason,
+                "entries": len(self._entries),
+                "size_mb": self._bytes / 1024 ** 2,
+                "prefills": self.prefills,
+                "hits": self.hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stale": self.stale,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+                "tokens_saved": self.tokens_saved,
+                "time_saved": self.time_saved,
+                # 対象リクエスト1件あたりのプロンプト処理の節約時間（ミリ秒）
+                "saved_ms_per_request": self.time_saved * 1000 / lookups if lookups else 0.0
+            }
+
+
+def encode_prefix(
+    model,
+    tokenize: Callable[[str], List[int]],
+    prefix_text: str,
+    follow_text: str,
+    device
+) -> Optional[PrefixEntry]:
+    """
+    プレフィックスをエンコードしてpast_key_valuesを作成
+
+    tokenize: 文字列をトークンID列にする関数（プロンプトのトークナイズと同じ方法）
+    follow_text: プレフィックスの直後に必ず続く文字列（「質問:」）。続きと合わせて
+    トークナイズしても変わらないトークンだけをキャッシュする（境界のトークンの結合や末尾の特殊トークン対策）
+    """
+    if not TORCH_AVAILABLE:
+        return None
+
+    prefix_ids = tokenize(prefix_text)
+    prompt_ids = tokenize(prefix_text + follow_text)
+    length = 0
+    while length < min(len(prefix_ids), len(prompt_ids)) and prefix_ids[length] == prompt_ids[length]:
+        length += 1
+    if length == 0:
+        return None
+    token_ids = tuple(prompt_ids[:length])
+
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        outputs = model(torch.tensor([token_ids], device=device), use_cache=True)
+    past_key_values = outputs.past_key_values
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        past_key_values = past_key_values.to_legacy_cache()
+    encode_time = time.perf_counter() - start_time
+
+    nbytes = sum(tensor.numel() * tensor.element_size() for layer in past_key_values for tensor in layer)
+    return PrefixEntry(prefix_text, token_ids, past_key_values, nbytes, encode_time)
+
+
+def expand_past_key_values(entry: PrefixEntry, rows: int):
+    """generateに渡すpast_key_valuesを作成（候補の行数分に複製、キャッシュ自体は変更しない）"""
+    past_key_values = entry.past_key_values
+    if rows > 1:
+        past_key_values = tuple(
+            tuple(tensor.repeat_interleave(rows, dim=0) for tensor in layer)
+            for layer in past_key_values
+        )
+    if DynamicCache is not None:
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return past_key_values
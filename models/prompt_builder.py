@@ -0,0 +1,170 @@
+"""
+プロンプト構築 - トークン数の予算内で会話履歴と質問を組み立てる
+
+質問と「回答:」の書き出しは必ず残し（長すぎる質問は先頭側を残して切り詰める）、
+残りの予算に新しい順で入るだけの過去のやり取りを入れる。
+各ターンのトークン数はMemoryManagerが保存時（古い履歴は初回の読み込み時）に記録した値を使い、
+古い履歴を毎回トークナイズしない。
+会話の要約がある場合は、要約済みのターンの代わりに要約を先頭に入れる
+"""
+
+import threading
+from typing import Callable, Dict, List, Optional
+
+# プロンプトの書式
+QUESTION_LABEL = "質問:"
+ANSWER_LABEL = "回答:"
+SUMMARY_LABEL = "この会話の要約:"
+
+
+class PromptBuilder:
+    """トークン数の予算付きプロンプトビルダー"""
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        name: str,
+        max_tokens: int = 400,
+        context_tokens: int = 160
+    ):
+        """
+        初期化
+
+        count_tokens: 文字列のトークン数を数える関数（特殊トークンを含めない）
+        name: トークン数の数え方の識別名（モデル名、保存済みのトークン数を区別する）
+        max_tokens: プロンプト全体のトークン数上限
+        context_tokens: 会話履歴に使うトークン数上限（質問が長い場合はさらに減らす）
+        """
+        self.count_tokens = count_tokens
+        self.name = name
+        self.max_tokens = max_tokens
+        self.context_tokens = context_tokens
+        self._lock = threading.Lock()
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        """統計をリセット"""
+        self.prompts = 0
+        self.turns_included = 0
+        self.context_tokens_used = 0
+        self.questions_truncated = 0
+        self.turns_counted = 0
+
+    @staticmethod
+    def format_turn(turn: Dict) -> str:
+        """1ターン分（または要約）の会話履歴の行"""
+        if 'summary' in turn:
+            return f"要約: {turn['summary']}\n"
+        return f"前回: {turn['user']} → {turn['assistant']}\n"
+
+    def count_turn(self, turn: Dict) -> int:
+        """1ターン分（または要約）の行のトークン数（MemoryManagerが保存時に記録する）"""
+        return self.count_tokens(self.format_turn(turn))
+
+    def _turn_tokens(self, turn: Dict) -> int:
+        """記録済みのトークン数（MemoryManagerが読み込み時に補うため、未記録の場合のみここで数える）"""
+        count = turn.get('tokens', {}).get(self.name)
+        if count is None:
+            count = self.count_turn(turn)
+            with self._lock:
+                self.turns_counted += 1
+        return count
+
+    def build_context(self, context: List[Dict], budget: Optional[int] = None) -> str:
+        """予算内に入るだけの最近のやり取りを古い順に並べた履歴部分"""
+        lines, _ = self._select_turns(context, self.context_tokens if budget is None else budget)
+        return "".join(lines)
+
+    def _select_turns(self, context: List[Dict], budget: int):
+        """
+        新しい順に予算内のターンを選び、(古い順の行, 使ったトークン数) を返す
+
+        先頭が要約の場合は要約を先に確保し、残りの予算に要約後のターンを入れる
+        """
+        context = context or []
+        summary_line = ""
+        used = 0
+        if context and 'summary' in context[0]:
+            tokens = self._turn_tokens(context[0])
+            if tokens <= budget:
+                summary_line = self.format_turn(context[0])
+                used = tokens
+            context = context[1:]
+
+        lines: List[str] = []
+        for turn in reversed(context):
+            if 'user' not in turn or 'assistant' not in turn:
+                continue
+            tokens = self._turn_tokens(turn)
+            if used + tokens > budget:
+                break
+            lines.append(self.format_turn(turn))
+            used += tokens
+        if summary_line:
+            lines.append(summary_line)
+        return lines[::-1], used
+
+    def build_question(self, message: str) -> str:
+        """質問と回答の書き出し（プロンプト全体の上限を超える質問は先頭側を残して切り詰める）"""
+        question = self._format_question(message)
+        if self.count_tokens(question) <= self.max_tokens:
+            return question
+
+        # 上限に収まる最長の先頭部分を二分探索
+        low, high = 0, len(message)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(self._format_question(message[:middle])) <= self.max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        with self._lock:
+            self.questions_truncated += 1
+        return self._format_question(message[:low])
+
+    @staticmethod
+    def _format_question(message: str) -> str:
+        """質問部分の書式"""
+        return f"{QUESTION_LABEL} {message}\n{ANSWER_LABEL}"
+
+    def build_summary_prompt(self, previous_summary: Optional[str], turns: List[Dict]) -> str:
+        """会話要約用のプロンプト（予算を超える場合は古いターンから省く）"""
+        head = f"これまでの要約: {previous_summary}\n" if previous_summary else ""
+        budget = self.max_tokens - self.count_tokens(head + SUMMARY_LABEL)
+
+        lines: List[str] = []
+        for turn in reversed(turns):
+            line = f"ユーザー: {turn['user']}\nAI: {turn['assistant']}\n"
+            budget -= self.count_tokens(line)
+            if budget < 0:
+                break
+            lines.append(line)
+        return head + "".join(reversed(lines)) + SUMMARY_LABEL
+
+    def context_budget(self, question: str) -> int:
+        """質問の長さに応じた会話履歴の予算（通常は一定で、会話のプレフィックスが変わらない）"""
+        return max(0, min(self.context_tokens, self.max_tokens - self.count_tokens(question)))
+
+    def build(self, message: str, context: List[Dict]) -> str:
+        """予算内のプロンプトを構築"""
+        question = self.build_question(message)
+        lines, used = self._select_turns(context, self.context_budget(question))
+        with self._lock:
+            self.prompts += 1
+            self.turns_included += len(lines)
+            self.context_tokens_used += used
+        return "".join(lines) + question
+
+    def get_stats(self) -> Dict:
+        """プロンプト構築の統計を取得"""
+        with self._lock:
+            return {
+                "max_tokens": self.max_tokens,
+                "context_tokens": self.context_tokens,
+                "avg_turns": self.turns_included / self.prompts if self.prompts else 0.0,
+                "avg_context_tokens": self.context_tokens_used / self.prompts if self.prompts else 0.0,
+                "questions_truncated": self.questions_truncated,
+                # トークン数が未記録で数え直したターン数
+                "turns_counted": self.turns_counted
+            }
@@ -0,0 +1,107 @@
+"""
+応答キャッシュ - 正規化したプロンプトをキーにしたLRU + TTLキャッシュ
+
+「おはよう」「ありがとう」など繰り返される短いメッセージで
+毎回モデル生成を行わないようにする
+"""
+
+import random
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class ResponseCache:
+    """LRU + TTL 応答キャッシュ"""
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        ttl_seconds: float = 600.0,
+        per_guild: bool = True,
+        bypass_rate: float = 0.0
+    ):
+        """
+        初期化
+
+        max_entries: 保持する最大件数（超えたら最も古く使われたものから削除）
+        ttl_seconds: エントリの有効期間（秒）
+        per_guild: サーバーごとにキャッシュを分けるか
+        bypass_rate: キャッシュを無視して生成し直す確率（応答の単調さを避ける）
+        """
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.per_guild = per_guild
+        self.bypass_rate = bypass_rate
+
+        self._entries: "OrderedDict[Tuple[Optional[str], str], Tuple[str, float]]" = OrderedDict()
+
+        # 統計
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        """プロンプトの正規化（NFKC・空白の圧縮）"""
+        prompt = unicodedata.normalize('NFKC', prompt)
+        return re.sub(r'\s+', ' ', prompt).strip()
+
+    def make_key(self, prompt: str, guild_id: Optional[str] = None) -> Tuple[Optional[str], str]:
+        """キャッシュキーを作成"""
+        scope = guild_id if self.per_guild else None
+        return (scope, self.normalize(prompt))
+
+    def get(self, key: Tuple[Optional[str], str]) -> Optional[str]:
+        """キャッシュから応答を取得（期限切れ・バイパス時はNone）"""
+        if self.bypass_rate > 0 and random.random() < self.bypass_rate:
+            self.bypassed += 1
+            return None
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        response, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key: Tuple[Optional[str], str], response: str):
+        """応答をキャッシュに保存"""
+        self._entries[key] = (response, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self, guild_id: Optional[str] = None):
+        """キャッシュをクリア（guild_id指定時はそのサーバー分のみ）"""
+        if guild_id is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] == guild_id]:
+            del self._entries[key]
+
+    def get_stats(self) -> Dict:
+        """キャッシュ統計を取得"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "miss_ratio": self.misses / lookups if lookups else 0.0
+        }
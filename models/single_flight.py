@@ -0,0 +1,118 @@
+"""
+シングルフライト - 同時に届いた同一プロンプトの生成を1回にまとめる
+
+荒らしやミームの連投で同じ文面が一斉に届いた場合、処理中の生成に相乗りさせて
+結果を全員に返す。長期間保持する応答キャッシュとは別に、同時に処理待ちの仕事だけをまとめる
+"""
+
+import asyncio
+import random
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from models.cancellation import (
+    CancellationGroup, CancellationToken, GenerationCancelled, REASON_SUPERSEDED
+)
+
+
+class _Flight:
+    """処理中の1件の生成と、その結果を待つ呼び出し元"""
+
+    def __init__(self):
+        self.token = CancellationGroup()
+        self.listeners: List[Callable[[str], None]] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def emit(self, text: str):
+        """途中テキストを全員に渡す（イベントループ上で呼ぶ）"""
+        for listener in list(self.listeners):
+            listener(text)
+
+
+class SingleFlight:
+    """同一キーの同時実行を1回にまとめる"""
+
+    def __init__(self, resample_rate: float = 0.0):
+        """
+        初期化
+
+        resample_rate: 相乗りせずに別途生成し直す確率（応答の多様性が必要な場合）
+        """
+        self.resample_rate = resample_rate
+        self._flights: Dict[Hashable, _Flight] = {}
+
+        # 統計
+        self.leaders = 0
+        self.merged = 0
+        self.resampled = 0
+
+    async def run(
+        self,
+        key: Hashable,
+        cancel_token: CancellationToken,
+        start: Callable[[CancellationGroup, Optional[Callable[[str], None]]], Awaitable[Any]],
+        on_partial: Optional[Callable[[str], None]] = None
+    ) -> Any:
+        """
+        同じキーの処理中の生成があれば相乗りし、なければ開始して結果を待つ
+
+        start: 共有の取り消しフラグと途中テキストの通知関数を受け取り、生成を実行するコルーチン関数
+        on_partial: この呼び出し元が途中テキストを受け取るコールバック
+        """
+        while True:
+            flight = self._join(key, start, on_partial is not None)
+            flight.token.add(cancel_token)
+            if on_partial is not None:
+                flight.listeners.append(on_partial)
+
+            try:
+                return await asyncio.shield(flight.task)
+            except asyncio.CancelledError:
+                # この呼び出し元だけが抜ける（全員が抜けたら共有の生成も止まる）
+                cancel_token.cancel(REASON_SUPERSEDED)
+                raise
+            except GenerationCancelled:
+                # 他の全員が取り消した直後に相乗りした場合は生成し直す
+                if cancel_token.cancelled:
+                    raise
+            finally:
+                if on_partial in flight.listeners:
+                    flight.listeners.remove(on_partial)
+
+    def _join(self, key: Hashable, start, streaming: bool) -> _Flight:
+        """相乗りできる生成を探し、なければ新しく開始"""
+        flight = self._flights.get(key)
+        if flight is not None and not flight.task.done() and not flight.token.cancelled:
+            if self.resample_rate <= 0 or random.random() >= self.resample_rate:
+                self.merged += 1
+                return flight
+            self.resampled += 1
+            return self._start(None, start, streaming)
+
+        self.leaders += 1
+        return self._start(key, start, streaming)
+
+    def _start(self, key: Optional[Hashable], start, streaming: bool) -> _Flight:
+        """生成を開始（keyがNoneの場合は相乗りの対象にしない）"""
+        flight = _Flight()
+        flight.task = asyncio.ensure_future(start(flight.token, flight.emit if streaming else None))
+        if key is not None:
+            self._flights[key] = flight
+        flight.task.add_done_callback(lambda _: self._finish(key, flight))
+        return flight
+
+    def _finish(self, key: Optional[Hashable], flight: _Flight):
+        """完了した生成を相乗りの対象から外す"""
+        if key is not None and self._flights.get(key) is flight:
+            del self._flights[key]
+        # 全員が抜けた後の例外も取得済みにしておく（未取得の警告を出さない）
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def get_stats(self) -> Dict:
+        """相乗りの統計を取得"""
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "merged": self.merged,
+            "resampled": self.resampled
+        }
@@ -0,0 +1,171 @@
+"""
+投機的デコーディング - 小さなドラフトモデルで候補トークンを先読みする
+
+同じトークナイザー系列の小さなモデル（例: rinna/japanese-gpt2-small）が提案した
+トークンを本体モデルがまとめて検証する（transformersのassisted generation）。
+採用率と速度向上を計測し、割に合わない場合は通常のデコードに戻す
+"""
+
+import random
+import threading
+from typing import Dict, Optional
+
+# PyTorchとTransformersのインポートを安全に行う
+try:
+    from transformers import AutoModelForCausalLM
+    TORCH_AVAILABLE = True
+except ImportError:
+    TORCH_AVAILABLE = False
+
+# 自動で無効化するか判断するまでに必要な計測回数
+MIN_SPECULATIVE_SAMPLES = 10
+MIN_BASELINE_SAMPLES = 3
+
+
+class SpeculativeDecoder:
+    """ドラフトモデルの管理と採用率・速度向上の計測"""
+
+    def __init__(self, draft_model, min_acceptance: float = 0.3, baseline_rate: float = 0.1):
+        """
+        初期化
+
+        draft_model: 候補トークンを提案する小さなモデル
+        min_acceptance: これを下回る採用率なら通常のデコードに戻す
+        baseline_rate: 速度比較のため通常のデコードで生成する割合
+        """
+        self.draft_model = draft_model
+        self.min_acceptance = min_acceptance
+        self.baseline_rate = baseline_rate
+
+        self.enabled = True
+        self.disabled_reason: Optional[str] = None
+
+        # 生成スレッドごとのforward回数（フックで数える）
+        self._calls = threading.local()
+        self._lock = threading.Lock()
+
+        # 統計
+        self.speculative_runs = 0
+        self.speculative_tokens = 0
+        self.speculative_time = 0.0
+        self.target_calls = 0
+        self.draft_calls = 0
+        self.baseline_runs = 0
+        self.baseline_tokens = 0
+        self.baseline_time = 0.0
+
+    @classmethod
+    def load(cls, model_name: str, target_model, device, **kwargs) -> Optional["SpeculativeDecoder"]:
+        """ドラフトモデルをロード（語彙が本体と異なる場合は使わない）"""
+        if not TORCH_AVAILABLE:
+            return None
+        try:
+            print(f"ドラフトモデル {model_name} をロード中...")
+            draft_model = AutoModelForCausalLM.from_pretrained(model_name, low_cpu_mem_usage=True)
+            if draft_model.config.vocab_size != target_model.config.vocab_size:
+                print("⚠️ ドラフトモデルの語彙が本体と異なるため投機的デコーディングを無効にします")
+                return None
+            draft_model = draft_model.to(device)
+            draft_model.eval()
+        except Exception as e:
+            print(f"⚠️ ドラフトモデルのロードに失敗しました（{e}）。通常のデコードを使用します")
+            return None
+
+        decoder = cls(draft_model, **kwargs)
+        print("✅ 投機的デコーディングを有効にしました")
+        return decoder
+
+    def _count(self, name: str):
+        """forward回数を数える（生成スレッドごと）"""
+        setattr(self._calls, name, getattr(self._calls, name, 0) + 1)
+
+    def choose(self, batch_rows: int) -> Optional[bool]:
+        """
+        この生成で投機的デコーディングを使うか決める
+
+        戻り値: True（使う）/ False（速度比較用に通常デコード）/ None（対象外）
+        ドラフトモデルとの検証は1行ずつのため、1行のバッチのみが対象
+        """
+        if not self.enabled or batch_rows != 1:
+            return None
+        return random.random() >= self.baseline_rate
+
+    def begin(self, target_model, speculative: bool):
+        """
+        計測開始（forward回数をリセット）
+
+        投機的デコードの生成中だけforward回数を数えるフックを登録する
+        （通常の生成・プレフィックスのエンコードでは数えない。endで必ず外す）
+        """
+        self._calls.target = 0
+        self._calls.draft = 0
+        self._calls.hooks = []
+        if speculative:
+            self._calls.hooks = [
+                target_model.register_forward_hook(lambda *_: self._count("target")),
+                self.draft_model.register_forward_hook(lambda *_: self._count("draft"))
+            ]
+
+    def end(self):
+        """計測終了（beginで登録したフックを外す）"""
+        for hook in getattr(self._calls, 'hooks', []):
+            hook.remove()
+        self._calls.hooks = []
+
+    def record(self, speculative: bool, tokens: int, elapsed: float):
+        """1回の生成結果を記録し、割に合わなければ無効化"""
+        with self._lock:
+            if speculative:
+                self.speculative_runs += 1
+                self.speculative_tokens += tokens
+                self.speculative_time += elapsed
+                self.target_calls += getattr(self._calls, 'target', 0)
+                self.draft_calls += getattr(self._calls, 'draft', 0)
+            else:
+                self.baseline_runs += 1
+                self.baseline_tokens += tokens
+                self.baseline_time += elapsed
+            self._check_payoff()
+
+    def _check_payoff(self):
+        """採用率・速度向上が低ければ通常のデコードに戻す（ロック取得済みで呼ぶ）"""
+        if not self.enabled or self.speculative_runs < MIN_SPECULATIVE_SAMPLES:
+            return
+        acceptance = self._acceptance_rate()
+        if acceptance < self.min_acceptance:
+            self.disable(f"採用率 {acceptance * 100:.0f}% が下限 {self.min_acceptance * 100:.0f}% 未満")
+        elif self.baseline_runs >= MIN_BASELINE_SAMPLES and self._speedup() < 1.0:
+            self.disable(f"速度向上 {self._speedup():.2f}倍 が1倍未満")
+
+    def disable(self, reason: str):
+        """投機的デコーディングを無効化"""
+        self.enabled = False
+        self.disabled_reason = reason
+        print(f"⚠️ 投機的デコーディングを無効にしました: {reason}")
+
+    def _acceptance_rate(self) -> float:
+        """ドラフトの提案トークンのうち本体が採用した割合"""
+        # 本体のforward 1回につき本体自身が1トークン確定し、残りはドラフトの提案を採用したもの
+        accepted = max(0, self.speculative_tokens - self.target_calls)
+        return accepted / self.draft_calls if self.draft_calls else 0.0
+
+    def _speedup(self) -> float:
+        """通常デコードと比べたトークン生成速度の比"""
+        if not self.speculative_time or not self.baseline_time or not self.baseline_tokens:
+            return 0.0
+        speculative_speed = self.speculative_tokens / self.speculative_time
+        baseline_speed = self.baseline_tokens / self.baseline_time
+        return speculative_speed / baseline_speed
+
+    def get_stats(self) -> Dict:
+        """投機的デコーディングの統計を取得"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "disabled_reason": self.disabled_reason,
+                "speculative_runs": self.speculative_runs,
+                "baseline_runs": self.baseline_runs,
+                "acceptance_rate": self._acceptance_rate(),
+                "tokens_per_target_call": self.speculative_tokens / self.target_calls if self.target_calls else 0.0,
+                "speedup": self._speedup()
+            }
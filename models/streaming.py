@@ -0,0 +1,95 @@
+"""
+ストリーミング - バッチ生成中のトークンを行ごとに途中テキストとして通知
+
+transformersのstreamerインターフェース（put/end）に準拠し、
+バッチ内の各行に対応するコールバックへ文単位で途中経過を渡す
+"""
+
+from typing import Callable, List, Optional
+
+# 途中経過を通知する区切り文字
+SENTENCE_TERMINATORS = ('。', '！', '？', '!', '?', '\n')
+
+
+class BatchTextStreamer:
+    """バッチ対応のテキストストリーマー"""
+
+    def __init__(
+        self,
+        tokenizer,
+        callbacks: List[Optional[Callable[[str], None]]],
+        chunk_chars: int = 12
+    ):
+        """
+        初期化
+
+        tokenizer: デコードに使うトークナイザー
+        callbacks: バッチの各行に対応するコールバック（不要な行はNone）
+        chunk_chars: 区切り文字がなくても通知する増分文字数
+        """
+        self.tokenizer = tokenizer
+        self.callbacks = callbacks
+        self.chunk_chars = max(1, chunk_chars)
+
+        self._prompt_seen = False
+        self._tokens: List[List[int]] = [[] for _ in callbacks]
+        self._emitted_lengths = [0 for _ in callbacks]
+        self._finished = [callback is None for callback in callbacks]
+
+    def put(self, value):
+        """generateから1ステップ分のトークンを受け取る"""
+        # 最初の呼び出しはプロンプト全体なのでスキップ
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+
+        token_ids = value.tolist() if hasattr(value, 'tolist') else list(value)
+        if not isinstance(token_ids, list):
+            token_ids = [token_ids]
+
+        for row, row_tokens in enumerate(token_ids):
+            if row >= len(self._tokens) or self._finished[row]:
+                continue
+            # 投機的デコーディングでは1ステップで複数トークンが確定する
+            if not isinstance(row_tokens, list):
+                row_tokens = [row_tokens]
+
+            for token_id in row_tokens:
+                # 終了トークン以降は通知しない
+                if token_id == self.tokenizer.eos_token_id:
+                    self._finished[row] = True
+                    break
+                self._tokens[row].append(token_id)
+
+            if self._tokens[row]:
+                self._maybe_emit(row)
+
+    def end(self):
+        """生成終了時に残りのテキストを通知"""
+        for row in range(len(self._tokens)):
+            if self.callbacks[row] is not None:
+                self._emit(row, self._decode(row))
+
+    def _decode(self, row: int) -> str:
+        """指定行のトークンをデコード"""
+        return self.tokenizer.decode(self._tokens[row], skip_special_tokens=True)
+
+    def _maybe_emit(self, row: int):
+        """文の区切りまたは一定文字数ごとに通知"""
+        text = self._decode(row)
+        new_text = text[self._emitted_lengths[row]:]
+        if not new_text:
+            return
+
+        if new_text.endswith(SENTENCE_TERMINATORS) or len(new_text) >= self.chunk_chars:
+            self._emit(row, text)
+
+    def _emit(self, row: int, text: str):
+        """コールバックを呼び出す"""
+        if len(text) <= self._emitted_lengths[row]:
+            return
+        self._emitted_lengths[row] = len(text)
+        try:
+            self.callbacks[row](text)
+        except Exception as e:
+            print(f"ストリーミング通知エラー: {e}")
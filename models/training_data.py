@@ -0,0 +1,53 @@
+"""
+学習データ - 会話から収集する学習データの保存
+
+LocalAI・RemoteAIのどちらからも同じ形式で保存する
+"""
+
+import json
+import os
+from datetime import datetime
+
+from models.data_stats import data_stats
+
+TRAINING_DATA_PATH = "data/conversations/training_data.json"
+
+# 保持する最大件数
+MAX_TRAINING_DATA = 1000
+
+
+def append_training_data(user_id: str, message: str, response: str, path: str = TRAINING_DATA_PATH):
+    """学習データを1件追加（簡略版）"""
+    try:
+        # データの保存（シンプル版）
+        data = {
+            "user_id": user_id,
+            "timestamp": datetime.now().isoformat(),
+            "message": message[:100],  # 長さ制限
+            "response": response[:200]  # 長さ制限
+        }
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        # 既存データの読み込み
+        training_data = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                training_data = json.load(f)
+        
+        # 新しいデータを追加
+        training_data.append(data)
+        
+        # 最新の1000件のみ保持
+        if len(training_data) > MAX_TRAINING_DATA:
+            training_data = training_data[-MAX_TRAINING_DATA:]
+        
+        # データを保存
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(training_data, f, ensure_ascii=False, indent=2)
+        
+        if path == TRAINING_DATA_PATH:
+            data_stats.set_training_data(len(training_data), os.path.getsize(path))
+            
+    except Exception as e:
+        print(f"学習データ保存エラー: {e}")
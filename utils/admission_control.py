@@ -0,0 +1,110 @@
+"""
+受付制御 - 自動応答リクエストの負荷制限
+
+処理待ちの自動応答数に上限を設け、混雑時は生成を短縮・テンプレート応答に切り替え、
+期限までに生成が始まらなかったリクエストは破棄する
+"""
+
+import time
+from typing import Dict, Optional
+
+from config import Config
+
+# 受付モード
+MODE_NORMAL = "normal"      # 通常の生成
+MODE_SHORT = "short"        # 生成トークン数を短縮
+MODE_TEMPLATE = "template"  # モデルを使わずテンプレート応答
+
+
+class AdmissionTicket:
+    """受付済みリクエストの処理条件"""
+
+    def __init__(self, mode: str, deadline: float, max_new_tokens: Optional[int] = None):
+        self.mode = mode
+        self.deadline = deadline
+        self.max_new_tokens = max_new_tokens
+
+
+class AdmissionController:
+    """自動応答の受付制御"""
+
+    def __init__(
+        self,
+        max_pending: int = 16,
+        deadline_seconds: float = 30.0,
+        short_threshold: int = 6,
+        template_threshold: int = 12,
+        short_max_tokens: int = 20
+    ):
+        """
+        初期化
+
+        max_pending: 同時に処理待ち・処理中にできる自動応答の上限（超えたら破棄）
+        deadline_seconds: 受付から生成開始までの期限（秒）
+        short_threshold: この件数以上が処理待ちなら生成トークン数を短縮
+        template_threshold: この件数以上が処理待ちならテンプレート応答
+        short_max_tokens: 短縮時の生成トークン上限
+        """
+        self.max_pending = max_pending
+        self.deadline_seconds = deadline_seconds
+        self.short_threshold = short_threshold
+        self.template_threshold = template_threshold
+        self.short_max_tokens = short_max_tokens
+
+        self.pending = 0
+
+        # 統計
+        self.admitted = 0
+        self.shed = 0
+        self.expired = 0
+        self.degraded_short = 0
+        self.degraded_template = 0
+
+    def admit(self) -> Optional[AdmissionTicket]:
+        """リクエストの受付（上限超過時はNone）"""
+        if self.pending >= self.max_pending:
+            self.shed += 1
+            return None
+
+        depth = self.pending
+        self.pending += 1
+        self.admitted += 1
+        deadline = time.monotonic() + self.deadline_seconds
+
+        if depth >= self.template_threshold:
+            self.degraded_template += 1
+            return AdmissionTicket(MODE_TEMPLATE, deadline)
+        if depth >= self.short_threshold:
+            self.degraded_short += 1
+            return AdmissionTicket(MODE_SHORT, deadline, self.short_max_tokens)
+        return AdmissionTicket(MODE_NORMAL, deadline)
+
+    def release(self, ticket: AdmissionTicket):
+        """処理完了（成功・失敗・期限切れを問わず呼ぶ）"""
+        self.pending = max(0, self.pending - 1)
+
+    def record_expired(self):
+        """期限切れで破棄したリクエストを記録"""
+        self.expired += 1
+
+    def get_stats(self) -> Dict:
+        """受付制御の統計を取得"""
+        return {
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "expired": self.expired,
+            "degraded_short": self.degraded_short,
+            "degraded_template": self.degraded_template
+        }
+
+
+# グローバルインスタンス
+admission_controller = AdmissionController(
+    max_pending=Config.AUTO_RESPONSE_MAX_PENDING,
+    deadline_seconds=Config.AUTO_RESPONSE_DEADLINE,
+    short_threshold=Config.AUTO_RESPONSE_SHORT_THRESHOLD,
+    template_threshold=Config.AUTO_RESPONSE_TEMPLATE_THRESHOLD,
+    short_max_tokens=Config.AUTO_RESPONSE_SHORT_MAX_TOKENS
+)
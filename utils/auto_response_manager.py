@@ -2,11 +2,14 @@
 自動応答管理 - チャンネル指定での自動AI応答機能
 
 指定されたチャンネルでのメッセージに自動的にAIが応答する機能を管理
+（イベントループからは *_async のメソッドを使い、設定ファイルの保存をスレッドで行う）
 """
 
+import asyncio
 import json
 import os
-from typing import Set
+import threading
+from typing import Dict, Set
 
 
 class AutoResponseManager:
@@ -16,6 +19,12 @@ class AutoResponseManager:
         """初期化"""
         self.config_path = "data/config/auto_response_channels.json"
         self.active_channels: Set[int] = set()
+        
+        # 保存の順序管理（古い内容で新しい保存を上書きしない）
+        self._save_lock = threading.Lock()
+        self._version = 0
+        self._saved_version = 0
+        
         self._load_config()
 
     def _load_config(self):
@@ -29,17 +38,39 @@ class AutoResponseManager:
             print(f"自動応答設定の読み込みエラー: {e}")
             self.active_channels = set()
 
-    def _save_config(self):
-        """設定ファイルの保存"""
-        try:
-            os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
-            data = {
+    def _snapshot(self) -> Dict:
+        """保存する設定の内容（変更の順番を付けて記録）"""
+        self._version += 1
+        return {
+            'version': self._version,
+            'data': {
                 'channels': list(self.active_channels)
             }
-            with open(self.config_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"自動応答設定の保存エラー: {e}")
+        }
+
+    def _save_config(self):
+        """設定ファイルの保存"""
+        self._write_config(self._snapshot())
+
+    async def _save_config_async(self):
+        """設定ファイルの保存（非同期版、書き込みはスレッドで行う）"""
+        await asyncio.to_thread(self._write_config, self._snapshot())
+
+    def _write_config(self, snapshot: Dict):
+        """設定ファイルを書き込み（一時ファイルに書いてから置き換え）"""
+        with self._save_lock:
+            # 後の変更が先に保存済みなら書き込まない
+            if snapshot['version'] < self._saved_version:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
+                temp_path = self.config_path + '.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot['data'], f, ensure_ascii=False, indent=2)
+                os.replace(temp_path, self.config_path)
+                self._saved_version = snapshot['version']
+            except Exception as e:
+                print(f"自動応答設定の保存エラー: {e}")
 
     def add_channel(self, channel_id: int) -> bool:
         """チャンネルを自動応答リストに追加"""
@@ -49,6 +80,14 @@ class AutoResponseManager:
             return True
         return False
 
+    async def add_channel_async(self, channel_id: int) -> bool:
+        """チャンネルを自動応答リストに追加（非同期版）"""
+        if channel_id not in self.active_channels:
+            self.active_channels.add(channel_id)
+            await self._save_config_async()
+            return True
+        return False
+
     def remove_channel(self, channel_id: int) -> bool:
         """チャンネルを自動応答リストから削除"""
         if channel_id in self.active_channels:
@@ -57,6 +96,14 @@ class AutoResponseManager:
             return True
         return False
 
+    async def remove_channel_async(self, channel_id: int) -> bool:
+        """チャンネルを自動応答リストから削除（非同期版）"""
+        if channel_id in self.active_channels:
+            self.active_channels.remove(channel_id)
+            await self._save_config_async()
+            return True
+        return False
+
     def is_active_channel(self, channel_id: int) -> bool:
         """指定チャンネルが自動応答対象かチェック"""
         return channel_id in self.active_channels
@@ -70,6 +117,11 @@ class AutoResponseManager:
         self.active_channels.clear()
         self._save_config()
 
+    async def clear_all_channels_async(self):
+        """全ての自動応答チャンネルをクリア（非同期版）"""
+        self.active_channels.clear()
+        await self._save_config_async()
+
 
 # グローバルインスタンス
 auto_response_manager = AutoResponseManager()
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""
+メッセージ結合 - 自動応答チャンネルでの連投をまとめる
+
+同じチャンネル・同じユーザーの連続したメッセージを待機時間内で1つのプロンプトにまとめ、
+新しいメッセージが届いたら古い生成を取り消す。直近と完全に同じ内容の連投は破棄する
+"""
+
+import asyncio
+import time
+import unicodedata
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Tuple
+
+from config import Config
+
+# (チャンネルID, ユーザーID)
+BurstKey = Tuple[int, int]
+
+
+class MessageBurst:
+    """まとめて1回の応答にするメッセージ群"""
+
+    def __init__(self, max_chars: int = 500):
+        self.messages: List = []
+        self.max_chars = max_chars
+        # 応答の保存・送信を始めたら取り消さない
+        self.committed = False
+
+    @property
+    def last_message(self):
+        """返信先（最後のメッセージ）"""
+        return self.messages[-1]
+
+    @property
+    def content(self) -> str:
+        """結合したプロンプト（上限を超える場合は新しい行を優先）"""
+        lines: List[str] = []
+        length = 0
+        for message in reversed(self.messages):
+            line = message.content.strip()
+            if lines and length + len(line) + 1 > self.max_chars:
+                break
+            lines.insert(0, line)
+            length += len(line) + 1
+        return "\n".join(lines)[-self.max_chars:]
+
+
+class MessageCoalescer:
+    """チャンネル・ユーザー単位のデバウンスと重複排除"""
+
+    def __init__(
+        self,
+        debounce_seconds: float = 1.5,
+        max_burst: int = 5,
+        duplicate_window: float = 60.0,
+        max_chars: int = 500
+    ):
+        """
+        初期化
+
+        debounce_seconds: 最後のメッセージから応答を始めるまでの待機時間（秒、0で結合しない）
+        max_burst: 1回の応答にまとめる最大メッセージ数（達したら待たずに応答）
+        duplicate_window: 同じ内容を重複とみなす時間（秒）
+        max_chars: 結合後のプロンプトの最大文字数
+        """
+        self.debounce_seconds = debounce_seconds
+        self.max_burst = max(1, max_burst)
+        self.duplicate_window = duplicate_window
+        self.max_chars = max_chars
+
+        self._bursts: Dict[BurstKey, MessageBurst] = {}
+        self._timers: Dict[BurstKey, asyncio.Task] = {}
+        self._running: Dict[BurstKey, Tuple[MessageBurst, asyncio.Task]] = {}
+
+        # 直近のメッセージハッシュ（時間で入れ替わる集合）
+        self._recent: Dict[BurstKey, Deque[Tuple[float, int]]] = {}
+
+        # 統計
+        self.received = 0
+        self.dispatched = 0
+        self.duplicates = 0
+        self.superseded = 0
+
+    def submit(self, message, handler: Callable[[MessageBurst], Awaitable[None]]) -> bool:
+        """メッセージを受け付ける（重複として破棄した場合はFalse）"""
+        key = (message.channel.id, message.author.id)
+        self.received += 1
+
+        if self._is_duplicate(key, message.content):
+            self.duplicates += 1
+            return False
+
+        burst = self._bursts.get(key)
+        if burst is None:
+            burst = MessageBurst(self.max_chars)
+            # 生成中の応答があれば取り消して、そのメッセージも含めて応答し直す
+            running = self._running.get(key)
+            if running is not None and not running[0].committed and not running[1].done():
+                running[1].cancel()
+                self.superseded += 1
+                burst.messages.extend(running[0].messages)
+            self._bursts[key] = burst
+        burst.messages.append(message)
+        burst.messages = burst.messages[-self.max_burst:]
+
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        if len(burst.messages) >= self.max_burst or self.debounce_seconds <= 0:
+            self._dispatch(key, handler)
+        else:
+            self._timers[key] = asyncio.create_task(self._wait_and_dispatch(key, handler))
+        return True
+
+    def _is_duplicate(self, key: BurstKey, content: str) -> bool:
+        """直近に同じ内容のメッセージがあったかチェックし、ハッシュを記録"""
+        now = time.monotonic()
+        cutoff = now - self.duplicate_window
+
+        # 全ハッシュが期限切れになったキーは集合ごと削除
+        for stale in [other for other, hashes in self._recent.items() if hashes[-1][0] < cutoff]:
+            del self._recent[stale]
+
+        recent = self._recent.setdefault(key, deque())
+        while recent and recent[0][0] < cutoff:
+            recent.popleft()
+
+        digest = hash(' '.join(unicodedata.normalize('NFKC', content).lower().split()))
+        if any(seen == digest for _, seen in recent):
+            return True
+        recent.append((now, digest))
+        return False
+
+    def discard_message(self, message) -> bool:
+        """削除されたメッセージを応答待ちのメッセージ群から外す（外した場合はTrue）"""
+        key = (message.channel.id, message.author.id)
+        burst = self._bursts.get(key)
+        if burst is None:
+            return False
+        remaining = [pending for pending in burst.messages if pending.id != message.id]
+        if len(remaining) == len(burst.messages):
+            return False
+        burst.messages = remaining
+        
+        # 全部削除されたら応答しない
+        if not remaining:
+            del self._bursts[key]
+            timer = self._timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+        return True
+
+    async def _wait_and_dispatch(self, key: BurstKey, handler: Callable[[MessageBurst], Awaitable[None]]):
+        """待機時間内に次のメッセージが来なければ応答を開始"""
+        await asyncio.sleep(self.debounce_seconds)
+        self._timers.pop(key, None)
+        self._dispatch(key, handler)
+
+    def _dispatch(self, key: BurstKey, handler: Callable[[MessageBurst], Awaitable[None]]):
+        """メッセージ群の応答を開始"""
+        burst = self._bursts.pop(key, None)
+        if burst is None:
+            return
+        self.dispatched += 1
+        task = asyncio.create_task(handler(burst))
+        self._running[key] = (burst, task)
+        task.add_done_callback(lambda _: self._on_done(key, task))
+
+    def _on_done(self, key: BurstKey, task: asyncio.Task):
+        """応答完了時に生成中の記録を消す"""
+        running = self._running.get(key)
+        if running is not None and running[1] is task:
+            del self._running[key]
+
+    def get_stats(self) -> Dict:
+        """結合・重複排除の統計を取得"""
+        return {
+            "received": self.received,
+            "dispatched": self.dispatched,
+            "duplicates": self.duplicates,
+            "superseded": self.superseded,
+            "pending_bursts": len(self._bursts),
+            # 1メッセージ1応答の場合と比べて省いた生成回数
+            "generations_saved": max(0, self.received - self.dispatched)
+        }
+
+
+# グローバルインスタンス
+message_coalescer = MessageCoalescer(
+    debounce_seconds=Config.AUTO_RESPONSE_DEBOUNCE,
+    max_burst=Config.AUTO_RESPONSE_MAX_BURST,
+    duplicate_window=Config.AUTO_RESPONSE_DUPLICATE_WINDOW
+)
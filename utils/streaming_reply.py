@@ -0,0 +1,123 @@
+"""
+ストリーミング返信 - 生成途中のテキストでDiscordメッセージを段階的に編集
+
+Discordの編集レート制限を超えないよう、短時間の更新はまとめて最新の内容だけを反映する
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+
+import discord
+
+from config import Config
+
+
+class StreamingReply:
+    """段階的に編集されるDiscord返信"""
+
+    def __init__(
+        self,
+        send: Callable[[discord.Embed], Awaitable[discord.Message]],
+        build_embed: Callable[[str], discord.Embed],
+        min_interval: Optional[float] = None
+    ):
+        """
+        初期化
+
+        send: 最初のメッセージを送信して返すコルーチン関数
+        build_embed: 途中テキストから表示用Embedを作る関数
+        min_interval: 編集の最小間隔（秒）
+        """
+        self.send = send
+        self.build_embed = build_embed
+        self.min_interval = Config.STREAM_EDIT_INTERVAL if min_interval is None else min_interval
+
+        self.message: Optional[discord.Message] = None
+        self.edit_count = 0
+        self._pending_text: Optional[str] = None
+        self._shown_text: Optional[str] = None
+        self._last_update = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._discarded = False
+
+    def update(self, text: str):
+        """途中テキストを受け取る（イベントループ上で呼ぶ）"""
+        if self._discarded or not text or text == self._shown_text:
+            return
+        self._pending_text = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        """保留中の最新テキストを間隔を空けて反映"""
+        while self._pending_text is not None:
+            wait = self.min_interval - (time.monotonic() - self._last_update)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            text, self._pending_text = self._pending_text, None
+            if text is None or text == self._shown_text:
+                continue
+            try:
+                await self._show(self.build_embed(text))
+                self._shown_text = text
+            except discord.HTTPException as e:
+                print(f"ストリーミング編集エラー: {e}")
+
+    async def _show(self, embed: discord.Embed):
+        """最初は送信、以降は編集"""
+        if self.message is None:
+            self.message = await self.send(embed)
+        else:
+            await self.message.edit(embed=embed)
+            self.edit_count += 1
+        self._last_update = time.monotonic()
+
+    async def finish(self, embed: discord.Embed, text: Optional[str] = None) -> discord.Message:
+        """
+        保留中の更新を破棄し、最終内容を反映
+
+        text: 最終的な応答テキスト（途中表示の続きでない場合は編集せず、送り直す）
+        """
+        self._pending_text = None
+        if self._task is not None and not self._task.done():
+            try:
+                await self._task
+            except Exception:
+                pass
+
+        # 途中表示と別の候補が採用された場合、続きに見える編集にしない
+        if text is not None and not self._continues_preview(text):
+            await self.discard()
+            self.message = await self.send(embed)
+            return self.message
+
+        # 最終編集もレート制限の間隔を守る
+        if self.message is not None:
+            wait = self.min_interval - (time.monotonic() - self._last_update)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        await self._show(embed)
+        return self.message
+
+    def _continues_preview(self, text: str) -> bool:
+        """最終テキストが途中表示の続きかチェック（途中表示がない場合はTrue）"""
+        if self.message is None or not self._shown_text:
+            return True
+        return text.startswith(self._shown_text.rstrip('…'))
+
+    async def discard(self):
+        """途中で送信したメッセージを削除（最終的に応答しない場合）"""
+        # 生成スレッドから遅れて届く途中経過で再送信しないようにする
+        self._discarded = True
+        self._pending_text = None
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        if self.message is not None:
+            try:
+                await self.message.delete()
+            except discord.HTTPException:
+                pass
+            self.message = None